@@ -34,6 +34,7 @@
 
 import file_utils as fu
 import sql_config
+import ucsc_bin as ub
 import utils as u
 
 
@@ -149,8 +150,11 @@ def dbsnpsql(chr, pos, ref, alt, vc):
 
 """" format must be pileup or vcf """
 """ Types of variants in dbSNP135: DIV, SNV,    MNV,   MIXED  """
+""" batch_size > 0 resolves that many variants per query instead of one query per line """
+""" bloom, a dbsnp_bloom.BloomFilter, skips the queries of positions not in dbSNP """
 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='SNV', sep='\t'):
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='SNV', sep='\t', batch_size=0,
+                     bloom=None):
     outfile = vcf+tmpextout
     fh_out = open(outfile, "w")
     logcountfile=vcf+'.count.log'
@@ -164,56 +168,46 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='S
     cursor = conn.cursor ()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if line.startswith("#")==False:
-            fields=line.split(sep)
-            chr=fields[inds[0]].strip()
-            if(chr.startswith("chr")==True):
-                chr = chr.replace('chr', '')
-
-            pos=fields[inds[1]].strip()
-            ref=clean_shit(fields[inds[2]]).strip()
-            alt=clean_shit(fields[inds[3]]).strip()
-
-            compRef=getComplementary(ref)
-            compAlt=getComplementary(alt)
-
-            #sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( (  REF="'+ str(ref) + '" AND ALT ="'+ str(alt)+'")  OR (REF="'+ str(compRef) + '" AND ALT ="'+ str(compAlt)+'" )) ;'
-            sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( REF="'+ str(ref) + '" OR REF ="'+ str(compRef)+'" )  AND INFO = "'+varclass+'" ;'
-            cursor.execute (sql)
-            rows = cursor.fetchall ()
-            fields[2]='.'
-            rsids=[]
-            mafs=[]
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) !='.':
-                        mafs.append('GMAF='+str(row[7]))
-
-                maf_str=''
-                if len(mafs)>0:
-                    maf_str=';'+';'.join([str(x) for x in mafs])
+    if batch_size > 0:
+        for block in readBlocks(fh, batch_size):
+            variants=[]
+            for line, fields in block:
+                if fields is not None:
+                    variants.append(dbSnpVariant(fields, inds))
 
+            found=lookupSnpsFromDbSnp(cursor, variants, varclass=varclass, bloom=bloom)
 
-                var_count=var_count+1
-                if str(fields[7])=='.':
-                    fields[7]='DB'+maf_str #fields[7]+';'+str(row[6])
+            v=0
+            for line, fields in block:
+                if fields is None:
+                    fh_out.write(line+'\n')
                 else:
-                    fields[7]=fields[7]+';DB;VC='+varclass + maf_str
-
-                fields[2]=str(';'.join(rsids))
-                l='\t'.join([str(x) for x in fields])
-                fh_out.write(l+'\n')
-
-            else:
+                    if addDbSnpRows(fields, found[v], varclass=varclass):
+                        var_count=var_count+1
+                    fh_out.write('\t'.join([str(x) for x in fields])+'\n')
+                    v=v+1
+                    linenum = linenum +1
+    else:
+        for line in fh:
+            line = line.strip()
+            if line.startswith("#")==False:
+                fields=line.split(sep)
+                chr, pos, ref, compRef = dbSnpVariant(fields, inds)
+
+                #sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( (  REF="'+ str(ref) + '" AND ALT ="'+ str(alt)+'")  OR (REF="'+ str(compRef) + '" AND ALT ="'+ str(compAlt)+'" )) ;'
+                sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( REF="'+ str(ref) + '" OR REF ="'+ str(compRef)+'" )  AND INFO = "'+varclass+'" ;'
+                rows = []
+                if bloom is None or bloom.mightContain(chr, pos):
+                    cursor.execute (sql)
+                    rows = cursor.fetchall ()
+                if addDbSnpRows(fields, rows, varclass=varclass):
+                    var_count=var_count+1
                 ## reset rsid to "." - in case there was annotation from old release of dbSNP
                 fh_out.write('\t'.join([str(x) for x in fields])+'\n')
 
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
+                linenum = linenum +1
+            else:
+                fh_out.write(line+'\n')
 
     ratioInDbSnp = (var_count/float(linenum))*100
     fh_log.write("## Please notice that all Isoforms were counted "+'\n')
@@ -227,10 +221,106 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='S
     fh_out.close()
 
 
-
+""" Reads stripped lines in blocks holding up to batch_size variants.
+    Header lines are kept in place with fields set to None """
+def readBlocks(fh, batch_size, sep='\t'):
+    block=[]
+    count=0
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            block.append((line, None))
+        else:
+            block.append((line, line.split(sep)))
+            count=count+1
+            if count == batch_size:
+                yield block
+                block=[]
+                count=0
+    if len(block) > 0:
+        yield block
+
+
+""" Chromosome, position and the two strands of the reference allele used to query dbSNP """
+def dbSnpVariant(fields, inds):
+    chr=fields[inds[0]].strip()
+    if(chr.startswith("chr")==True):
+        chr = chr.replace('chr', '')
+
+    pos=fields[inds[1]].strip()
+    ref=clean_shit(fields[inds[2]]).strip()
+
+    return (chr, pos, ref, getComplementary(ref))
+
+
+""" Writes dbSNP rows into ID and INFO, returns True if the variant is in dbSNP """
+def addDbSnpRows(fields, rows, varclass='SNV'):
+    fields[2]='.'
+    if len(rows) == 0:
+        return False
+
+    rsids=[]
+    mafs=[]
+    for row in rows:
+        rsids.append(str(row[3]))
+        if str(row[7]) !='.':
+            mafs.append('GMAF='+str(row[7]))
+
+    maf_str=''
+    if len(mafs)>0:
+        maf_str=';'+';'.join([str(x) for x in mafs])
+
+    if str(fields[7])=='.':
+        fields[7]='DB'+maf_str #fields[7]+';'+str(row[6])
+    else:
+        fields[7]=fields[7]+';DB;VC='+varclass + maf_str
+
+    fields[2]=str(';'.join(rsids))
+    return True
+
+
+""" Resolves a list of dbSnpVariant tuples with one query.
+    Returns the matching rows for every variant, in the order the variants were given.
+    MySQL compares strings case-insensitively, so do the matching here.
+    Positions a bloom filter rules out are left out of the query """
+def lookupSnpsFromDbSnp(cursor, variants, varclass='SNV', bloom=None):
+    if len(variants) == 0:
+        return []
+
+    positions={}
+    for chr, pos, ref, compRef in variants:
+        if bloom is None or bloom.mightContain(chr, pos):
+            positions.setdefault(chr.upper(), set()).add(int(pos))
+
+    if len(positions) == 0:
+        return [[] for v in variants]
+
+    where=[]
+    for chr in sorted(positions.keys()):
+        inlist=','.join([str(x) for x in sorted(positions[chr])])
+        where.append('(CHR="'+ str(chr) + '" AND POS IN (' + inlist + '))')
+
+    sql='select * from dbSNP where INFO = "'+varclass+'" AND (' + ' OR '.join(where) + ');'
+    cursor.execute (sql)
+    columns=[str(d[0]).upper() for d in cursor.description]
+    chr_col=columns.index('CHR')
+    pos_col=columns.index('POS')
+    ref_col=columns.index('REF')
+
+    byPosition={}
+    for row in cursor.fetchall ():
+        byPosition.setdefault((str(row[chr_col]).upper(), int(row[pos_col])), []).append(row)
+
+    found=[]
+    for chr, pos, ref, compRef in variants:
+        refs=(ref.upper(), compRef.upper())
+        rows=byPosition.get((chr.upper(), int(pos)), [])
+        found.append([row for row in rows if str(row[ref_col]).upper() in refs])
+
+    return found
 """" format must be pileup or vcf """
 """" this method is slower than above """""
-def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass='SNV', sep='\t'):
+def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass='SNV', sep='\t', bloom=None):
     outfile = vcf+tmpextout
     fh_out = open(outfile, "w")
     logcountfile=vcf+'.count.log'
@@ -258,8 +348,10 @@ def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass
 
             sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos)  + ' AND INFO != "'+varclass+'" ;'
 
-            cursor.execute (sql)
-            rows = cursor.fetchall ()
+            rows = []
+            if bloom is None or bloom.mightContain(chr, pos):
+                cursor.execute (sql)
+                rows = cursor.fetchall ()
             fields[2]='.'
             rsids=[]
             vcs=[]
@@ -457,6 +549,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, tmpextin='
 
 
             sql='select * from ' + table + ' where chrom="'+ str(chr) + '"   AND (txStart - ' + str(promoter_offset) +') <= ' + str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + str(promoter_offset) +');'
+            sql=ub.addBins(cursor, table, sql, pos, promoter_offset)
 
             cursor.execute (sql)
             rows = cursor.fetchall ()
@@ -525,6 +618,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, tmpextin='
 
                     elif u.isBetween(pos, promoter_plus, txtStart) and strand=="+":
                         sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql=ub.addBins(cursor, 'cpgIslandExt', sql, pos)
                         cursor.execute (sql)
                         rows = cursor.fetchone ()
                         if rows is not None:
@@ -532,6 +626,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, tmpextin='
                             promoter_count=promoter_count+1
                     elif u.isBetween(pos, txtEnd, promoter_minus) and strand=="-":
                         sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql=ub.addBins(cursor, 'cpgIslandExt', sql, pos)
                         cursor.execute (sql)
                         rows = cursor.fetchone ()
                         if rows is not None:
@@ -645,6 +740,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, tmpext
             this_gene_name = str(u.parse_field(info_field, 'name',';','='))
 
             sql='select * from ' + table + ' where chrom="'+ str(chr) + '"   AND (txStart - ' + str(promoter_offset) +') <= ' + str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + str(promoter_offset) +');'
+            sql=ub.addBins(cursor, table, sql, pos, promoter_offset)
             cursor.execute (sql)
             rows = cursor.fetchall ()
             info=[]
@@ -720,6 +816,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, tmpext
 
                     elif u.isBetween(pos, promoter_plus, txtStart) and strand=="+":
                         sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql=ub.addBins(cursor, 'cpgIslandExt', sql, pos)
                         cursor.execute (sql)
                         rows = cursor.fetchone ()
                         if rows is not None:
@@ -727,6 +824,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, tmpext
                             promoter_count=promoter_count+1
                     elif u.isBetween(pos, txtEnd, promoter_minus) and strand=="-":
                         sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                        sql=ub.addBins(cursor, 'cpgIslandExt', sql, pos)
                         cursor.execute (sql)
                         rows = cursor.fetchone ()
                         if rows is not None:
@@ -845,6 +943,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', tmpext
                 ## chrom is not needed, as one table contains one chromosome
                 #sql='select chrom, chromStart, chromEnd, name from tfbsConsSites' +chrIndex+ ' where  chrom="'+ str(chr) + '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
                 sql='select chrom, chromStart, chromEnd, name from tfbsConsSites' +chrIndex+ ' where  chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd;'
+                sql=ub.addBins(cursor, 'tfbsConsSites'+chrIndex, sql, pos)
                 #print (sql)
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -927,6 +1026,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', tmpexto
                 isOverlap = False
 
                 sql='select * from ' + table + ' where chromosome="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -1001,6 +1101,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', tmpextin='
                 isOverlap = False
 
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND chromEnd = ' + str(pos) + ';'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -1072,6 +1173,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', tmpextin=
                 isOverlap = False
 
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -1157,6 +1259,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf', table='genomicSuperDups',
                 l=str(isOverlap)
 
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchone ()
@@ -1231,6 +1334,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene', tmpextin='', tmpex
                 pos=fields[inds[1]].strip()
                 isOverlap = False
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (' + startName + ' <= ' + str(pos) + ' AND ' + str(pos) + ' <= ' + endName +');'
+                sql=ub.addBins(cursor, table, sql, pos)
                 overlapsWith=[]
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -1307,6 +1411,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', tmpextin='', tmp
                 pos=fields[inds[1]].strip()
                 isOverlap = False
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (' + startName + ' <= ' + str(pos) + ' AND ' + str(pos) + ' <= ' + endName +');'
+                sql=ub.addBins(cursor, table, sql, pos)
                 overlapsWith=[]
                 cursor.execute (sql)
                 rows = cursor.fetchall ()
@@ -1371,6 +1476,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', tmpextin='', t
                 pos=fields[inds[1]].strip()
                 isOverlap = False
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchone ()
@@ -1435,6 +1541,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', tmpextin='', tmp
                     chr = "chr" + chr
                 pos=fields[inds[1]].strip()
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchone ()
@@ -1501,6 +1608,7 @@ def addOverlapWithPutativePromoter(vcf, format='vcf', table='putativePromoter',
                     chr = "chr" + chr
                 pos=fields[inds[1]].strip()
                 sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+                sql=ub.addBins(cursor, table, sql, pos)
                 #print(sql)
                 cursor.execute (sql)
                 rows = cursor.fetchone ()
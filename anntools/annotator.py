@@ -1,80 +1,232 @@
+import collections
+import os
 import subprocess
+import time
 import boto3
 import json
 from botocore.exceptions import ClientError
 import config_init
+import job_executor
 import sys
 
-app_config = config_init.UtilsConfig()
-
-# ref: http://boto3.readthedocs.io/en/latest/reference/services/s3.html#bucket
-# Create s3 client
-s3 = boto3.resource('s3', region_name=app_config.AWS_REGION_NAME)
-
-# ref: http://boto3.readthedocs.io/en/latest/guide/sqs.html
-# Create sqs client
-sqs = boto3.resource('sqs', region_name=app_config.AWS_REGION_NAME)
-queue = sqs.get_queue_by_name(QueueName=app_config.AWS_SQS_JOB_REQUEST_NAME)
-
-# Looping to retrieve messages from SQS
-while True:
-    messages = queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=5)
-    if len(messages) == 0:
-        continue
-
-    for message in messages:
-        data = json.loads(json.loads(message.body)['Message'])
-
-        try:
-            bucket = data['s3_inputs_bucket']
-            key = data['s3_key_input_file']
-            file_info = key.split('/')[2]
-            results_bucket = data['s3_results_bucket']
-            user_id = data['user_id']
-            job_id = data['job_id']
-            email = data['email']
-            url = data['url']
-            role = data['role']
-            file_path = app_config.LOCAL_DATA_PREFIX + file_info
-            print('File Path: {}'.format(file_path))
-            print('Key: {}'.format(key))
-
-            status = 'PENDING'
-
-            # ref: http://boto3.readthedocs.io/en/latest/reference/services/s3.html#S3.Bucket.download_file
-            # Download file from s3 bucket
-            s3.Bucket(bucket).download_file(key, file_path)
-
-            # Run the annotator
-            subprocess.Popen([sys.executable, 'run.py', file_path, user_id, email, url, role])
-
-            status = "RUNNING"
-
-            print(status)
-            # Create dynamodb client
-            dynamodb = boto3.resource('dynamodb', region_name=app_config.AWS_REGION_NAME)
-
-            # Update dynamodb
-            # ref: https://github.com/santoshghimire/boto3-examples/blob/master/dynamodb.py
-            ann_table = dynamodb.Table(app_config.AWS_DYNAMODB_ANNOTATIONS_TABLE)
-            ann_table.update_item(
-                Key={
-                    'job_id': job_id
-                },
-                UpdateExpression="set job_status = :running",
-                ConditionExpression="job_status = :pending",
-                ExpressionAttributeValues={
-                    ':pending': 'PENDING',
-                    ':running': status
-                },
-                ReturnValues="ALL_NEW"
-            )
-
-            message.delete()
-
-            print('Job submitted successfully')
-
-        except ClientError as e:
-            message.delete()
-            print(e)
-            continue
+
+class JobScheduler(object):
+    """ The run.py children of the annotator, at most concurrency of them at
+        once (default: one per CPU core). With warm, the jobs run on the
+        pre-warmed executors of a job_executor.ExecutorPool instead """
+
+    def __init__(self, concurrency=0, warm=False):
+        self.concurrency = concurrency
+        if self.concurrency <= 0:
+            self.concurrency = os.cpu_count() or 1
+        self.pool = None
+        if warm:
+            self.pool = job_executor.ExecutorPool(self.concurrency)
+        # pid of the child or executor -> (child, job id, start time)
+        self.running = {}
+
+    def free(self):
+        """ Jobs that can start now """
+        if self.pool is not None:
+            # fewer when executors failed to start
+            return self.pool.idle()
+        return self.concurrency - len(self.running)
+
+    def submit(self, job_id, args):
+        if self.pool is not None:
+            self.running[self.pool.submit(job_id, args)] = (None, job_id, time.time())
+        else:
+            child = subprocess.Popen([sys.executable, 'run.py'] + args)
+            self.running[child.pid] = (child, job_id, time.time())
+        print('Job {} started ({} of {} slots in use)'.format(job_id, len(self.running), self.concurrency))
+
+    def reap(self):
+        """ Forgets the jobs that finished """
+        if self.pool is not None:
+            exited = [(pid, code) for pid, job_id, code in self.pool.poll()]
+        else:
+            exited = [(pid, child.returncode) for pid, (child, job_id, started) in self.running.items()
+                      if child.poll() is not None]
+        for pid, code in exited:
+            child, job_id, started = self.running.pop(pid)
+            print('Job {} exited with code {} after {:.1f} seconds'.format(job_id, code, time.time() - started))
+
+
+class JobLanes(object):
+    """ Jobs received and waiting for a slot, in one FIFO lane per role.
+
+        The lanes are served weighted-fair (stride scheduling): while both
+        have jobs waiting, a lane of weight 3 starts 3 jobs for every job of
+        a lane of weight 1, so premium jobs go first without free ones
+        starving. A lane that was empty starts again level with the others
+        rather than with the credit of its idle time. Roles without a lane
+        of their own share the last one. """
+
+    def __init__(self, weights):
+        self.weights = collections.OrderedDict(weights)
+        self.waiting = collections.OrderedDict([(lane, collections.deque()) for lane in self.weights])
+        # jobs started per lane, divided by its weight
+        self.passes = dict([(lane, 0.0) for lane in self.weights])
+        # lane -> [jobs started, total and longest wait in seconds]
+        self.waits = dict([(lane, [0, 0.0, 0.0]) for lane in self.weights])
+
+    def __len__(self):
+        return sum([len(jobs) for jobs in self.waiting.values()])
+
+    def lane(self, role):
+        if role in self.weights:
+            return role
+        return list(self.weights.keys())[-1]
+
+    def jobs(self):
+        for lane in self.waiting.values():
+            for job in lane:
+                yield job
+
+    def put(self, role, job):
+        """ job is a dict, with 'sent' the time it was queued """
+        lane = self.lane(role)
+        if len(self.waiting[lane]) == 0:
+            busy = [self.passes[l] for l in self.waiting if len(self.waiting[l]) > 0]
+            if len(busy) > 0:
+                self.passes[lane] = max(self.passes[lane], min(busy))
+        self.waiting[lane].append(job)
+
+    def get(self):
+        """ (lane, job) of the next job to start """
+        lane = min([l for l in self.waiting if len(self.waiting[l]) > 0],
+                   key=lambda l: (self.passes[l], -self.weights[l]))
+        job = self.waiting[lane].popleft()
+        self.passes[lane] += 1.0 / self.weights[lane]
+        waited = max(time.time() - job['sent'], 0.0)
+        self.waits[lane][0] += 1
+        self.waits[lane][1] += waited
+        self.waits[lane][2] = max(self.waits[lane][2], waited)
+        print('Job {} of the {} lane waited {:.1f} seconds'.format(job['data']['job_id'], lane, waited))
+        return (lane, job)
+
+    def summary(self):
+        lanes = []
+        for lane, (started, total, longest) in self.waits.items():
+            mean = 0.0
+            if started > 0:
+                mean = total / started
+            lanes.append('{} {} started, {} waiting, wait mean {:.1f} s, max {:.1f} s'.format(
+                lane, started, len(self.waiting[lane]), mean, longest))
+        return 'Lanes: ' + '; '.join(lanes)
+
+
+# the executors of job_executor.py import this module again, without running the loop
+if __name__ == '__main__':
+    app_config = config_init.UtilsConfig()
+    scheduler = JobScheduler(app_config.JOB_CONCURRENCY, warm=app_config.WARM_EXECUTORS)
+    lanes = JobLanes(app_config.JOB_LANES)
+
+    # ref: http://boto3.readthedocs.io/en/latest/reference/services/s3.html#bucket
+    # Create s3 client
+    s3 = boto3.resource('s3', region_name=app_config.AWS_REGION_NAME)
+
+    # ref: http://boto3.readthedocs.io/en/latest/guide/sqs.html
+    # Create sqs client
+    sqs = boto3.resource('sqs', region_name=app_config.AWS_REGION_NAME)
+    queue = sqs.get_queue_by_name(QueueName=app_config.AWS_SQS_JOB_REQUEST_NAME)
+
+    # Looping to retrieve messages from SQS, no more than there are free slots
+    # and JOB_PREFETCH more: the others stay in the queue for this or another
+    # annotator instance. The messages received wait in the lanes of their
+    # role until a slot is free
+    while True:
+        scheduler.reap()
+        room = scheduler.free() + app_config.JOB_PREFETCH - len(lanes)
+        if room <= 0:
+            # not waiting for a slot at once, the lanes need their visibility kept
+            time.sleep(1)
+        else:
+            wait = 5
+            if len(lanes) > 0:
+                wait = 1
+            messages = queue.receive_messages(MaxNumberOfMessages=min(room, 10), WaitTimeSeconds=wait,
+                                              AttributeNames=['SentTimestamp'])
+            for message in messages:
+                data = json.loads(json.loads(message.body)['Message'])
+                sent = time.time()
+                if 'SentTimestamp' in (message.attributes or {}):
+                    sent = int(message.attributes['SentTimestamp']) / 1000.0
+                lanes.put(data.get('role'), {'message': message, 'data': data, 'sent': sent, 'hidden': 0})
+
+        started = False
+        while scheduler.free() > 0 and len(lanes) > 0:
+            lane, job = lanes.get()
+            message = job['message']
+            data = job['data']
+            started = True
+
+            try:
+                bucket = data['s3_inputs_bucket']
+                key = data['s3_key_input_file']
+                file_info = key.split('/')[2]
+                results_bucket = data['s3_results_bucket']
+                user_id = data['user_id']
+                job_id = data['job_id']
+                email = data['email']
+                url = data['url']
+                role = data['role']
+                file_path = app_config.LOCAL_DATA_PREFIX + file_info
+                print('File Path: {}'.format(file_path))
+                print('Key: {}'.format(key))
+
+                status = 'PENDING'
+
+                if app_config.STREAM_INPUT:
+                    # Run the annotator, reading the file from s3 as it annotates
+                    scheduler.submit(job_id, [file_path, user_id, email, url, role, bucket, key])
+                else:
+                    # ref: http://boto3.readthedocs.io/en/latest/reference/services/s3.html#S3.Bucket.download_file
+                    # Download file from s3 bucket
+                    s3.Bucket(bucket).download_file(key, file_path)
+
+                    # Run the annotator
+                    scheduler.submit(job_id, [file_path, user_id, email, url, role])
+
+                status = "RUNNING"
+
+                print(status)
+                # Create dynamodb client
+                dynamodb = boto3.resource('dynamodb', region_name=app_config.AWS_REGION_NAME)
+
+                # Update dynamodb
+                # ref: https://github.com/santoshghimire/boto3-examples/blob/master/dynamodb.py
+                ann_table = dynamodb.Table(app_config.AWS_DYNAMODB_ANNOTATIONS_TABLE)
+                ann_table.update_item(
+                    Key={
+                        'job_id': job_id
+                    },
+                    UpdateExpression="set job_status = :running",
+                    ConditionExpression="job_status = :pending",
+                    ExpressionAttributeValues={
+                        ':pending': 'PENDING',
+                        ':running': status
+                    },
+                    ReturnValues="ALL_NEW"
+                )
+
+                message.delete()
+
+                print('Job submitted successfully')
+
+            except ClientError as e:
+                message.delete()
+                print(e)
+                continue
+
+        if started:
+            print(lanes.summary())
+
+        # keep the messages waiting in the lanes invisible to the other annotators
+        for job in lanes.jobs():
+            if time.time() - job['hidden'] > app_config.JOB_VISIBILITY / 2:
+                try:
+                    job['message'].change_visibility(VisibilityTimeout=app_config.JOB_VISIBILITY)
+                    job['hidden'] = time.time()
+                except ClientError as e:
+                    print(e)
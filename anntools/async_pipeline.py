@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+""" Fused engine with the queries of the stages pipelined on asyncio.
+
+    annotateLines waits for every query before sending the next one, so the
+    process is idle for each round trip to the server. Here the stages await
+    their queries on an AsyncDatabase that keeps up to window of them in
+    flight: with aiomysql each one goes out on a connection of an aiomysql
+    pool, without it (or on the SQLite backend) on a thread of a pool of that
+    many threads, with a connection checked out of sql_config.pool.
+
+    Stages without per-query async lookups (in-memory indexes, merge joins,
+    batched dbSNP, ...) run their lookupBatch on one of those threads, one
+    block at a time per stage. Up to depth blocks are looked up at once and
+    their results are applied and written in input order, so the output is
+    the one of pipeline.annotateLines.
+"""
+
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiomysql
+except ImportError:
+    # the queries then run on threads
+    aiomysql = None
+
+import annotate as ann
+import pipeline
+import sql_config
+import stages as st
+import variant_cache as vc
+
+
+class AsyncDatabase(object):
+    """ Annotation database for the coroutines of the stages, with at most
+        window queries in flight. Gauges of the queries in flight and of their
+        latency are kept and written to count.log (see report()) """
+
+    def __init__(self, window=16):
+        self.window = window
+        self.slots = None
+        self.pool = None
+        self.executor = ThreadPoolExecutor(max_workers=window)
+        self.locks = {}
+        # cursor of the event loop thread, for the metadata queries of the stages
+        self.conn = sql_config.conn2annotator()
+        self.cursor = self.conn.cursor ()
+
+        self.in_flight = 0
+        self.peak = 0
+        self.queries = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    async def open(self):
+        self.slots = asyncio.Semaphore(self.window)
+        if aiomysql is not None and not sql_config.sqlite_db:
+            self.pool = await aiomysql.create_pool(host=sql_config.host, port=sql_config.port,
+                                                   user=sql_config.user, password=sql_config.passwd,
+                                                   db=sql_config.db, minsize=1, maxsize=self.window)
+
+    def threadCall(self, function, args):
+        conn = sql_config.conn2annotator()
+        try:
+            return function(conn.cursor (), *args)
+        finally:
+            conn.close()
+
+    def lock(self, owner):
+        if owner not in self.locks:
+            self.locks[owner] = asyncio.Lock()
+        return self.locks[owner]
+
+    async def measure(self, awaitable):
+        async with self.slots:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            started = time.time()
+            try:
+                return await awaitable
+            finally:
+                elapsed = time.time() - started
+                self.in_flight -= 1
+                self.queries += 1
+                self.latency += elapsed
+                self.max_latency = max(self.max_latency, elapsed)
+
+    async def call(self, function, *args):
+        """ function(cursor, *args) on an executor thread """
+        loop = asyncio.get_running_loop()
+        return await self.measure(loop.run_in_executor(self.executor, self.threadCall, function, args))
+
+    async def poolFetchall(self, sql):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql)
+                return await cursor.fetchall()
+
+    async def fetchall(self, sql):
+        """ Rows of one query """
+        if self.pool is None:
+            return await self.call(lambda cursor: (cursor.execute (sql), cursor.fetchall ())[1])
+        return await self.measure(self.poolFetchall(sql))
+
+    def gauges(self):
+        mean = 0.0
+        if self.queries > 0:
+            mean = self.latency / self.queries
+        return dict(window=self.window, in_flight=self.in_flight, peak=self.peak, queries=self.queries,
+                    mean_latency=mean, max_latency=self.max_latency)
+
+    def summary(self):
+        g = self.gauges()
+        return ('Async queries: ' + str(g['queries']) + ' (window ' + str(g['window']) + ', peak ' + str(g['peak'])
+                + ' in flight), latency mean ' + ('%.1f' % (g['mean_latency'] * 1000)) + ' ms, max '
+                + ('%.1f' % (g['max_latency'] * 1000)) + ' ms')
+
+    def report(self, fh_log):
+        print (self.summary())
+        fh_log.write(self.summary() + '\n')
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+        self.executor.shutdown()
+        self.conn.close()
+
+
+async def lookupBlock(db, stages, variants, cache):
+    """ results[s][v] of a block, the stages looked up concurrently """
+    found = [None] * len(variants)
+    if cache is not None:
+        found = cache.getMany(stages, variants)
+    missing = vc.missingVariants(variants, found)
+    fresh = [[] for stage in stages]
+    if len(missing) > 0:
+        fresh = await asyncio.gather(*[stage.lookupBatchAsync(db, missing) for stage in stages])
+        if cache is not None:
+            cache.putMany(stages, missing, fresh)
+    return vc.mergeResults(stages, found, fresh)
+
+
+async def annotateLinesAsync(lines, fh_out, stages, db, format='vcf', block_size=1000, sep='\t', depth=2, cache=None):
+    inds=ann.getFormatSpecificIndices(format=format)
+    pending = collections.deque()
+    for block in ann.readBlocks(lines, block_size, sep=sep):
+        variants=[st.variantOf(fields, inds) for line, fields in block if fields is not None]
+        pending.append((block, asyncio.ensure_future(lookupBlock(db, stages, variants, cache))))
+        if len(pending) > depth:
+            block, results = pending.popleft()
+            pipeline.applyBlock(block, stages, await results)
+            pipeline.writeBlock(fh_out, block)
+    while len(pending) > 0:
+        block, results = pending.popleft()
+        pipeline.applyBlock(block, stages, await results)
+        pipeline.writeBlock(fh_out, block)
+
+
+async def annotateFile(infile, outfile, stages, window, format, block_size, cache, lines, out):
+    db = AsyncDatabase(window)
+    await db.open()
+    fh = lines
+    if fh is None:
+        fh = open(infile)
+    fh_out = out
+    if fh_out is None:
+        fh_out = open(outfile, "w")
+    try:
+        await annotateLinesAsync(fh, fh_out, stages, db, format=format, block_size=block_size, cache=cache)
+    finally:
+        await db.close()
+        fh.close()
+        fh_out.close()
+    return db
+
+
+""" pipeline.run with up to window queries in flight """
+def run(infile, outfile, stages, window=16, format='vcf', block_size=1000, cache=None, lines=None, out=None):
+    db = asyncio.run(annotateFile(infile, outfile, stages, window, format, block_size, cache, lines, out))
+
+    for stage in stages:
+        stage.close()
+    if cache is not None:
+        cache.close()
+    pipeline.writeLog(infile+'.count.log', stages, cache=cache, reports=[db])
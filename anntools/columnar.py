@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+""" Columnar batches of variants and vectorized position joins (NumPy).
+
+    A VariantBatch holds a block of records as columns: chromosome codes and
+    positions as NumPy arrays, REF and ALT as string arrays. An annotator
+    then joins all the positions of a chromosome against the intervals of a
+    table with a few np.searchsorted calls instead of one lookup per record:
+
+      - the intervals are split in classes of lengths, class k holding
+        those of 2**k - 1 to 2**(k+1) - 2 bases, and sorted by start within
+        their class;
+      - the intervals of a class holding pos are among those starting from
+        pos - longest to pos, longest being the longest of the class (two
+        searchsorted calls), and are picked by end >= pos.
+
+    Those of a class starting at least its shortest length before pos all
+    hold it, so a position scans about twice as many intervals as it hits,
+    plus one search per class: a chromosome-long CNV is scanned only by the
+    positions it holds, not by every position after its start.
+
+    Hits come back in table order, like interval_index.TableIndex, so the
+    first one is what fetchone() returns.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    # only needed by the stages using ColumnarTable
+    np = None
+
+
+class VariantBatch(object):
+    """ Columns of a block of variants """
+
+    def __init__(self, chroms, positions, refs, alts):
+        self.names, codes = np.unique(np.array(chroms, dtype=object), return_inverse=True)
+        self.codes = codes.astype(np.int32)
+        self.positions = np.array([int(p) for p in positions], dtype=np.int64)
+        self.refs = np.array(refs, dtype=object)
+        self.alts = np.array(alts, dtype=object)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def fromVariants(cls, variants):
+        """ from (chrom, pos, ref, alt) tuples, as stages.variantOf gives them """
+        return cls([v[0] for v in variants], [v[1] for v in variants], [v[2] for v in variants],
+                   [v[3] for v in variants])
+
+    def chromosomes(self):
+        """ (chromosome, indices of its variants) of every chromosome of the batch """
+        for code in range(0, len(self.names)):
+            yield (self.names[code], np.nonzero(self.codes == code)[0])
+
+
+class IntervalColumns(object):
+    """ Closed intervals [start, end] of one chromosome, ids in input order """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        lengths = np.maximum(ends - starts, 0)
+        classes = np.floor(np.log2(lengths + 1)).astype(np.int64)
+        # (ids by start, starts, ends, longest length) of every class
+        self.classes = []
+        for k in np.unique(classes):
+            members = np.nonzero(classes == k)[0]
+            ids = members[np.argsort(starts[members], kind='stable')]
+            self.classes.append((ids, starts[ids], ends[ids], int(lengths[ids].max())))
+
+    def join(self, positions):
+        """ (variant, interval id) of every interval holding a position,
+            ordered by variant then id """
+        positions = np.asarray(positions, dtype=np.int64)
+        variants = [np.zeros(0, dtype=np.int64)]
+        hits = [np.zeros(0, dtype=np.int64)]
+        for ids, starts, ends, longest in self.classes:
+            hi = np.searchsorted(starts, positions, 'right')
+            lo = np.searchsorted(starts, positions - longest, 'left')
+            counts = hi - lo
+            variant = np.repeat(np.arange(len(positions)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidate = np.repeat(lo, counts) + offsets
+            keep = ends[candidate] >= positions[variant]
+            variants.append(variant[keep])
+            hits.append(ids[candidate[keep]])
+        variant = np.concatenate(variants)
+        ids = np.concatenate(hits)
+        order = np.lexsort((ids, variant))
+        return (variant[order], ids[order])
+
+
+class ColumnarTable(object):
+    """ Rows of one table, loaded one chromosome at a time into IntervalColumns.
+        sql returns the rows of a chromosome, %s is the chromosome """
+
+    def __init__(self, sql, start='chromStart', end='chromEnd'):
+        self.sql = sql
+        self.start = start
+        self.end = end
+        self.chroms = {}
+
+    def load(self, cursor, chrom):
+        cursor.execute (self.sql % chrom)
+        columns = [str(d[0]) for d in cursor.description]
+        s = columns.index(self.start)
+        e = columns.index(self.end)
+        rows = cursor.fetchall ()
+        return (rows, IntervalColumns([int(row[s]) for row in rows], [int(row[e]) for row in rows]))
+
+    def join(self, cursor, chrom, positions, first=False):
+        """ rows holding each position, in table order (with first, at most one) """
+        if chrom not in self.chroms:
+            self.chroms[chrom] = self.load(cursor, chrom)
+        rows, intervals = self.chroms[chrom]
+        variant, ids = intervals.join(positions)
+        hits = [[] for p in positions]
+        if first:
+            firsts = np.unique(variant, return_index=True)[1]
+            variant = variant[firsts]
+            ids = ids[firsts]
+        for v, i in zip(variant.tolist(), ids.tolist()):
+            hits[v].append(rows[i])
+        return hits
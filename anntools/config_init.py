@@ -44,3 +44,96 @@ class UtilsConfig(object):
         self.FREE_USER_FILE_LIMIT = int(self.config['GASAPP']['FREE_USER_FILE_LIMIT'])
 
         self.LOCAL_DATA_PREFIX = self.config['GASAPP']['LOCAL_DATA_PREFIX']
+
+        # Jobs annotator.py runs at once (0 = one per CPU core)
+        self.JOB_CONCURRENCY = int(self.config['GASAPP'].get('JOB_CONCURRENCY', '0'))
+
+        # Jobs run on pre-warmed executors instead of a run.py process each
+        self.WARM_EXECUTORS = self.config['GASAPP'].getboolean('WARM_EXECUTORS', False)
+
+        # Requests received ahead of the free slots, and the weight of the lane of each role
+        self.JOB_PREFETCH = int(self.config['GASAPP'].get('JOB_PREFETCH', '10'))
+        self.JOB_LANES = [(l.split(':')[0].strip(), float(l.split(':')[1])) for l in
+                          self.config['GASAPP'].get('JOB_LANES', 'premium_user:3, free_user:1').split(',')
+                          if len(l.strip()) > 0]
+        self.JOB_VISIBILITY = int(self.config['GASAPP'].get('JOB_VISIBILITY', '600'))
+
+        # Job input streamed from s3 with concurrent ranged GETs instead of downloaded first
+        self.STREAM_INPUT = self.config['GASAPP'].getboolean('STREAM_INPUT', False)
+        self.INPUT_PART_SIZE = int(self.config['GASAPP'].get('INPUT_PART_SIZE', str(8 * 1024 * 1024)))
+        self.INPUT_CONCURRENCY = int(self.config['GASAPP'].get('INPUT_CONCURRENCY', '4'))
+
+        # Annotated file sent to s3 as a multipart upload while it is written
+        self.STREAM_OUTPUT = self.config['GASAPP'].getboolean('STREAM_OUTPUT', False)
+        self.OUTPUT_PART_SIZE = int(self.config['GASAPP'].get('OUTPUT_PART_SIZE', str(8 * 1024 * 1024)))
+        self.OUTPUT_CONCURRENCY = int(self.config['GASAPP'].get('OUTPUT_CONCURRENCY', '4'))
+
+        # Directory standing in for s3 when streaming (empty = s3)
+        self.LOCAL_S3_DIR = self.config['GASAPP'].get('LOCAL_S3_DIR', '')
+
+        # the settings of the annotator; a utils.cfg predating them runs the
+        # jobs as before, with the defaults below
+        if not self.config.has_section('ANNTOOLS'):
+            self.config.add_section('ANNTOOLS')
+
+        # staged = one annotate.py function per pass, fused = all annotators in one pass
+        self.ENGINE = self.config['ANNTOOLS'].get('ENGINE', 'staged')
+
+        # Number of variants resolved per dbSNP query (0 = one query per variant)
+        self.DBSNP_BATCH_SIZE = int(self.config['ANNTOOLS'].get('DBSNP_BATCH_SIZE', '0'))
+
+        # Overlap tables answered from an in-memory interval index (fused engine)
+        self.INDEXED_TABLES = [t.strip() for t in self.config['ANNTOOLS'].get('INDEXED_TABLES', '').split(',') if len(t.strip()) > 0]
+
+        # Merge join coordinate-sorted input with the overlap tables (fused engine)
+        self.MERGE_JOIN = self.config['ANNTOOLS'].getboolean('MERGE_JOIN', False)
+
+        # Local SQLite annotation database instead of MySQL (empty = MySQL)
+        self.SQLITE_DB = self.config['ANNTOOLS'].get('SQLITE_DB', '')
+
+        # Maximum number of open annotation database connections per process
+        self.POOL_SIZE = int(self.config['ANNTOOLS'].get('POOL_SIZE', '16'))
+
+        # Worker processes doing the lookups of the fused engine (0 = in the main process)
+        self.WORKERS = int(self.config['ANNTOOLS'].get('WORKERS', '0'))
+
+        # Parts of the input annotated in parallel (0 = no sharding)
+        self.SHARDS = int(self.config['ANNTOOLS'].get('SHARDS', '0'))
+        self.SHARD_BY_CHROM = self.config['ANNTOOLS'].getboolean('SHARD_BY_CHROM', False)
+
+        # Cache of the variant lookups shared by all jobs (empty = no cache)
+        self.CACHE_PATH = self.config['ANNTOOLS'].get('CACHE_PATH', '')
+        self.CACHE_VERSION = self.config['ANNTOOLS'].get('CACHE_VERSION', '')
+        self.CACHE_SIZE = int(self.config['ANNTOOLS'].get('CACHE_SIZE', '5000000'))
+
+        # Restrict the range queries to the UCSC bins of the position
+        self.USE_BIN = self.config['ANNTOOLS'].getboolean('USE_BIN', False)
+
+        # Answer getGenes from refGene loaded in memory (fused engine)
+        self.GENE_MODELS = self.config['ANNTOOLS'].getboolean('GENE_MODELS', False)
+
+        # Resolve the three bigRefGene tables for a block of variants in one query
+        self.BIGREFGENE_BATCHED = self.config['ANNTOOLS'].getboolean('BIGREFGENE_BATCHED', False)
+
+        # Overlap tables joined with whole blocks of variants at once (needs NumPy)
+        self.COLUMNAR_TABLES = [t.strip() for t in self.config['ANNTOOLS'].get('COLUMNAR_TABLES', '').split(',')
+                                if len(t.strip()) > 0]
+
+        # Bloom filter of the dbSNP positions built by dbsnp_bloom.py (empty = query every variant)
+        self.DBSNP_BLOOM = self.config['ANNTOOLS'].get('DBSNP_BLOOM', '')
+
+        # Directory of the table snapshots exported by snapshot.py (empty = none)
+        self.SNAPSHOT_DIR = self.config['ANNTOOLS'].get('SNAPSHOT_DIR', '')
+
+        # Queries kept in flight by the fused engine without WORKERS (0 = one at a time)
+        self.ASYNC_WINDOW = int(self.config['ANNTOOLS'].get('ASYNC_WINDOW', '0'))
+
+        # Threads doing the lookups of each annotator of the staged engine (0 = none)
+        self.LOOKUP_THREADS = int(self.config['ANNTOOLS'].get('LOOKUP_THREADS', '0'))
+
+        # Per-variant queries sent in one round trip by the fused engine (0 = one per round trip)
+        self.MULTI_STATEMENTS = int(self.config['ANNTOOLS'].get('MULTI_STATEMENTS', '0'))
+
+        # Lookup strategy of the fused overlap stages chosen per chromosome, and the round trip it assumes
+        self.ADAPTIVE_PLAN = self.config['ANNTOOLS'].getboolean('ADAPTIVE_PLAN', False)
+        self.PLAN_QUERY_MS = float(self.config['ANNTOOLS'].get('PLAN_QUERY_MS', '1.0'))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+""" Bloom filter of the (CHR, POS) pairs of the dbSNP table.
+
+    Most variants of a sample are either in dbSNP or novel, and every novel
+    one costs a query returning nothing. The filter answers "certainly not in
+    dbSNP" for most of them without a round trip: a position that was never
+    added always has one of its bits clear, while a position of the table
+    always has all of them set. A false positive only means a query that
+    returns no rows, as without the filter.
+
+    Both getSnpsFromDbSnp and getIndelsFromDbSnp select by CHR and POS, so one
+    filter serves both. Chromosomes are upper-cased, as MySQL compares them
+    case-insensitively.
+
+    The file is a small header followed by the bit array; it is memory-mapped
+    read-only, so every worker of a host shares the same pages. Build it with:
+
+        python dbsnp_bloom.py build dbsnp.bloom --fp-rate 0.01
+
+    and rebuild it whenever dbSNP is reloaded: positions added to the table
+    afterwards would be skipped.
+"""
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+import sql_config
+
+
+MAGIC = b'ANNBLOOM'
+VERSION = 1
+# magic, version, number of bits, number of hashes, number of keys added
+HEADER = struct.Struct('<8sIQIQ')
+
+
+def key(chr, pos):
+    return (str(chr).upper() + ':' + str(int(pos))).encode('utf-8')
+
+
+def bitPositions(k, bits, hashes):
+    """ Bits of a key, by double hashing one 128-bit digest """
+    digest = hashlib.blake2b(k, digest_size=16).digest()
+    h1 = int.from_bytes(digest[0:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(0, hashes)]
+
+
+def optimalSize(keys, fp_rate):
+    """ Number of bits and of hashes giving fp_rate false positives for keys keys """
+    keys = max(int(keys), 1)
+    bits = int(math.ceil(-keys * math.log(fp_rate) / (math.log(2) ** 2)))
+    bits = max(bits, 64)
+    hashes = max(int(round(float(bits) / keys * math.log(2))), 1)
+    return (bits, hashes)
+
+
+class BloomFilter(object):
+    """ Read-only, memory-mapped filter written by build() """
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.bits, self.hashes, self.keys = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(path + ' is not a dbSNP Bloom filter')
+        self.checked = 0
+        self.skipped = 0
+
+    def __getstate__(self):
+        # mmaps do not pickle, reopen in the other process
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def mightContain(self, chr, pos):
+        """ False when the table certainly has no row at chr:pos """
+        try:
+            k = key(chr, pos)
+        except ValueError:
+            # not a position, let the query decide
+            return True
+        self.checked += 1
+        for bit in bitPositions(k, self.bits, self.hashes):
+            if not self.map[HEADER.size + (bit >> 3)] & (1 << (bit & 7)):
+                self.skipped += 1
+                return False
+        return True
+
+    def fpRate(self):
+        """ Expected false positive rate for the number of keys added """
+        return (1.0 - math.exp(-float(self.hashes) * self.keys / self.bits)) ** self.hashes
+
+    def summary(self):
+        return ('dbSNP Bloom filter: ' + str(self.skipped) + ' of ' + str(self.checked) + ' queries avoided'
+                + ' (expected false positive rate ' + ('%.4f' % self.fpRate()) + ')')
+
+    def close(self):
+        self.map.close()
+        self.fh.close()
+
+
+""" Writes the filter of every (CHR, POS) of table to path. keys sizes the
+    filter (default: the number of rows of the table) """
+def build(conn, path, fp_rate=0.01, keys=None, table='dbSNP'):
+    cursor = conn.cursor ()
+    if keys is None:
+        cursor.execute ('select count(*) from ' + table + ';')
+        keys = int(cursor.fetchone ()[0])
+    cursor.close()
+    bits, hashes = optimalSize(keys, fp_rate)
+    array = bytearray((bits + 7) >> 3)
+
+    cursor = sql_config.streamCursor(conn)
+    cursor.execute ('select CHR, POS from ' + table + ';')
+    added = 0
+    while True:
+        rows = cursor.fetchmany (10000)
+        if len(rows) == 0:
+            break
+        for chr, pos in rows:
+            for bit in bitPositions(key(chr, pos), bits, hashes):
+                array[bit >> 3] |= 1 << (bit & 7)
+            added += 1
+    cursor.close()
+
+    # written aside and renamed, so running jobs keep their complete filter
+    tmp = path + '.tmp' + str(os.getpid())
+    fh = open(tmp, 'wb')
+    fh.write(HEADER.pack(MAGIC, VERSION, bits, hashes, added))
+    fh.write(array)
+    fh.close()
+    os.rename(tmp, path)
+    print ("Added " + str(added) + " rows of " + table + " to " + path + " (" + str(bits >> 3) + " bytes, "
+           + str(hashes) + " hashes)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bloom filter of the dbSNP positions')
+    commands = parser.add_subparsers(dest='command')
+    builder = commands.add_parser('build', help='build the filter from the dbSNP table')
+    builder.add_argument('path')
+    builder.add_argument('--fp-rate', type=float, default=0.01,
+                         help='false positive rate, lower takes more bits per position')
+    builder.add_argument('--keys', type=int, default=None,
+                         help='positions to size the filter for (default: rows of the table)')
+    builder.add_argument('--table', default='dbSNP')
+    stats = commands.add_parser('stats', help='size and expected false positive rate of a filter')
+    stats.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        conn = sql_config.connect()
+        build(conn, args.path, fp_rate=args.fp_rate, keys=args.keys, table=args.table)
+        conn.close()
+    elif args.command == 'stats':
+        bloom = BloomFilter(args.path)
+        print (str(bloom.keys) + ' positions, ' + str(bloom.bits >> 3) + ' bytes, ' + str(bloom.hashes)
+               + ' hashes, expected false positive rate ' + ('%.4f' % bloom.fpRate()))
+        bloom.close()
+    else:
+        parser.print_help()
@@ -32,82 +32,212 @@
 #
 ################################################################################
 
+import collections
 import sys
 import os
 import file_utils as fu
 import annotate as ann
+import lookup_executor
+import async_pipeline
+from dbsnp_bloom import BloomFilter
+import pipeline
+import planner
+import shard
+import sql_config
+import stages as st
+import variant_cache
 
-def run(infile, format):
+ENGINES = ['staged', 'fused']
+
+# option -> (default, engines using it, option it refines: in use only with
+# that one in use too). Left at its default, an option is not in use
+OPTIONS = collections.OrderedDict([
+    # variants resolved per dbSNP query (0 = one query per variant)
+    ('dbsnp_batch_size', (0, ENGINES, None)),
+    # path of a dbsnp_bloom.py filter: the dbSNP queries of the positions
+    # not in dbSNP are skipped
+    ('dbsnp_bloom', ('', ENGINES, None)),
+    # threads doing the lookups of every annotate.py function (see lookup_executor.py)
+    ('lookup_threads', (0, ['staged'], None)),
+    # overlap tables answered from memory (see interval_index.py)
+    ('indexed_tables', ((), ['fused'], None)),
+    # coordinate-sorted input joined with the overlap tables (see sweep.py)
+    ('merge_join', (False, ['fused'], None)),
+    # getGenes answered from refGene loaded in memory (see gene_models.py)
+    ('gene_models', (False, ['fused'], None)),
+    # the three bigRefGene tables resolved for a whole block in one query
+    ('bigrefgene_batched', (False, ['fused'], None)),
+    # overlap tables joined with whole blocks at once (see columnar.py)
+    ('columnar_tables', ((), ['fused'], None)),
+    # directory of the overlap table snapshots read instead of the tables (see snapshot.py)
+    ('snapshot_dir', ('', ['fused'], None)),
+    # per-variant queries sent in one round trip (see sql_config.fetchSets)
+    ('multi_statements', (0, ['fused'], None)),
+    # lookups of the overlap stages chosen per chromosome from the number of
+    # variants of the input and plan_query_ms, the cost of a round trip (see planner.py)
+    ('adaptive_plan', (False, ['fused'], None)),
+    ('plan_query_ms', (1.0, ['fused'], 'adaptive_plan')),
+    # processes doing the lookups (see pipeline.py)
+    ('workers', (0, ['fused'], None)),
+    # parts of the input annotated in parallel (see shard.py)
+    ('shards', (0, ['fused'], None)),
+    ('shard_by_chrom', (False, ['fused'], 'shards')),
+    # queries kept in flight, their gauges written to count.log (see
+    # async_pipeline.py); ignored with workers or shards, and says so
+    ('async_window', (0, ['fused'], None)),
+    # cache of the lookups of earlier jobs (see variant_cache.py)
+    ('cache_path', ('', ['fused'], None)),
+    ('cache_version', ('', ['fused'], 'cache_path')),
+    ('cache_size', (1000000, ['fused'], 'cache_path')),
+])
+
+
+class Options(object):
+    """ Engine of run() and its options, as attributes: engine='staged'
+        chains the annotate.py functions through temp files, engine='fused'
+        annotates every record in one pass (see pipeline.py). An option in
+        use that the engine does not take raises ValueError instead of being
+        ignored """
+
+    def __init__(self, engine='staged', **options):
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine ' + str(engine) + ', not one of ' + ', '.join(ENGINES))
+        for name in options:
+            if name not in OPTIONS:
+                raise TypeError('Unknown option ' + name)
+        self.engine = engine
+        for name, (default, engines, refines) in OPTIONS.items():
+            value = options.get(name, default)
+            if isinstance(default, tuple):
+                value = tuple(value)
+            setattr(self, name, value)
+        for name in self.inUse():
+            if engine not in OPTIONS[name][1]:
+                raise ValueError(name + ' is not supported by the ' + engine + ' engine')
+
+    def inUse(self):
+        """ Options set to something else than their default """
+        names = []
+        for name, (default, engines, refines) in OPTIONS.items():
+            if getattr(self, name) != default and (refines is None or refines in names):
+                names.append(name)
+        return names
+
+
+""" Annotates infile with the engine and options of options (an Options,
+    default: the staged engine alone).
+    lines, an open input such as s3_stream.openObject, is annotated instead
+    of the file infile, which still names the outputs; the fused engine
+    reads it as it comes, the others once it is written to infile. out, an
+    open output such as s3_stream.MultipartUpload.open(), receives the
+    annotated lines instead of the file annotatedName(infile): as they are
+    annotated with the fused engine, once the file is written with the
+    others; it is closed at the end """
+def run(infile, format, options=None, lines=None, out=None):
+    if options is None:
+        options = Options()
+    fused = options.engine == 'fused'
+
+    if lines is not None and (not fused or options.shards > 1 or options.adaptive_plan):
+        # these read the input more than once
+        spool(lines, infile)
+        lines = None
+
+    spooled = None
+    if out is not None and (not fused or options.shards > 1):
+        # these write the output file
+        spooled, out = out, None
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', tmpextout='.1' )
+    if fused:
+        runFused(infile, format, options, lines=lines, out=out)
+    else:
+        runStaged(infile, format, options)
+
+    if spooled is not None:
+        spool(open(annotatedName(infile)), spooled)
+
+
+def runStaged(infile, format, options):
+    annotator = lambda function: function
+    if options.lookup_threads > 0:
+        annotator = lambda function: lookup_executor.threaded(function, threads=options.lookup_threads)
+
+    bloom = None
+    if options.dbsnp_bloom:
+        bloom = BloomFilter(options.dbsnp_bloom)
+    annotator(ann.getSnpsFromDbSnp)(vcf=infile, format='vcf', tmpextin='', tmpextout='.1',
+                         batch_size=options.dbsnp_batch_size, bloom=bloom)
+    if bloom is not None:
+        print(bloom.summary())
+        bloom.close()
     #print("Done dbSNP")
     # Set numbering
     tmpextin=1
     tmpextout=2
 
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.getBigRefGene)(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("Done BigRefGene ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.getGenes)(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("Done RefGene")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithCytoband)(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("cytoband ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithGadAll)(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("gadAll ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithGwasCatalog)(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("GwasCatalog ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithMiRNA)(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("miRNA")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWitHUGOGeneNomenclature)(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("HUGO Gene Nomenclature Committee (HGNC) ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithCnvDatabase)(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("dgv_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithCnvDatabase)(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("abParts_IG_T_CelReceptors")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithCnvDatabase)(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("mcCarroll_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithCnvDatabase)(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("conrad_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithGenomicSuperDups)(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("genomicSuperDups")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    annotator(ann.addOverlapWithTfbsConsSites)(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
     #print("addOverlapWithTfbsConsSites")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
@@ -117,5 +247,54 @@ def run(infile, format):
         fu.delete(infile+'.'+ str(i))
 
     os.rename(infile+'.'+str(tmpextin), infile+'.annot')
-    finalout=(infile+'.annot').replace('.vcf.annot', '.annot.vcf')
+    finalout=annotatedName(infile)
     os.rename(infile+'.annot', finalout)
+
+
+""" Writes the open input lines to fh_out, an open output or the path of
+    a file, and closes both """
+def spool(lines, fh_out):
+    if isinstance(fh_out, str):
+        fh_out = open(fh_out, "w")
+    for line in lines:
+        fh_out.write(line)
+    fh_out.close()
+    lines.close()
+
+
+""" sample.vcf -> sample.annot.vcf """
+def annotatedName(infile):
+    return (infile+'.annot').replace('.vcf.annot', '.annot.vcf')
+
+
+def runFused(infile, format, options, lines=None, out=None):
+    block_size=1000
+    if options.dbsnp_batch_size > 0:
+        block_size=options.dbsnp_batch_size
+
+    # of the stages, given to the worker processes to build theirs
+    stage_options=dict(dbsnp_batched=options.dbsnp_batch_size > 0, indexed_tables=options.indexed_tables,
+                       merge_join=options.merge_join, gene_models=options.gene_models,
+                       bigrefgene_batched=options.bigrefgene_batched, columnar_tables=options.columnar_tables,
+                       dbsnp_bloom=options.dbsnp_bloom, snapshot_dir=options.snapshot_dir,
+                       multi_statements=options.multi_statements)
+    if options.adaptive_plan:
+        stage_options['plan']=dict(counts=planner.countVariants(infile, format=format),
+                                   query_ms=options.plan_query_ms)
+    stages=st.driverStages(**stage_options)
+    cache=None
+    if options.cache_path:
+        cache=variant_cache.VariantCache(options.cache_path, version=options.cache_version,
+                                         max_entries=options.cache_size)
+    if options.async_window > 0 and (options.workers > 0 or options.shards > 1):
+        print ("Async lookups disabled: ASYNC_WINDOW does not apply with WORKERS or SHARDS")
+    if options.shards > 1:
+        shard.run(infile, annotatedName(infile), stages, stage_options, options.shards,
+                  by_chrom=options.shard_by_chrom, format=format, block_size=block_size, cache=cache)
+        return
+    if options.async_window > 0 and options.workers == 0:
+        async_pipeline.run(infile, annotatedName(infile), stages, window=options.async_window, format=format,
+                           block_size=block_size, cache=cache, lines=lines, out=out)
+        return
+    pipeline.run(infile, annotatedName(infile), stages, format=format, block_size=block_size,
+                 workers=options.workers, options=stage_options, cache=cache, lines=lines, out=out)
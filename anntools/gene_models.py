@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+""" Gene model cache for the getGenes / getExonsEtAl stages.
+
+    refGene is loaded once per chromosome; the exonStarts/exonEnds blobs of
+    every transcript are decoded once into arrays, so the exons holding a
+    position are found by bisection instead of splitting and walking the
+    blobs for every variant. The transcripts overlapping a position (with the
+    promoter offset) come from an IntervalIndex, in table order like
+    interval_index.TableIndex.
+"""
+
+import bisect
+from array import array
+
+from interval_index import IntervalIndex
+
+
+def decodeList(blob, count):
+    if isinstance(blob, bytes):
+        blob = blob.decode("utf-8")
+    return array('l', [int(x) for x in str(blob).split(',')[0:count]])
+
+
+class Transcript(tuple):
+    """ refGene row with its coordinates and exons decoded """
+
+    def __new__(cls, row):
+        self = tuple.__new__(cls, row)
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        count = int(row[8])
+        self.exonStarts = decodeList(row[9], count)
+        self.exonEnds = decodeList(row[10], count)
+        # exons never overlap in refGene, but the linear walk is kept for rows where they would
+        self.ordered = list(self.exonStarts) == sorted(self.exonStarts) and list(self.exonEnds) == sorted(self.exonEnds)
+        return self
+
+    def exonHits(self, pos):
+        """ 0-based numbers of the exons holding pos, in exon order """
+        if self.ordered == False:
+            return [e for e in range(0, len(self.exonStarts)) if self.exonStarts[e] <= pos <= self.exonEnds[e]]
+        hits = []
+        e = bisect.bisect_right(self.exonStarts, pos) - 1
+        while e >= 0 and self.exonEnds[e] >= pos:
+            hits.append(e)
+            e = e - 1
+        hits.reverse()
+        return hits
+
+
+class GeneModels(object):
+    """ Transcripts of a refGene-like table, loaded one chromosome at a time """
+
+    def __init__(self, table='refGene', promoter_offset=500):
+        self.sql = 'select * from ' + table + ' where chrom="%s";'
+        self.promoter_offset = int(promoter_offset)
+        self.chroms = {}
+
+    def load(self, cursor, chrom):
+        cursor.execute (self.sql % chrom)
+        transcripts = [Transcript(row) for row in cursor.fetchall ()]
+        return IntervalIndex([(t.txStart - self.promoter_offset, t.txEnd + self.promoter_offset, t)
+                              for t in transcripts])
+
+    def query(self, cursor, chrom, pos):
+        """ Transcripts with txStart - offset <= pos <= txEnd + offset """
+        if chrom not in self.chroms:
+            self.chroms[chrom] = self.load(cursor, chrom)
+        return self.chroms[chrom].query(int(pos))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+""" In-memory interval index for the range-overlap annotators.
+
+    A table is loaded once per chromosome into a nested containment list
+    (Alekseyenko & Lee, 2007): intervals sorted by start, each one holding the
+    intervals it contains. Siblings never contain each other, so their ends
+    are sorted too and a point query is a bisection plus a walk over the hits
+    of every level, O(log n + k).
+
+    Hits are returned in the order the table returned the rows of the
+    chromosome, which is the order the per-variant SQL query returns them in
+    (and its first row is what fetchone() gets).
+"""
+
+import bisect
+
+
+class IntervalIndex(object):
+    """ Static index of closed intervals [start, end] """
+
+    def __init__(self, intervals):
+        """ intervals: list of (start, end, item); item order is the result order """
+        self.items = [item for start, end, item in intervals]
+        order = sorted(range(0, len(intervals)), key=lambda i: (intervals[i][0], -intervals[i][1], i))
+
+        # every sublist is [starts, ends, item ids, child sublists]
+        self.sublists = [[[], [], [], []]]
+        stack = []
+        for i in order:
+            start, end = intervals[i][0], intervals[i][1]
+            while len(stack) > 0 and stack[-1][0] < end:
+                stack.pop()
+            parent = 0
+            if len(stack) > 0:
+                parent = stack[-1][1]
+            sub = self.sublists[parent]
+            sub[0].append(start)
+            sub[1].append(end)
+            sub[2].append(i)
+            sub[3].append(None)
+
+            self.sublists.append([[], [], [], []])
+            child = len(self.sublists) - 1
+            sub[3][-1] = child
+            stack.append((end, child))
+
+    def __len__(self):
+        return len(self.items)
+
+    def ids(self, pos):
+        """ ids of the intervals holding pos, in no particular order """
+        found = []
+        todo = [0]
+        while len(todo) > 0:
+            starts, ends, ids, children = self.sublists[todo.pop()]
+            i = bisect.bisect_left(ends, pos)
+            while i < len(starts) and starts[i] <= pos:
+                found.append(ids[i])
+                if len(self.sublists[children[i]][0]) > 0:
+                    todo.append(children[i])
+                i = i + 1
+        return found
+
+    def query(self, pos):
+        """ items holding pos, in input order """
+        return [self.items[i] for i in sorted(self.ids(pos))]
+
+    def first(self, pos):
+        """ first item holding pos in input order, or None """
+        ids = self.ids(pos)
+        if len(ids) == 0:
+            return None
+        return self.items[min(ids)]
+
+
+class TableIndex(object):
+    """ Rows of one table, loaded one chromosome at a time into IntervalIndex.
+
+        sql is the query returning the rows of a chromosome, with %s for the
+        chromosome; start and end name the columns of the interval.
+    """
+
+    def __init__(self, sql, start='chromStart', end='chromEnd'):
+        self.sql = sql
+        self.start = start
+        self.end = end
+        self.chroms = {}
+
+    def load(self, cursor, chrom):
+        cursor.execute (self.sql % chrom)
+        columns = [str(d[0]) for d in cursor.description]
+        s = columns.index(self.start)
+        e = columns.index(self.end)
+        rows = cursor.fetchall ()
+        return IntervalIndex([(int(row[s]), int(row[e]), row) for row in rows])
+
+    def index(self, cursor, chrom):
+        if chrom not in self.chroms:
+            self.chroms[chrom] = self.load(cursor, chrom)
+        return self.chroms[chrom]
+
+    def query(self, cursor, chrom, pos):
+        return self.index(cursor, chrom).query(int(pos))
+
+    def first(self, cursor, chrom, pos):
+        return self.index(cursor, chrom).first(int(pos))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+""" Pre-warmed executors for the jobs of annotator.py.
+
+    Starting run.py for a job costs an interpreter, the imports of boto3,
+    pymysql and the annotation modules, and the reading of config.txt and
+    utils.cfg; for a small input that is most of the job. An ExecutorPool
+    pays it once per executor instead: the executors are forked from a
+    forkserver that has imported run.py already, read the configuration once
+    and then run the jobs sent to them over a pipe, one at a time, with
+    run.runJob, keeping their boto3 resources and database connections.
+
+    A job that raises is reported with exit code 1 and the executor goes on
+    with the next one; an executor that dies is replaced. An executor that
+    dies before it is ready (its configuration could not be read, ...) is
+    tried again at the next poll(), the pool running short meanwhile.
+
+    The startup avoided is that of a cold run.py, timed once when the pool
+    starts (see coldStartup); every job reports it against the time its
+    descriptor took to reach the executor.
+"""
+
+import multiprocessing
+from multiprocessing.connection import wait
+import subprocess
+import sys
+import time
+import traceback
+
+
+# imported by the forkserver, so every executor starts with them loaded
+PRELOAD = ['run', 'config_init', 'driver', 'annotate', 'sql_config', 'boto3']
+
+
+""" Seconds a new interpreter takes to import run.py and read the configuration """
+def coldStartup():
+    started = time.time()
+    subprocess.call([sys.executable, '-c', 'import run, config_init; config_init.UtilsConfig()'])
+    return time.time() - started
+
+
+""" Body of an executor: configures run.py once, then runs the jobs received
+    on conn until it is closed or sent None """
+def serve(conn, services):
+    import config_init
+    import run
+    run.configure(config_init.UtilsConfig())
+    for service in services:
+        run.__resource__(service, run.app_config.AWS_REGION_NAME)
+    conn.send(('ready',))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job_id, args, sent = job
+        started = time.time()
+        code = 0
+        try:
+            run.runJob(args)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.send(('done', job_id, code, started - sent, time.time() - started))
+
+
+class ExecutorPool(object):
+    """ size executors, each running one job at a time """
+
+    def __init__(self, size, preload=PRELOAD, services=('s3', 'sns')):
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(list(preload))
+        self.services = list(services)
+        self.cold = coldStartup()
+        print('Cold run.py startup: {:.3f} seconds'.format(self.cold))
+        self.size = size
+        # pid -> [process, connection, job id or None]
+        self.executors = {}
+        self.refill()
+        if len(self.executors) == 0:
+            raise RuntimeError('No executor could start, see their tracebacks above')
+        self.jobs = 0
+        self.dispatch = 0.0
+
+    def start(self):
+        """ Starts an executor; False if it died before being ready """
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=serve, args=(child, self.services))
+        process.start()
+        child.close()
+        try:
+            parent.recv()
+        except EOFError:
+            process.join()
+            parent.close()
+            print('Executor {} exited with code {} before being ready'.format(process.pid, process.exitcode))
+            return False
+        self.executors[process.pid] = [process, parent, None]
+        return True
+
+    def refill(self):
+        """ Starts executors up to size, until one fails """
+        while len(self.executors) < self.size and self.start():
+            pass
+
+    def idle(self):
+        return len([e for e in self.executors.values() if e[2] is None])
+
+    def submit(self, job_id, args):
+        """ Sends the job to an idle executor and returns the pid of the executor """
+        for pid, executor in self.executors.items():
+            if executor[2] is None:
+                executor[1].send((job_id, args, time.time()))
+                executor[2] = job_id
+                return pid
+        raise RuntimeError('No idle executor for job ' + str(job_id))
+
+    def poll(self, timeout=0):
+        """ (pid, job id, exit code) of the jobs finished since the last call """
+        busy = dict([(e[1], pid) for pid, e in self.executors.items() if e[2] is not None])
+        finished = []
+        for conn in wait(list(busy.keys()), timeout):
+            pid = busy[conn]
+            process, conn, job_id = self.executors[pid]
+            try:
+                message = conn.recv()
+            except EOFError:
+                # the executor died with the job
+                process.join()
+                del self.executors[pid]
+                finished.append((pid, job_id, process.exitcode))
+                continue
+            _, job_id, code, dispatch, seconds = message
+            self.executors[pid][2] = None
+            self.jobs += 1
+            self.dispatch += dispatch
+            print('Job {} ran in a warm executor: dispatched in {:.1f} ms, {:.3f} seconds of startup saved'.format(
+                  job_id, dispatch * 1000, self.cold - dispatch))
+            print(self.summary())
+            finished.append((pid, job_id, code))
+        self.refill()
+        return finished
+
+    def summary(self):
+        saved = self.jobs * self.cold - self.dispatch
+        return ('Warm executors: ' + str(self.jobs) + ' jobs, ' + ('%.3f' % saved) + ' seconds of startup saved ('
+                + ('%.3f' % self.cold) + ' s cold start per job)')
+
+    def close(self):
+        for process, conn, job_id in self.executors.values():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process, conn, job_id in self.executors.values():
+            process.join()
+        self.executors = {}
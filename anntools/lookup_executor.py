@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+""" Thread-pool execution of the annotate.py functions.
+
+    threaded(ann.addOverlapWithCytoband, threads=8) is called like
+    ann.addOverlapWithCytoband and writes the same output file and count.log
+    section, but the lookups of the variants are spread over a bounded pool of
+    threads, each one with its own connection to the annotation database and
+    its own instance of the stages.py stage reproducing the function, so no
+    state of a stage is shared between threads. The lookup of a line is that
+    of the stage; the lines are annotated and counted by the caller's stage;
+    lines are held in a reorder buffer until every line before them is done,
+    so they are written in input order.
+
+    At most window lines are in flight; a line whose lookup is slow holds
+    back the writing of the next ones, not their lookups.
+"""
+
+import collections
+import functools
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+import pipeline
+import sql_config
+import stages as st
+
+
+def stageClasses(cls=st.Stage):
+    for sub in cls.__subclasses__():
+        yield sub
+        for subsub in stageClasses(sub):
+            yield subsub
+
+
+""" The stage reproducing the annotate.py function name, built from the
+    arguments of the call it shares with the stage (table, varclass, ...) """
+def stageFor(name, arguments):
+    for cls in stageClasses():
+        if cls.__dict__.get('function') == name:
+            params = inspect.signature(cls.__init__).parameters
+            return cls(**dict([(k, v) for k, v in arguments.items() if k in params and k != 'self']))
+    raise ValueError('No stage reproduces ' + str(name))
+
+
+class LookupExecutor(object):
+    """ Bounded thread pool with one database connection per thread, and
+        one stage per thread when stage_factory is given """
+
+    def __init__(self, threads=8, window=None, stage_factory=None):
+        self.threads = threads
+        self.window = window
+        self.stage_factory = stage_factory
+        if self.window is None:
+            self.window = threads * 64
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.executor = ThreadPoolExecutor(max_workers=threads, initializer=self.connect)
+
+    def connect(self):
+        conn = sql_config.connect()
+        self.local.cursor = conn.cursor ()
+        self.local.stage = None
+        if self.stage_factory is not None:
+            self.local.stage = self.stage_factory()
+        with self.lock:
+            self.connections.append(conn)
+
+    def lookup(self, stage, variant):
+        if self.local.stage is not None:
+            stage = self.local.stage
+        return stage.lookup(self.local.cursor, variant)
+
+    def annotate(self, lines, fh_out, stage, format='vcf', sep='\t'):
+        """ Writes the lines annotated by stage to fh_out, in input order """
+        inds = ann.getFormatSpecificIndices(format=format)
+        pending = collections.deque()
+        for line in lines:
+            line = line.strip()
+            if line.startswith("#"):
+                pending.append((line, None, None))
+            else:
+                fields = line.split(sep)
+                pending.append((line, fields, self.executor.submit(self.lookup, stage, st.variantOf(fields, inds))))
+            while len(pending) > 0 and (len(pending) > self.window or pending[0][2] is None or pending[0][2].done()):
+                self.write(fh_out, stage, *pending.popleft())
+        while len(pending) > 0:
+            self.write(fh_out, stage, *pending.popleft())
+
+    def write(self, fh_out, stage, line, fields, future):
+        block = [(line, fields)]
+        if fields is not None:
+            pipeline.applyBlock(block, [stage], [[future.result()]])
+        pipeline.writeBlock(fh_out, block)
+
+    def close(self):
+        self.executor.shutdown()
+        for conn in self.connections:
+            conn.close()
+
+
+""" function, an annotate.py annotator, with its lookups on threads threads """
+def threaded(function, threads=8, window=None):
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        call = inspect.signature(function).bind(*args, **kwargs)
+        call.apply_defaults()
+        arguments = call.arguments
+        stage = stageFor(function.__name__, arguments)
+
+        basefile = arguments['vcf']
+        fh = open(basefile + arguments.get('tmpextin', ''))
+        fh_out = open(basefile + arguments['tmpextout'], "w")
+        executor = LookupExecutor(threads=threads, window=window,
+                                  stage_factory=lambda: stageFor(function.__name__, arguments))
+        try:
+            executor.annotate(fh, fh_out, stage, format=arguments.get('format', 'vcf'),
+                              sep=arguments.get('sep', '\t'))
+        finally:
+            executor.close()
+            fh.close()
+            fh_out.close()
+
+        if stage.log_mode is not None:
+            fh_log = open(basefile + '.count.log', stage.log_mode)
+            stage.report(fh_log)
+            fh_log.close()
+
+    return run
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+""" Fused annotation engine.
+
+    Runs every stage of stages.py over each record in one pass: the input is
+    parsed once, lookups are done a block of records at a time and the final
+    .annot.vcf is written directly, instead of one temp file per annotator.
+    The output is byte for byte the one of the annotate.py functions chained
+    by driver.run.
+
+    With workers > 0 the lookups of the stages are spread over worker
+    processes, each one owning a fixed group of stages (and their indexes,
+    merge joins and connection). The main process reads the blocks, sends
+    each one to every worker and applies the results in pipeline order, so
+    the output does not depend on the number of workers.
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import annotate as ann
+import sql_config
+import stages as st
+import variant_cache as vc
+
+
+""" Annotates a block of (line, fields) records in place.
+    results[s][v] is the lookup of stage s for the v-th variant of the block """
+def applyBlock(block, stages, results):
+    v=0
+    for line, fields in block:
+        if fields is None:
+            continue
+        for s in range(0, len(stages)):
+            stages[s].apply(fields, results[s][v])
+            # every annotate.py function strips the line it reads back
+            if len(fields) == 8:
+                fields[7] = fields[7].rstrip()
+        v=v+1
+
+
+def writeBlock(fh_out, block):
+    for line, fields in block:
+        if fields is None:
+            fh_out.write(line+'\n')
+        else:
+            fh_out.write('\t'.join(fields)+'\n')
+
+
+""" Streams lines through all stages and writes the annotated lines to fh_out.
+    With a VariantCache, only the variants missing from it are looked up """
+def annotateLines(lines, fh_out, stages, cursor, format='vcf', block_size=1000, sep='\t', cache=None):
+    inds=ann.getFormatSpecificIndices(format=format)
+    lookup=lambda variants: [stage.lookupBatch(cursor, variants) for stage in stages]
+    for block in ann.readBlocks(lines, block_size, sep=sep):
+        variants=[st.variantOf(fields, inds) for line, fields in block if fields is not None]
+        results=vc.cachedLookups(cache, stages, variants, lookup)
+        applyBlock(block, stages, results)
+        writeBlock(fh_out, block)
+
+
+# Stages looked up one after the other by the same worker, in this order
+CHAINS = [('getSnpsFromDbSnp', 'getBigRefGene', 'getGenes')]
+
+
+""" Splits the stage indices into at most workers groups. Stages of a chain
+    stay together; the groups are balanced by number of stages """
+def stageGroups(stages, workers):
+    units = []
+    chained = set()
+    for chain in CHAINS:
+        unit = [s for s in range(0, len(stages)) if stages[s].function in chain]
+        unit.sort(key=lambda s: chain.index(stages[s].function))
+        if len(unit) > 0:
+            units.append(unit)
+            chained.update(unit)
+    units.extend([[s] for s in range(0, len(stages)) if s not in chained])
+
+    groups = [[] for i in range(0, min(workers, len(units)))]
+    for unit in units:
+        smallest = min(groups, key=len)
+        smallest.extend(unit)
+    return groups
+
+
+# Stages and cursor of a worker process, set by initWorker
+worker_stages = None
+worker_conn = None
+
+
+def initWorker(options, group):
+    global worker_stages, worker_conn
+    stages = st.driverStages(**options)
+    worker_stages = [stages[s] for s in group]
+    worker_conn = sql_config.conn2annotator()
+
+
+def lookupWorker(variants):
+    cursor = worker_conn.cursor ()
+    return [stage.lookupBatch(cursor, variants) for stage in worker_stages]
+
+
+def closeWorker():
+    for stage in worker_stages:
+        stage.close()
+    worker_conn.close()
+
+
+def mergeBlock(fh_out, stages, groups, cache, block, found, missing, futures):
+    fresh = [[] for stage in stages]
+    for group, future in zip(groups, futures):
+        for s, result in zip(group, future.result()):
+            fresh[s] = result
+    if cache is not None:
+        cache.putMany(stages, missing, fresh)
+    applyBlock(block, stages, vc.mergeResults(stages, found, fresh))
+    writeBlock(fh_out, block)
+
+
+""" annotateLines with the lookups done by worker processes. options are the
+    driverStages arguments the stages were built with; at most depth blocks
+    are in flight per worker """
+def annotateLinesParallel(lines, fh_out, stages, options, workers, format='vcf', block_size=1000, sep='\t', depth=2,
+                          cache=None):
+    inds=ann.getFormatSpecificIndices(format=format)
+    groups = stageGroups(stages, workers)
+    executors = [ProcessPoolExecutor(max_workers=1, initializer=initWorker, initargs=(options, group))
+                 for group in groups]
+    pending = collections.deque()
+    try:
+        for block in ann.readBlocks(lines, block_size, sep=sep):
+            variants=[st.variantOf(fields, inds) for line, fields in block if fields is not None]
+            found=[None] * len(variants)
+            if cache is not None:
+                found=cache.getMany(stages, variants)
+            missing=vc.missingVariants(variants, found)
+            futures=[]
+            if len(missing) > 0:
+                futures=[executor.submit(lookupWorker, missing) for executor in executors]
+            pending.append((block, found, missing, futures))
+            if len(pending) > depth:
+                mergeBlock(fh_out, stages, groups, cache, *pending.popleft())
+        while len(pending) > 0:
+            mergeBlock(fh_out, stages, groups, cache, *pending.popleft())
+        for future in [executor.submit(closeWorker) for executor in executors]:
+            future.result()
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+""" Writes the count.log sections of all stages, in pipeline order, then
+    those of the cache and of the other reports (objects with a report(fh_log)) """
+def writeLog(logfile, stages, cache=None, reports=()):
+    fh_log = open(logfile, 'w')
+    for stage in stages:
+        stage.report(fh_log)
+    if cache is not None:
+        cache.report(fh_log)
+    for report in reports:
+        report.report(fh_log)
+    fh_log.close()
+
+
+def run(infile, outfile, stages, format='vcf', block_size=1000, workers=0, options=None, cache=None, lines=None,
+        out=None):
+    fh = lines
+    if fh is None:
+        fh = open(infile)
+    fh_out = out
+    if fh_out is None:
+        fh_out = open(outfile, "w")
+
+    if workers > 0:
+        annotateLinesParallel(fh, fh_out, stages, options, workers, format=format, block_size=block_size,
+                              cache=cache)
+    else:
+        conn = sql_config.conn2annotator()
+        cursor = conn.cursor ()
+        annotateLines(fh, fh_out, stages, cursor, format=format, block_size=block_size, cache=cache)
+        conn.close()
+
+    for stage in stages:
+        stage.close()
+    if cache is not None:
+        cache.close()
+    fh.close()
+    fh_out.close()
+    writeLog(infile+'.count.log', stages, cache=cache)
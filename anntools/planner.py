@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+""" Adaptive lookup strategy of the overlap stages.
+
+    For every table and chromosome the planner picks the cheapest of:
+
+      point    one query per variant            n * query_ms
+      batched  multi-statement round trips      n / batch * query_ms + n * statement_ms
+               (see sql_config.fetchSets)
+      bulk     the rows of the chromosome       query_ms + rows * row_ms
+               loaded once and joined in memory
+               (interval_index.TableIndex)
+
+    n is the number of variants of the input on that chromosome (counted by
+    countVariants before annotating), rows the number of rows of the table
+    on it, counted the first time the chromosome comes up, and only when n
+    is large enough for the bulk load to have a chance. The costs are
+    configurable; the defaults are those of an RDS server in the same
+    region. Every decision and the time spent looking up with it are
+    printed when the stage closes.
+"""
+
+import math
+import time
+
+import annotate as ann
+import sql_config
+
+
+POINT = 'point'
+BATCHED = 'batched'
+BULK = 'bulk'
+
+
+""" Number of variants of infile per chromosome, as written in the file """
+def countVariants(infile, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    counts = {}
+    fh = open(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#") or len(line) == 0:
+            continue
+        chrom = line.split(sep)[inds[0]].strip()
+        counts[chrom] = counts.get(chrom, 0) + 1
+    fh.close()
+    return counts
+
+
+class Planner(object):
+    """ Strategy of each (stage, chromosome), decided once per process """
+
+    def __init__(self, counts, query_ms=1.0, row_ms=0.002, statement_ms=0.05):
+        self.counts = counts
+        self.query_ms = query_ms
+        self.row_ms = row_ms
+        self.statement_ms = statement_ms
+        # (table, chromosome) -> [strategy, variants, rows, lookups, seconds]
+        self.plans = {}
+
+    def variants(self, stage, chr):
+        return sum([n for chrom, n in self.counts.items() if stage.chrom(chrom) == chr])
+
+    def rows(self, cursor, stage, chr):
+        cursor.execute ('select count(*) from (' + (stage.indexSql() % chr).rstrip().rstrip(';') + ') t;')
+        return int(cursor.fetchone ()[0])
+
+    def batch(self, stage):
+        """ Queries per round trip of the batched strategy, 0 without multiple statements """
+        if not sql_config.sqlite_db:
+            return stage.multi_statements
+        return 0
+
+    def decide(self, cursor, stage, chr):
+        n = max(self.variants(stage, chr), 1)
+        if not stage.queryable(chr):
+            # looked up without a query
+            return [POINT, n, 0, 0, 0.0]
+        costs = {POINT: n * self.query_ms}
+        if self.batch(stage) > 1:
+            costs[BATCHED] = math.ceil(n / float(self.batch(stage))) * self.query_ms + n * self.statement_ms
+        rows = None
+        # loading the chromosome costs at least a query
+        if min(costs.values()) > 2 * self.query_ms:
+            rows = self.rows(cursor, stage, chr)
+            costs[BULK] = self.query_ms + rows * self.row_ms
+        strategy = min(costs, key=lambda s: (costs[s], s))
+        return [strategy, n, rows, 0, 0.0]
+
+    def strategy(self, cursor, stage, chr):
+        key = (stage.table, chr)
+        if key not in self.plans:
+            self.plans[key] = self.decide(cursor, stage, chr)
+        return self.plans[key][0]
+
+    def record(self, stage, chr, lookups, seconds):
+        plan = self.plans[(stage.table, chr)]
+        plan[3] += lookups
+        plan[4] += seconds
+
+    def summary(self, table):
+        lines = []
+        for key in sorted([k for k in self.plans.keys() if k[0] == table]):
+            strategy, n, rows, lookups, seconds = self.plans[key]
+            table_rows = 'not counted'
+            if rows is not None:
+                table_rows = str(rows) + ' rows'
+            lines.append('Plan ' + table + ' ' + str(key[1]) + ': ' + strategy + ' (' + str(n) + ' variants, '
+                         + table_rows + '), ' + str(lookups) + ' lookups in ' + ('%.3f' % seconds) + ' s')
+        return '\n'.join(lines)
@@ -6,9 +6,12 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import time
 import driver
+import sql_config
+import stages
+import ucsc_bin
+import s3_stream
 import boto3
 import subprocess
-from botocore.exceptions import ClientError
 import config_init
 import json
 from urllib.parse import urljoin
@@ -32,6 +35,23 @@ class Timer(object):
             print("Total runtime: {0:.6f} seconds".format(self.secs))
 
 
+# boto3 resources of the process, created once: a job_executor.py executor
+# reuses them for every job it runs
+resources = {}
+
+
+def __resource__(service, region_name):
+    '''
+    Helper function returning the boto3 resource of a service, created on first use
+    :param service:
+    :param region_name:
+    :return:
+    '''
+    if (service, region_name) not in resources:
+        resources[(service, region_name)] = boto3.resource(service, region_name=region_name)
+    return resources[(service, region_name)]
+
+
 def __update_status__(annotations_table, job_id, results_bucket, ann_key, log_key, status, complete_time):
     '''
     Helper function used to update job status in dynamodb
@@ -45,7 +65,7 @@ def __update_status__(annotations_table, job_id, results_bucket, ann_key, log_ke
     :return:
     '''
     # ref: https://github.com/santoshghimire/boto3-examples/blob/master/dynamodb.py
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    dynamodb = __resource__('dynamodb', 'us-east-1')
     ann_table = dynamodb.Table(annotations_table)
     ann_table.update_item(
         Key={
@@ -82,7 +102,7 @@ def __publish_complete_status__(user_id, job_id, email, url, complete_topic):
             'url': request_url
             }
 
-    sns = boto3.resource('sns', region_name=app_config.AWS_REGION_NAME)
+    sns = __resource__('sns', app_config.AWS_REGION_NAME)
     topic = sns.Topic(complete_topic)
     topic.publish(Message=json.dumps(data))
     print('Publish message: {}'.format(data))
@@ -105,7 +125,7 @@ def __publish_archive_status__(job_id, ann_key, complete_time):
             's3_key_result_file': ann_key
             }
 
-    sns = boto3.resource('sns', region_name=app_config.AWS_REGION_NAME)
+    sns = __resource__('sns', app_config.AWS_REGION_NAME)
     topic = sns.Topic(app_config.AWS_SNS_JOB_ARCHIVE_TOPIC)
     topic.publish(Message=json.dumps(data))
     print('Publish message: {}'.format(data))
@@ -122,38 +142,113 @@ def __upload_file__(results_bucket, ann_file, ann_key, log_file, log_key):
     :return:
     '''
     # ref: https://stackoverflow.com/questions/37017244/uploading-a-file-to-a-s3-bucket-with-a-prefix-using-boto3
-    s3 = boto3.resource('s3', region_name=app_config.AWS_REGION_NAME)
+    s3 = __resource__('s3', app_config.AWS_REGION_NAME)
     s3.meta.client.upload_file(ann_file, results_bucket, ann_key)
     s3.meta.client.upload_file(log_file, results_bucket, log_key)
 
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        app_config = config_init.UtilsConfig()
-        results_bucket = app_config.AWS_S3_RESULTS_BUCKET
-        log_suffix = '.vcf.count.log'
-        ann_suffix = '.annot.vcf'
-
-        file_name = sys.argv[1].split('/')[1].split('.')[0]
-        user_id = sys.argv[2]
-        job_id = file_name.split('~')[0]
-        email = sys.argv[3]
-        url = sys.argv[4]
-        role = sys.argv[5]
-        ann_file = app_config.LOCAL_DATA_PREFIX + file_name + ann_suffix
-        log_file = app_config.LOCAL_DATA_PREFIX + file_name + log_suffix
-        ann_key = app_config.AWS_S3_KEY_PREFIX + user_id + '/' + file_name + ann_suffix
-        log_key = app_config.AWS_S3_KEY_PREFIX + user_id + '/' + file_name + log_suffix
+def __upload_streamed__(upload, results_bucket, log_file, log_key):
+    '''
+    Helper function used to wait for the streamed annotated file to be
+    complete, then upload the log file. Waited for first, so that a failed
+    completion aborts the upload and shuts its threads down whatever
+    happens to the log.
+    :param upload:
+    :param results_bucket:
+    :param log_file:
+    :param log_key:
+    :return:
+    '''
+    upload.wait()
+    s3_stream.retry(lambda: upload.store.putFile(log_file, results_bucket, log_key), 'upload of ' + log_key)
+
+
+""" Settings of the jobs of this process, read once """
+def configure(config):
+    global app_config
+    app_config = config
+    if app_config.SQLITE_DB:
+        sql_config.useSqlite(app_config.SQLITE_DB)
+    sql_config.configurePool(max_size=app_config.POOL_SIZE)
+    ucsc_bin.enabled = app_config.USE_BIN
+    # raises ValueError here, rather than in every job, when an option is
+    # set that ENGINE does not support
+    global options
+    options = driver.Options(engine=app_config.ENGINE, dbsnp_batch_size=app_config.DBSNP_BATCH_SIZE,
+                             dbsnp_bloom=app_config.DBSNP_BLOOM, lookup_threads=app_config.LOOKUP_THREADS,
+                             indexed_tables=app_config.INDEXED_TABLES, merge_join=app_config.MERGE_JOIN,
+                             gene_models=app_config.GENE_MODELS, bigrefgene_batched=app_config.BIGREFGENE_BATCHED,
+                             columnar_tables=app_config.COLUMNAR_TABLES, snapshot_dir=app_config.SNAPSHOT_DIR,
+                             multi_statements=app_config.MULTI_STATEMENTS, adaptive_plan=app_config.ADAPTIVE_PLAN,
+                             plan_query_ms=app_config.PLAN_QUERY_MS, workers=app_config.WORKERS,
+                             shards=app_config.SHARDS, shard_by_chrom=app_config.SHARD_BY_CHROM,
+                             async_window=app_config.ASYNC_WINDOW, cache_path=app_config.CACHE_PATH,
+                             cache_version=app_config.CACHE_VERSION, cache_size=app_config.CACHE_SIZE)
+
+
+""" Annotates one input and publishes the results; args are those of the
+    command line: input file, user id, email, url and role, then the bucket
+    and key of the input when it is streamed from s3 rather than downloaded
+    to the input file """
+def runJob(args):
+    results_bucket = app_config.AWS_S3_RESULTS_BUCKET
+    log_suffix = '.vcf.count.log'
+    ann_suffix = '.annot.vcf'
+
+    file_name = args[0].split('/')[1].split('.')[0]
+    user_id = args[1]
+    job_id = file_name.split('~')[0]
+    email = args[2]
+    url = args[3]
+    role = args[4]
+    ann_file = app_config.LOCAL_DATA_PREFIX + file_name + ann_suffix
+    log_file = app_config.LOCAL_DATA_PREFIX + file_name + log_suffix
+    ann_key = app_config.AWS_S3_KEY_PREFIX + user_id + '/' + file_name + ann_suffix
+    log_key = app_config.AWS_S3_KEY_PREFIX + user_id + '/' + file_name + log_suffix
+
+    lines = None
+    upload = None
+    try:
+        try:
+            store = None
+            if len(args) > 6 or app_config.STREAM_OUTPUT:
+                store = s3_stream.objectStore(app_config.AWS_REGION_NAME, local_dir=app_config.LOCAL_S3_DIR)
+            if len(args) > 6:
+                lines = s3_stream.openObject(store, args[5], args[6], part_size=app_config.INPUT_PART_SIZE,
+                                             concurrency=app_config.INPUT_CONCURRENCY)
+            out = None
+            if app_config.STREAM_OUTPUT:
+                # the annotated file goes to s3 as it is written
+                upload = s3_stream.MultipartUpload(store, results_bucket, ann_key,
+                                                   part_size=app_config.OUTPUT_PART_SIZE,
+                                                   concurrency=app_config.OUTPUT_CONCURRENCY)
+                out = upload.open()
+
+            with Timer():
+                driver.run(args[0], 'vcf', options, lines=lines, out=out)
+        except Exception:
+            # no partial object left in s3, and the job is not left RUNNING;
+            # raised again for the exit code and traceback of the job
+            if upload is not None:
+                upload.abort()
+            __update_status__(app_config.AWS_DYNAMODB_ANNOTATIONS_TABLE,
+                              job_id, results_bucket, ann_key, log_key, 'FAILED', int(time.time()))
+            raise
+        finally:
+            # the engines close it once read; not when they fail, and its
+            # threads and buffered parts would outlive the job
+            if lines is not None:
+                lines.close()
+        print(sql_config.pool.summary())
 
         complete_time = int(time.time())
 
         try:
             # upload files to s3
-            __upload_file__(results_bucket, ann_file, ann_key, log_file, log_key)
+            if upload is not None:
+                __upload_streamed__(upload, results_bucket, log_file, log_key)
+            else:
+                __upload_file__(results_bucket, ann_file, ann_key, log_file, log_key)
 
             print('Update dynamodb successfully')
 
@@ -168,18 +263,28 @@ if __name__ == '__main__':
             __update_status__(app_config.AWS_DYNAMODB_ANNOTATIONS_TABLE,
                               job_id, results_bucket, ann_key, log_key, 'COMPLETED', complete_time)
 
-        except ClientError as e:
-
+        except Exception as e:
+            # ClientError, or whatever failed the streamed upload (an IOError
+            # of the local store, an EndpointConnectionError, ...)
             print(e)
             # if job failed,update job status as Failed in dynamodb
             __update_status__(app_config.AWS_DYNAMODB_ANNOTATIONS_TABLE,
                               job_id, results_bucket, ann_key, log_key, 'FAILED', complete_time)
 
-        finally:
-            # Clean up (delete) local job files
-            subprocess.Popen(['rm', '-f', sys.argv[1]])
-            subprocess.Popen(['rm', '-f', ann_file])
-            subprocess.Popen(['rm', '-f', log_file])
+    finally:
+        # Clean up (delete) local job files, whether the job failed or not;
+        # waited for, as the process may be a job_executor.py executor
+        # running many jobs
+        subprocess.call(['rm', '-f', args[0], ann_file, log_file])
+        # nor do the tables the job indexed stay in the memory of such an
+        # executor, or outlive a reload of the database
+        stages.shared_indexes.clear()
+
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 1:
+        configure(config_init.UtilsConfig())
+        runJob(sys.argv[1:])
 
     else:
         print("A valid .vcf file must be provided as input to this program.")
\ No newline at end of file
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+""" Streaming of the job input from S3 and of the results to it.
+
+    openObject returns the object as a text file read while it downloads:
+    the object is cut in parts of part_size bytes fetched with byte-range
+    GETs, up to concurrency at once, and handed over in order, so
+    driver.run annotates the first records while the rest is still in
+    transit. Lines are split as by open(), whatever part boundary they
+    straddle. A GET that fails is retried alone.
+
+    MultipartUpload is the other way round: the annotated lines written to
+    its open() are sent as the parts of a multipart upload as soon as
+    part_size bytes are there, up to concurrency parts at once, each one
+    retried alone. Closing it sends the last part and completes the upload
+    in the background; wait() returns once the object is there.
+
+    The stores hide where the objects are: S3ObjectStore is S3 itself,
+    LocalObjectStore a directory holding bucket/key files, to run jobs
+    without AWS.
+"""
+
+import collections
+import hashlib
+import io
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+except ImportError:
+    # only LocalObjectStore then
+    boto3 = None
+
+
+""" function(), called again up to retries times while it raises """
+def retry(function, what, retries=3):
+    for attempt in range(0, retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print('Retrying ' + what + ': ' + str(e))
+            time.sleep(0.1 * 2 ** attempt)
+
+
+class LocalObjectStore(object):
+    """ Stand-in for S3: the object bucket/key is the file root/bucket/key,
+        the parts of the uploads in progress are files of root/.uploads """
+
+    min_part_size = 1
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def size(self, bucket, key):
+        return os.path.getsize(self.path(bucket, key))
+
+    def getRange(self, bucket, key, start, end):
+        """ Bytes start to end, both included """
+        fh = open(self.path(bucket, key), 'rb')
+        try:
+            fh.seek(start)
+            return fh.read(end - start + 1)
+        finally:
+            fh.close()
+
+    def uploadDir(self, upload_id):
+        return os.path.join(self.root, '.uploads', upload_id)
+
+    def createMultipart(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.uploadDir(upload_id))
+        return upload_id
+
+    def uploadPart(self, bucket, key, upload_id, number, data):
+        """ ETag of the part """
+        fh = open(os.path.join(self.uploadDir(upload_id), str(number)), 'wb')
+        fh.write(data)
+        fh.close()
+        return hashlib.md5(data).hexdigest()
+
+    def completeMultipart(self, bucket, key, upload_id, parts):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp' + upload_id
+        fh = open(tmp, 'wb')
+        for part in parts:
+            fh_part = open(os.path.join(self.uploadDir(upload_id), str(part['PartNumber'])), 'rb')
+            data = fh_part.read()
+            fh_part.close()
+            if hashlib.md5(data).hexdigest() != part['ETag']:
+                fh.close()
+                os.remove(tmp)
+                raise IOError('Part ' + str(part['PartNumber']) + ' of ' + key + ' does not match its ETag')
+            fh.write(data)
+        fh.close()
+        os.rename(tmp, path)
+        shutil.rmtree(self.uploadDir(upload_id))
+
+    def abortMultipart(self, bucket, key, upload_id):
+        shutil.rmtree(self.uploadDir(upload_id), ignore_errors=True)
+
+    def putFile(self, path, bucket, key):
+        target = self.path(bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target + '.tmp')
+        os.rename(target + '.tmp', target)
+
+
+class S3ObjectStore(object):
+
+    # S3 rejects smaller parts, but for the last one
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, client):
+        self.client = client
+
+    def size(self, bucket, key):
+        return self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    def getRange(self, bucket, key, start, end):
+        response = self.client.get_object(Bucket=bucket, Key=key, Range='bytes=' + str(start) + '-' + str(end))
+        return response['Body'].read()
+
+    def createMultipart(self, bucket, key):
+        return self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def uploadPart(self, bucket, key, upload_id, number, data):
+        return self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                       Body=data)['ETag']
+
+    def completeMultipart(self, bucket, key, upload_id, parts):
+        self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def abortMultipart(self, bucket, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    def putFile(self, path, bucket, key):
+        self.client.upload_file(path, bucket, key)
+
+
+""" The objects of S3, or of local_dir when set """
+def objectStore(region_name, local_dir=''):
+    if local_dir:
+        return LocalObjectStore(local_dir)
+    if boto3 is None:
+        raise ImportError('boto3 is needed to read objects from S3')
+    return S3ObjectStore(boto3.client('s3', region_name=region_name))
+
+
+class RangedObject(io.RawIOBase):
+    """ Bytes of an object, its parts fetched concurrently and read in order """
+
+    def __init__(self, store, bucket, key, part_size=8 * 1024 * 1024, concurrency=4, retries=3):
+        io.RawIOBase.__init__(self)
+        self.store = store
+        self.bucket = bucket
+        self.key = key
+        self.retries = retries
+        self.size = store.size(bucket, key)
+        self.ranges = collections.deque([(start, min(start + part_size, self.size) - 1)
+                                         for start in range(0, self.size, part_size)])
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # parts fetched or being fetched, in object order: a window of two
+        # parts per thread, so the threads stay busy while one is consumed
+        self.window = 2 * concurrency
+        self.pending = collections.deque()
+        self.part = memoryview(b'')
+        self.gets = 0
+        self.started = time.time()
+        self.fill()
+
+    def get(self, start, end):
+        data = self.store.getRange(self.bucket, self.key, start, end)
+        if len(data) != end - start + 1:
+            raise IOError('Short read of ' + self.key + ' bytes ' + str(start) + '-' + str(end))
+        return data
+
+    def fetch(self, start, end):
+        return retry(lambda: self.get(start, end), 'bytes ' + str(start) + '-' + str(end) + ' of ' + self.key,
+                     self.retries)
+
+    def fill(self):
+        while len(self.ranges) > 0 and len(self.pending) < self.window:
+            start, end = self.ranges.popleft()
+            self.pending.append(self.executor.submit(self.fetch, start, end))
+            self.gets += 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.part) == 0:
+            if len(self.pending) == 0:
+                return 0
+            self.part = memoryview(self.pending.popleft().result())
+            self.fill()
+        n = min(len(b), len(self.part))
+        b[:n] = self.part[:n]
+        self.part = self.part[n:]
+        return n
+
+    def summary(self):
+        return ('Streamed ' + str(self.size) + ' bytes of ' + self.key + ' in ' + str(self.gets)
+                + ' ranged parts, ' + ('%.3f' % (time.time() - self.started)) + ' s')
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+            print(self.summary())
+        io.RawIOBase.close(self)
+
+
+""" The object as a text file, read while its parts download """
+def openObject(store, bucket, key, part_size=8 * 1024 * 1024, concurrency=4, retries=3):
+    raw = RangedObject(store, bucket, key, part_size=part_size, concurrency=concurrency, retries=retries)
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=min(part_size, io.DEFAULT_BUFFER_SIZE * 16)))
+
+
+class MultipartUpload(io.RawIOBase):
+    """ Object written as the parts of a multipart upload, sent while the
+        next ones are written """
+
+    def __init__(self, store, bucket, key, part_size=8 * 1024 * 1024, concurrency=4, retries=3):
+        io.RawIOBase.__init__(self)
+        self.store = store
+        self.bucket = bucket
+        self.key = key
+        self.retries = retries
+        self.part_size = max(part_size, store.min_part_size)
+        self.upload_id = store.createMultipart(bucket, key)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # parts held in memory at most, sent or waiting for a thread
+        self.window = 2 * concurrency
+        self.buffer = bytearray()
+        self.parts = []
+        self.completion = None
+        self.size = 0
+        self.started = time.time()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while len(self.buffer) >= self.part_size:
+            self.send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(b)
+
+    def send(self, data):
+        waiting = [part for part in self.parts if not part.done()]
+        if len(waiting) >= self.window:
+            waiting[0].result()
+        self.parts.append(self.executor.submit(self.uploadPart, len(self.parts) + 1, data))
+        self.size += len(data)
+
+    def uploadPart(self, number, data):
+        etag = retry(lambda: self.store.uploadPart(self.bucket, self.key, self.upload_id, number, data),
+                     'part ' + str(number) + ' of ' + self.key, self.retries)
+        return {'PartNumber': number, 'ETag': etag}
+
+    def complete(self):
+        # the parts were queued before, so they are all sent or being sent
+        parts = [part.result() for part in self.parts]
+        retry(lambda: self.store.completeMultipart(self.bucket, self.key, self.upload_id, parts),
+              'completion of ' + self.key, self.retries)
+
+    def close(self):
+        if not self.closed:
+            if len(self.buffer) > 0 or len(self.parts) == 0:
+                self.send(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.completion = self.executor.submit(self.complete)
+        io.RawIOBase.close(self)
+
+    def wait(self):
+        """ Returns once the object is complete; aborts the upload and raises
+            when it failed """
+        try:
+            self.completion.result()
+        except Exception:
+            self.abort()
+            raise
+        self.executor.shutdown()
+        print('Uploaded ' + str(self.size) + ' bytes to ' + self.key + ' in ' + str(len(self.parts)) + ' parts, '
+              + ('%.3f' % (time.time() - self.started)) + ' s')
+
+    def abort(self):
+        for part in self.parts:
+            part.cancel()
+        self.executor.shutdown()
+        self.store.abortMultipart(self.bucket, self.key, self.upload_id)
+
+    def open(self):
+        """ The upload as a text file """
+        return io.TextIOWrapper(io.BufferedWriter(self, buffer_size=min(self.part_size, io.DEFAULT_BUFFER_SIZE * 16)))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+""" Sharded annotation of large inputs.
+
+    The input is cut into newline-aligned byte ranges, so a chromosome can
+    span several shards and a large one does not hold the whole run back
+    (optionally they are moved to the next change of chromosome, so that no
+    chromosome is split between shards of a sorted VCF; that caps the shards
+    at the number of chromosomes). Every shard is annotated by the fused engine in its own
+    process into a part file, the parts are concatenated in input order and
+    the stage counters of the shards are added up for count.log.
+"""
+
+import os
+import shutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import annotate as ann
+import file_utils as fu
+import pipeline
+import sql_config
+import stages as st
+
+
+def lineChrom(line, ind):
+    if line.startswith(b'#'):
+        return None
+    fields = line.split(b'\t')
+    if len(fields) <= ind:
+        return None
+    return fields[ind].strip()
+
+
+""" Byte offsets [0, ..., size] of at most shards ranges, each starting at
+    the beginning of a line (with by_chrom, of a new chromosome) """
+def shardOffsets(infile, shards, by_chrom=False, format='vcf'):
+    size = os.path.getsize(infile)
+    ind = ann.getFormatSpecificIndices(format=format)[0]
+    offsets = [0]
+    fh = open(infile, 'rb')
+    for i in range(1, shards):
+        start = max(size * i // shards, offsets[-1])
+        if start >= size:
+            break
+        fh.seek(start)
+        if start > 0:
+            fh.seek(start - 1)
+            fh.readline()
+        if by_chrom:
+            previous = None
+            while True:
+                pos = fh.tell()
+                line = fh.readline()
+                if len(line) == 0:
+                    break
+                chrom = lineChrom(line, ind)
+                if previous is not None and chrom is not None and chrom != previous:
+                    fh.seek(pos)
+                    break
+                if chrom is not None:
+                    previous = chrom
+        start = fh.tell()
+        if start > offsets[-1] and start < size:
+            offsets.append(start)
+    fh.close()
+    offsets.append(size)
+    return offsets
+
+
+def rangeLines(infile, start, end):
+    fh = open(infile, 'rb')
+    fh.seek(start)
+    pos = start
+    while pos < end:
+        line = fh.readline()
+        if len(line) == 0:
+            break
+        pos = pos + len(line)
+        yield line.decode()
+    fh.close()
+
+
+""" Annotates infile[start:end] into partfile, returns the counters of the
+    stages and of the cache """
+def annotateShard(infile, start, end, partfile, options, format='vcf', block_size=1000, cache=None):
+    stages = st.driverStages(**options)
+    fh_out = open(partfile, 'w')
+    conn = sql_config.conn2annotator()
+    cursor = conn.cursor ()
+
+    pipeline.annotateLines(rangeLines(infile, start, end), fh_out, stages, cursor, format=format,
+                           block_size=block_size, cache=cache)
+
+    for stage in stages:
+        stage.close()
+    conn.close()
+    fh_out.close()
+    if cache is None:
+        return ([stage.counts for stage in stages], None)
+    cache.close()
+    return ([stage.counts for stage in stages], cache.counts)
+
+
+def run(infile, outfile, stages, options, shards, by_chrom=False, format='vcf', block_size=1000, cache=None):
+    try:
+        offsets = shardOffsets(infile, shards, by_chrom=by_chrom, format=format)
+        parts = [outfile + '.part' + str(i) for i in range(0, len(offsets) - 1)]
+
+        executor = ProcessPoolExecutor(max_workers=min(len(parts), os.cpu_count() or 1))
+        try:
+            futures = [executor.submit(annotateShard, infile, offsets[i], offsets[i + 1], parts[i], options,
+                                       format=format, block_size=block_size, cache=cache)
+                       for i in range(0, len(parts))]
+            counts = [future.result() for future in futures]
+        finally:
+            executor.shutdown()
+
+        fh_out = open(outfile, 'w')
+        for part in parts:
+            fh = open(part)
+            shutil.copyfileobj(fh, fh_out)
+            fh.close()
+            fu.delete(part)
+        fh_out.close()
+
+        for s in range(0, len(stages)):
+            stages[s].counts = Counter()
+            for shard, cached in counts:
+                stages[s].counts.update(shard[s])
+        if cache is not None:
+            for shard, cached in counts:
+                cache.counts.update(cached)
+        pipeline.writeLog(infile + '.count.log', stages, cache=cache)
+    finally:
+        # as pipeline.run does: driverStages opened their bloom filters and
+        # snapshots even though the shards use their own
+        for stage in stages:
+            stage.close()
+        if cache is not None:
+            cache.close()
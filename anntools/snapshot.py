@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+""" Memory-mapped binary snapshots of the overlap tables.
+
+    A snapshot holds the rows of one table in a single file, grouped by
+    chromosome, then by class of lengths as in columnar.IntervalColumns
+    (class k holds the intervals of 2**k - 1 to 2**(k+1) - 2 bases), and
+    sorted by start within their class:
+
+        header       magic, format version, length of the metadata
+        metadata     JSON: table, columns, interval columns, byte order and
+                     the [first row, row count, longest length] of every
+                     class of every chromosome
+        starts       int32 per row
+        ends         int32 per row
+        ids          int32 per row, position of the row in the table order
+        kinds        uint8 per cell, type of the value (see KINDS)
+        offsets      uint64 per cell + 1, where the value starts in the heap
+        heap         the values, as text (bytes values as they are)
+
+    The file is opened with mmap and read in place, so opening one costs a
+    header read and every annotator process of a host shares the same pages
+    of the page cache instead of loading its own copy of the table.
+
+    The rows of a class holding pos are among those starting from pos -
+    longest to pos, found by bisection, so a lookup scans about twice as many
+    rows as it hits, plus two searches per class: a chromosome-long CNV is
+    only scanned by the positions it holds. The hits come back in table
+    order, like interval_index.TableIndex, so the first one is what
+    fetchone() returns.
+
+    Export the tables of the annotator with:
+
+        python snapshot.py export /data/snapshots [cytoBand dgv_Cnv ...]
+
+    and export them again whenever the database is reloaded.
+"""
+
+import argparse
+import bisect
+import decimal
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import sql_config
+
+
+MAGIC = b'ANNSNAP\x00'
+# 2: rows grouped by class of lengths instead of a running maximum of the ends
+VERSION = 2
+# magic, version, length of the metadata
+HEADER = struct.Struct('<8sII')
+
+# type of a cell -> how to read its heap text back
+NONE, INT, FLOAT, TEXT, BYTES, DECIMAL = range(0, 6)
+KINDS = {
+    NONE: lambda b: None,
+    INT: lambda b: int(b),
+    FLOAT: lambda b: float(b),
+    TEXT: lambda b: b.decode('utf-8'),
+    BYTES: lambda b: b,
+    DECIMAL: lambda b: decimal.Decimal(b.decode('ascii')),
+}
+
+
+def encode(value):
+    """ (kind, heap bytes) of a value """
+    if value is None:
+        return (NONE, b'')
+    if isinstance(value, bool):
+        return (INT, str(int(value)).encode('ascii'))
+    if isinstance(value, int):
+        return (INT, str(value).encode('ascii'))
+    if isinstance(value, float):
+        return (FLOAT, repr(value).encode('ascii'))
+    if isinstance(value, decimal.Decimal):
+        return (DECIMAL, str(value).encode('ascii'))
+    if isinstance(value, str):
+        return (TEXT, value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return (BYTES, bytes(value))
+    raise ValueError('Cannot store ' + type(value).__name__ + ' values in a snapshot')
+
+
+def align(size):
+    return (size + 7) & ~7
+
+
+""" Writes a snapshot to path. chroms maps each chromosome to the rows of the
+    table for it, in table order; start and end name the interval columns """
+def write(path, table, columns, chroms, start='chromStart', end='chromEnd'):
+    s = columns.index(start)
+    e = columns.index(end)
+    starts, ends, ids = [], [], []
+    kinds = bytearray()
+    offsets = [0]
+    heap = bytearray()
+    directory = {}
+    for chrom in sorted(chroms.keys()):
+        rows = chroms[chrom]
+        lengths = [max(int(row[e]) - int(row[s]), 0) for row in rows]
+        classes = [(length + 1).bit_length() - 1 for length in lengths]
+        order = sorted(range(0, len(rows)), key=lambda i: (classes[i], int(rows[i][s]), i))
+        directory[chrom] = []
+        current = None
+        for i in order:
+            if classes[i] != current:
+                current = classes[i]
+                directory[chrom].append([len(starts), 0, 0])
+            group = directory[chrom][-1]
+            group[1] = group[1] + 1
+            group[2] = max(group[2], lengths[i])
+            row = rows[i]
+            starts.append(int(row[s]))
+            ends.append(int(row[e]))
+            ids.append(i)
+            for value in row:
+                kind, data = encode(value)
+                kinds.append(kind)
+                heap.extend(data)
+                offsets.append(len(heap))
+
+    metadata = json.dumps({'table': table, 'columns': columns, 'start': start, 'end': end,
+                           'byteorder': sys.byteorder, 'rows': len(starts), 'chroms': directory,
+                           'created': time.strftime('%Y-%m-%d %H:%M:%S')}).encode('utf-8')
+    metadata = metadata + b' ' * (align(HEADER.size + len(metadata)) - HEADER.size - len(metadata))
+
+    # written aside and renamed, so running jobs keep the snapshot they opened
+    tmp = path + '.tmp' + str(os.getpid())
+    fh = open(tmp, 'wb')
+    fh.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+    fh.write(metadata)
+    for values in [starts, ends, ids]:
+        fh.write(struct.pack('=%di' % len(values), *values))
+    fh.write(kinds)
+    fh.write(b'\x00' * (align(len(kinds)) - len(kinds)))
+    fh.write(struct.pack('=%dQ' % len(offsets), *offsets))
+    fh.write(heap)
+    fh.close()
+    os.rename(tmp, path)
+
+
+""" Snapshot of the rows sql (with %s for the chromosome) returns for every
+    chromosome of chroms """
+def export(cursor, path, table, sql, chroms, start='chromStart', end='chromEnd'):
+    columns = None
+    rows = {}
+    for chrom in chroms:
+        cursor.execute (sql % chrom)
+        if columns is None:
+            columns = [str(d[0]) for d in cursor.description]
+        rows[str(chrom).upper()] = list(cursor.fetchall ())
+    if columns is None:
+        # no chromosome: the columns of the empty table
+        cursor.execute ('select * from ' + table + ' limit 0;')
+        columns = [str(d[0]) for d in cursor.description]
+    write(path, table, columns, rows, start=start, end=end)
+    print ("Exported " + str(sum([len(r) for r in rows.values()])) + " rows of " + table + " to " + path)
+
+
+class Snapshot(object):
+    """ Read-only view of a snapshot file """
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.slices = []
+        magic, version, size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(path + ' is not an annotation table snapshot')
+        if version != VERSION:
+            self.close()
+            raise ValueError(path + ' is a version ' + str(version) + ' snapshot, export it again')
+        metadata = json.loads(self.map[HEADER.size:HEADER.size + size].decode('utf-8'))
+        if metadata['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError(path + ' was written on a ' + metadata['byteorder'] + '-endian host')
+        self.table = metadata['table']
+        self.columns = metadata['columns']
+        self.start = metadata['start']
+        self.end = metadata['end']
+        self.chroms = metadata['chroms']
+        self.width = len(self.columns)
+
+        rows = metadata['rows']
+        # the views of the sections never leave the object: row() copies
+        # the values out of the map, and close() releases the views before
+        # closing it
+        self.view = memoryview(self.map)
+        offset = HEADER.size + size
+        sections = []
+        for name in ['starts', 'ends', 'ids']:
+            sections.append(self.section(offset, 4 * rows).cast('i'))
+            offset = offset + 4 * rows
+        self.starts, self.ends, self.ids = sections
+        cells = rows * self.width
+        self.kinds = self.section(offset, cells)
+        offset = offset + align(cells)
+        self.offsets = self.section(offset, 8 * (cells + 1)).cast('Q')
+        self.heap = offset + 8 * (cells + 1)
+
+    def __getstate__(self):
+        # mmaps do not pickle, reopen in the other process
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def section(self, offset, size):
+        view = self.view[offset:offset + size]
+        # released by close(), with the casts made of it
+        self.slices.append(view)
+        return view
+
+    def row(self, r):
+        first = r * self.width
+        values = []
+        for c in range(first, first + self.width):
+            data = bytes(self.map[self.heap + self.offsets[c]:self.heap + self.offsets[c + 1]])
+            values.append(KINDS[self.kinds[c]](data))
+        return tuple(values)
+
+    def rowIds(self, chrom, pos):
+        """ rows holding pos, in table order """
+        chrom = str(chrom).upper()
+        if chrom not in self.chroms:
+            return []
+        pos = int(pos)
+        hits = []
+        for first, count, longest in self.chroms[chrom]:
+            hi = bisect.bisect_right(self.starts, pos, first, first + count)
+            lo = bisect.bisect_left(self.starts, pos - longest, first, hi)
+            hits.extend([r for r in range(lo, hi) if self.ends[r] >= pos])
+        hits.sort(key=lambda r: self.ids[r])
+        return hits
+
+    def query(self, chrom, pos):
+        return [self.row(r) for r in self.rowIds(chrom, pos)]
+
+    def first(self, chrom, pos):
+        hits = self.rowIds(chrom, pos)
+        if len(hits) == 0:
+            return None
+        return self.row(hits[0])
+
+    def close(self):
+        for name in ['starts', 'ends', 'ids', 'kinds', 'offsets']:
+            if hasattr(self, name):
+                getattr(self, name).release()
+        for view in self.slices:
+            view.release()
+        if hasattr(self, 'view'):
+            self.view.release()
+        self.map.close()
+        self.fh.close()
+
+
+def snapshotPath(directory, table):
+    return os.path.join(directory, table + '.snap')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Snapshots of the overlap tables of the annotator')
+    commands = parser.add_subparsers(dest='command')
+    exporter = commands.add_parser('export', help='export tables from the annotation database')
+    exporter.add_argument('directory')
+    exporter.add_argument('tables', nargs='*', help='default: every overlap table of the annotator')
+    info = commands.add_parser('info', help='table, rows and chromosomes of a snapshot')
+    info.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        import stages as st
+        conn = sql_config.connect()
+        cursor = conn.cursor ()
+        for stage in st.driverStages():
+            if isinstance(stage, st.OverlapStage) and (len(args.tables) == 0 or stage.table in args.tables):
+                stage.exportSnapshot(cursor, snapshotPath(args.directory, stage.table))
+        conn.close()
+    elif args.command == 'info':
+        snapshot = Snapshot(args.path)
+        print (snapshot.table + ': ' + str(len(snapshot.starts)) + ' rows, ' + str(len(snapshot.chroms))
+               + ' chromosomes, ' + snapshot.start + '-' + snapshot.end)
+        snapshot.close()
+    else:
+        parser.print_help()
@@ -33,9 +33,19 @@
 ################################################################################
 
 #import MySQLdb
-import pymysql
+import os
+import re
+import threading
+import time
+try:
+    import pymysql
+    from pymysql.constants import CLIENT
+except ImportError:
+    # only needed for the MySQL server, not for a local SQLite database
+    pymysql = None
 import file_utils as fu
 import file_utils as fu
+import sqlite_backend
 
 def load_config(filename='config.txt'):
     fh = open(filename, "r")
@@ -55,7 +65,255 @@ passwd = config[2]
 db = config[3]
 port = int(config[4])
 
-def conn2annotator():
+# Local SQLite annotation database (see sqlite_backend.py) used instead of the
+# MySQL server above; inherited by child processes through the environment
+sqlite_db = os.environ.get('ANNTOOLS_SQLITE_DB')
+
+def useSqlite(path):
+    global sqlite_db
+    sqlite_db = path
+    os.environ['ANNTOOLS_SQLITE_DB'] = path
+    pool.clear()
+    multi_pool.clear()
+
+def connect(multi_statements=False):
+    """ New connection to the annotation database, bypassing the pool.
+        multi_statements: whether it accepts several statements per
+        execute() (see fetchSets) """
+    if sqlite_db:
+        return sqlite_backend.connect(sqlite_db)
     #conn = MySQLdb.connect (host = host, user = user, passwd = passwd, db = db, port = port)
+    if multi_statements:
+        return pymysql.connect (host = host, user = user, passwd = passwd, db = db, port = port,
+                                client_flag = CLIENT.MULTI_STATEMENTS)
     conn = pymysql.connect (host = host, user = user, passwd = passwd, db = db, port = port)
     return conn
+
+
+def healthy(conn):
+    try:
+        if hasattr(conn, 'ping'):
+            conn.ping(reconnect=False)
+        else:
+            conn.execute('select 1')
+        return True
+    except Exception:
+        return False
+
+
+class PooledConnection(object):
+    """ Connection checked out of a ConnectionPool; close() gives it back """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool(object):
+    """ Process-wide pool of annotation database connections.
+
+        At most max_size connections are open at once; get() waits for one to
+        be released beyond that. Connections idle for more than check_after
+        seconds are pinged before being handed out again and replaced if dead.
+        Counters of created/reused connections and of the time spent waiting
+        are kept to size the pool (see summary()).
+    """
+
+    def __init__(self, connect, max_size=16, check_after=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.check_after = check_after
+        self.lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.dropped = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.peak = 0
+
+    def forked(self):
+        # sockets inherited from the parent process must not be shared
+        if self.pid != os.getpid():
+            self.reset()
+
+    def get(self):
+        self.lock.acquire()
+        try:
+            self.forked()
+            if len(self.idle) == 0 and self.in_use >= self.max_size:
+                self.waits = self.waits + 1
+                start = time.time()
+                while len(self.idle) == 0 and self.in_use >= self.max_size:
+                    self.lock.wait()
+                self.wait_time = self.wait_time + time.time() - start
+            self.in_use = self.in_use + 1
+            self.peak = max(self.peak, self.in_use)
+            conn = None
+            if len(self.idle) > 0:
+                conn, released = self.idle.pop()
+        finally:
+            self.lock.release()
+
+        # connecting and pinging happen outside the lock
+        try:
+            if conn is not None and time.time() - released > self.check_after and not healthy(conn):
+                self.discard(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+                self.count('created')
+            else:
+                self.count('reused')
+        except Exception:
+            self.release(None)
+            raise
+        return PooledConnection(self, conn)
+
+    def count(self, counter):
+        self.lock.acquire()
+        setattr(self, counter, getattr(self, counter) + 1)
+        self.lock.release()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.count('dropped')
+
+    def release(self, conn):
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                return
+            self.in_use = self.in_use - 1
+            if conn is not None:
+                self.idle.append((conn, time.time()))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ Closes the idle connections, e.g. after switching databases """
+        self.lock.acquire()
+        idle = self.idle
+        self.idle = []
+        self.lock.release()
+        for conn, released in idle:
+            conn.close()
+
+    def summary(self):
+        return ("Connection pool: " + str(self.created) + " created, " + str(self.reused) + " reused, "
+                + str(self.dropped) + " dropped, peak " + str(self.peak) + "/" + str(self.max_size) + " in use, "
+                + str(self.waits) + " waits, " + "{0:.3f}".format(self.wait_time) + " s waiting")
+
+
+pool = ConnectionPool(connect, max_size=int(os.environ.get('ANNTOOLS_POOL_SIZE', '16')))
+
+# connections accepting several statements per execute(), used by fetchSets
+# alone: those of pool never do
+multi_pool = ConnectionPool(lambda: connect(multi_statements=True),
+                            max_size=int(os.environ.get('ANNTOOLS_POOL_SIZE', '16')))
+
+
+def configurePool(max_size=None, check_after=None):
+    for p in [pool, multi_pool]:
+        if max_size is not None:
+            p.max_size = max_size
+        if check_after is not None:
+            p.check_after = check_after
+
+
+def conn2annotator():
+    """ Connection from the shared pool; close() returns it to the pool """
+    return pool.get()
+
+def streamCursor(conn):
+    """ Unbuffered cursor: rows are read from the server as they are fetched """
+    if sqlite_db:
+        # sqlite cursors already step through the result
+        return conn.cursor()
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+def rowOrder(cursor, table, chrom=None):
+    """ Columns ordering the rows of table the way a query on its chromosome
+        column chrom returns them: the other columns of the index starting
+        with chrom, then the row id (SQLite) or the primary key (MySQL, whose
+        indexes end with it). Without chrom, or such an index, the rows come
+        in row id or primary key order. None when the table has no primary
+        key, as then no query can ask for the order of its rows """
+    indexes = []
+    if sqlite_db:
+        cursor.execute ('PRAGMA index_list("' + table + '");')
+        for index in cursor.fetchall ():
+            cursor.execute ('PRAGMA index_info("' + str(index[1]) + '");')
+            indexes.append([str(c[2]) for c in sorted(cursor.fetchall ())])
+        primary = ['rowid']
+    else:
+        cursor.execute ('SHOW KEYS FROM ' + table + ';')
+        keys = {}
+        for row in cursor.fetchall ():
+            keys.setdefault(str(row[2]), []).append((int(row[3]), str(row[4])))
+        primary = [c for seq, c in sorted(keys.pop('PRIMARY', []))]
+        if len(primary) == 0:
+            return None
+        indexes = [[c for seq, c in sorted(columns)] for columns in keys.values()]
+    if chrom is not None:
+        for columns in indexes:
+            if len(columns) > 0 and columns[0].lower() == chrom.lower():
+                return columns[1:] + [c for c in primary if c not in columns]
+    return primary
+
+
+# values of a variant that may go in a packed statement as they are: VCF
+# CHROM, POS, REF and ALT, breakends included, but no quote, backslash,
+# semicolon or space to end the string or the statement they are put in
+packable_value = re.compile(r'^[A-Za-z0-9_.,:<>*+\[\]-]+$')
+
+def packable(variant):
+    """ Whether the queries of variant can be sent with others in one execute() """
+    return all([packable_value.match(str(value)) is not None for value in variant])
+
+
+def fetchSets(cursor, sqls, per_call=16):
+    """ Rows of every query of sqls, in order. Up to per_call queries go to
+        the server in one execute() of a connection of multi_pool; their
+        result sets are walked with nextset(). SQLite runs one statement per
+        execute(), so there they are sent one at a time on cursor, as they
+        are when per_call < 2. The callers check that the values put in sqls
+        are packable() """
+    if sqlite_db or per_call < 2:
+        results = []
+        for sql in sqls:
+            cursor.execute (sql)
+            results.append(cursor.fetchall ())
+        return results
+
+    results = []
+    conn = multi_pool.get()
+    try:
+        cursor = conn.cursor()
+        for first in range(0, len(sqls), per_call):
+            chunk = [sql.rstrip().rstrip(';') + ';' for sql in sqls[first:first + per_call]]
+            cursor.execute (' '.join(chunk))
+            results.append(cursor.fetchall ())
+            while cursor.nextset():
+                results.append(cursor.fetchall ())
+        cursor.close()
+    finally:
+        conn.close()
+    return results
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+""" Local SQLite copy of the annotation database.
+
+    sql_config.conn2annotator() connects here instead of the MySQL server when
+    a database file is configured (ANNTOOLS_SQLITE_DB or sql_config.useSqlite),
+    so workers annotate against local disk and the pipeline runs offline.
+    Tables keep their MySQL names, columns and column order; text columns
+    compare case-insensitively like MySQL's default collation. Queries read
+    rows through the coordinate indexes, so load the dumps sorted by
+    chromosome and start, as UCSC ships them, to get the rows back in the
+    order of the MySQL tables.
+
+    Loading, from the MySQL dump format (table.sql with the CREATE TABLE and
+    table.txt[.gz] with tab separated rows, as written by mysqldump --tab and
+    distributed by UCSC):
+
+        python sqlite_backend.py load annotation.db cytoBand.sql cytoBand.txt.gz
+
+    or straight from the MySQL server of config.txt:
+
+        python sqlite_backend.py copy annotation.db dbSNP refGene cytoBand ...
+"""
+
+import argparse
+import gzip
+import re
+import sqlite3
+
+
+# Composite indexes matching the predicates of annotate.py, for the tables
+# whose coordinates are not named chrom/chromStart/chromEnd
+INDEXES = {
+    'dbSNP': [('CHR', 'POS')],
+    'chrom_pos_equal_base': [('CHR', 'start')],
+    'chrom_pos_equal_nobase': [('CHR', 'start')],
+    'chrom_pos_unequal': [('CHR', 'start', 'end')],
+    'refGene': [('chrom', 'txStart', 'txEnd')],
+    'gadAll': [('chromosome', 'chromStart', 'chromEnd')],
+    'gwasCatalog': [('chrom', 'chromEnd')],
+}
+
+
+def connect(path, readonly=True):
+    """ Connection used like a pymysql one: cursor(), execute(), fetch*(), description """
+    if readonly:
+        conn = sqlite3.connect('file:' + path + '?mode=ro', uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA mmap_size = 1073741824')
+    conn.execute('PRAGMA cache_size = -262144')
+    return conn
+
+
+def sqliteType(mysql_type):
+    t = mysql_type.lower()
+    if 'blob' in t or 'binary' in t:
+        return 'BLOB'
+    if 'int' in t:
+        return 'INTEGER'
+    if t.startswith('float') or t.startswith('double') or t.startswith('decimal') or t.startswith('real'):
+        return 'REAL'
+    return 'TEXT COLLATE NOCASE'
+
+
+def keyColumns(text):
+    """ `chrom`(8),`bin` -> ['chrom', 'bin'] """
+    return [re.sub(r'\(\d+\)', '', c).strip().strip('`') for c in text.split(',')]
+
+
+def parseCreateTable(ddl):
+    """ Parses a MySQL CREATE TABLE into (table, [(column, sqlite type)], [key columns]) """
+    table = re.search(r'CREATE TABLE\s+(?:IF NOT EXISTS\s+)?`?(\w+)`?', ddl, re.IGNORECASE).group(1)
+    columns = []
+    keys = []
+    body = ddl[ddl.index('(') + 1:ddl.rindex(')')]
+    for line in body.split('\n'):
+        line = line.strip().rstrip(',')
+        if line.startswith('`'):
+            name = line[1:line.index('`', 1)]
+            mysql_type = line[line.index('`', 1) + 1:].split()[0]
+            columns.append((name, sqliteType(mysql_type)))
+        else:
+            key = re.match(r'(?:PRIMARY |UNIQUE |FULLTEXT )?(?:KEY|INDEX)\s*(?:`\w+`)?\s*\((.*)\)', line, re.IGNORECASE)
+            if key is not None:
+                keys.append(keyColumns(key.group(1)))
+    return (table, columns, keys)
+
+
+def defaultIndexes(table, names):
+    """ Composite index on the coordinates the annotators query by """
+    if table in INDEXES:
+        return INDEXES[table]
+    lower = [n.lower() for n in names]
+    if 'chromstart' in lower and 'chromend' in lower:
+        start = names[lower.index('chromstart')]
+        end = names[lower.index('chromend')]
+        if 'chrom' in lower:
+            return [(names[lower.index('chrom')], start, end)]
+        # one table per chromosome, like tfbsConsSites
+        return [(start, end)]
+    return []
+
+
+def createTable(conn, table, columns, keys):
+    conn.execute('DROP TABLE IF EXISTS "' + table + '"')
+    conn.execute('CREATE TABLE "' + table + '" (' + ', '.join(['"' + n + '" ' + t for n, t in columns]) + ')')
+
+    names = [n for n, t in columns]
+    # column names are case-insensitive, as in MySQL
+    byLower = dict([(n.lower(), n) for n in names])
+    indexes = []
+    for key in list(defaultIndexes(table, names)) + keys:
+        if all([k.lower() in byLower for k in key]):
+            key = tuple([byLower[k.lower()] for k in key])
+            if key not in indexes:
+                indexes.append(key)
+    for i in range(0, len(indexes)):
+        conn.execute('CREATE INDEX "' + table + '_' + str(i) + '" ON "' + table + '" (' + ', '.join(['"' + k + '"' for k in indexes[i]]) + ')')
+
+
+def unescape(value):
+    """ mysqldump --tab escaping: \\N is NULL, backslash escapes tab, newline and backslash """
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0'}.get(m.group(1), m.group(1)), value)
+
+
+def readRows(path, columns):
+    blobs = [i for i in range(0, len(columns)) if columns[i][1] == 'BLOB']
+    if path.endswith('.gz'):
+        fh = gzip.open(path, 'rt')
+    else:
+        fh = open(path)
+    for line in fh:
+        line = line.rstrip('\n')
+        if len(line) == 0:
+            continue
+        row = [unescape(v) for v in line.split('\t')]
+        for i in blobs:
+            if row[i] is not None:
+                row[i] = row[i].encode('utf-8')
+        yield row
+    fh.close()
+
+
+def insertRows(conn, table, columns, rows, batch=10000):
+    sql = 'INSERT INTO "' + table + '" VALUES (' + ','.join(['?'] * len(columns)) + ')'
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == batch:
+            conn.executemany(sql, chunk)
+            count = count + len(chunk)
+            chunk = []
+    conn.executemany(sql, chunk)
+    return count + len(chunk)
+
+
+def loadDump(db, schema, data):
+    """ Loads table.sql + table.txt[.gz] into the database """
+    conn = connect(db, readonly=False)
+    table, columns, keys = parseCreateTable(open(schema).read())
+    createTable(conn, table, columns, keys)
+    count = insertRows(conn, table, columns, readRows(data, columns))
+    conn.commit()
+    conn.close()
+    print ("Loaded " + str(count) + " rows into " + table)
+
+
+def copyTable(db, table):
+    """ Copies a table from the MySQL server of config.txt """
+    import pymysql
+    import sql_config
+
+    # straight to the server, not through sql_config.conn2annotator(): with
+    # ANNTOOLS_SQLITE_DB set that would read the SQLite database back
+    mysql = pymysql.connect (host = sql_config.host, user = sql_config.user, passwd = sql_config.passwd,
+                             db = sql_config.db, port = sql_config.port)
+    cursor = mysql.cursor ()
+    cursor.execute ('SHOW CREATE TABLE `' + table + '`')
+    name, columns, keys = parseCreateTable(cursor.fetchone ()[1])
+    cursor.close()
+    conn = connect(db, readonly=False)
+    createTable(conn, table, columns, keys)
+
+    # rows read from the server as they are inserted
+    cursor = mysql.cursor (pymysql.cursors.SSCursor)
+    cursor.execute ('select * from `' + table + '`')
+    rows = iter(lambda: cursor.fetchmany (10000), [])
+    count = 0
+    for chunk in rows:
+        count = count + insertRows(conn, table, columns, chunk)
+    conn.commit()
+    cursor.close()
+    mysql.close()
+    conn.close()
+    print ("Copied " + str(count) + " rows of " + table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the local SQLite annotation database')
+    commands = parser.add_subparsers(dest='command')
+    load = commands.add_parser('load', help='load a mysqldump --tab / UCSC table dump')
+    load.add_argument('db')
+    load.add_argument('schema', help='table.sql with the CREATE TABLE statement')
+    load.add_argument('data', help='table.txt or table.txt.gz with tab separated rows')
+    copy = commands.add_parser('copy', help='copy tables from the MySQL server of config.txt')
+    copy.add_argument('db')
+    copy.add_argument('tables', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        loadDump(args.db, args.schema, args.data)
+    elif args.command == 'copy':
+        for table in args.tables:
+            copyTable(args.db, table)
+    else:
+        parser.print_help()
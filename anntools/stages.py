@@ -0,0 +1,1182 @@
+#!/usr/bin/env python
+
+""" Annotators of annotate.py split into per-record stages.
+
+    Every stage has a lookup() that queries the database for one variant and
+    an apply() that edits the record with the lookup result. Lookups only
+    depend on the variant (chrom, pos, ref, alt), never on what earlier stages
+    wrote into INFO, so they can be computed in any order; apply() has to run
+    in pipeline order. Counters are kept per stage and written to count.log
+    by report(), in the same words as the annotate.py functions.
+"""
+
+import asyncio
+import collections
+import os
+import time
+from collections import Counter
+
+import annotate as ann
+import sql_config
+import ucsc_bin as ub
+import utils as u
+import columnar
+from columnar import ColumnarTable, VariantBatch
+from dbsnp_bloom import BloomFilter
+from gene_models import GeneModels, Transcript
+from interval_index import IntervalIndex, TableIndex
+from planner import BATCHED, BULK, Planner
+from snapshot import Snapshot, export, snapshotPath
+from sweep import SweepJoin
+
+
+""" (chrom, pos, ref, alt) of a record, as every annotator reads them """
+def variantOf(fields, inds):
+    chr=fields[inds[0]].strip()
+    pos=fields[inds[1]].strip()
+    ref=ann.clean_shit(fields[inds[2]]).strip()
+    alt=ann.clean_shit(fields[inds[3]]).strip()
+    return (chr, pos, ref, alt)
+
+
+def withChr(chr):
+    if(chr.startswith("chr")==False):
+        chr = "chr" + chr
+    return chr
+
+
+def withoutChr(chr):
+    if(chr.startswith("chr")==True):
+        chr = chr.replace('chr', '')
+    return chr
+
+
+""" Appends to INFO unless it already ends with a separator """
+def appendInfo(fields, text):
+    if str(fields[7]).endswith(';')==True:
+        fields[7]=fields[7]+text
+    else:
+        fields[7]=fields[7]+';'+text
+
+
+""" OR of the SQL terms nested as a balanced tree, as SQLite limits the
+    depth of an expression to 1000 """
+def orTree(terms):
+    if len(terms) == 1:
+        return terms[0]
+    half = len(terms) // 2
+    return '(' + orTree(terms[:half]) + ' OR ' + orTree(terms[half:]) + ')'
+
+
+# TableIndex by query, shared by the stages of a job reading the same table;
+# run.runJob empties it after every job
+shared_indexes = {}
+
+
+def sharedIndex(sql, start='chromStart', end='chromEnd'):
+    if sql not in shared_indexes:
+        shared_indexes[sql] = TableIndex(sql, start=start, end=end)
+    return shared_indexes[sql]
+
+
+class Stage(object):
+    """ Base class of the pipeline stages """
+
+    # annotate.py function the stage reproduces
+    function = None
+    # how that function opens count.log (None: it does not write to it)
+    log_mode = 'a'
+    # queries lookupBatch() packs in one execute() where it can (see sql_config.fetchSets)
+    multi_statements = 0
+
+    def __init__(self, table):
+        self.table = table
+        self.counts = Counter()
+
+    def lookup(self, cursor, variant):
+        raise NotImplementedError
+
+    def lookupBatch(self, cursor, variants):
+        return [self.lookup(cursor, v) for v in variants]
+
+    def packable(self, variants):
+        """ Whether the queries of variants can go several per execute()
+            (see sql_config.packable) """
+        return all([sql_config.packable(v) for v in variants])
+
+    async def lookupAsync(self, db, variant):
+        """ lookup() with its queries awaited on db, an async_pipeline.AsyncDatabase """
+        raise NotImplementedError
+
+    async def gatherLookups(self, db, variants):
+        return list(await asyncio.gather(*[self.lookupAsync(db, v) for v in variants]))
+
+    async def lookupBatchAsync(self, db, variants):
+        """ lookupBatch() for async_pipeline.py. By default it runs on a thread
+            of db, one block at a time; stages with a lookupAsync() override
+            this to keep their queries in flight together """
+        async with db.lock(self):
+            return await db.call(self.lookupBatch, variants)
+
+    def apply(self, fields, result):
+        raise NotImplementedError
+
+    def report(self, fh_log):
+        pass
+
+    def close(self):
+        pass
+
+
+class DbSnpStage(Stage):
+    """ getSnpsFromDbSnp: rsIDs and GMAF of SNVs.
+        With a bloom filter (dbsnp_bloom.BloomFilter) the positions it rules
+        out are not queried """
+
+    function = 'getSnpsFromDbSnp'
+    log_mode = 'w'
+
+    def __init__(self, table='dbSNP', varclass='SNV', batched=False, bloom=None):
+        Stage.__init__(self, table)
+        self.varclass = varclass
+        self.batched = batched
+        self.bloom = bloom
+
+    def mightContain(self, variant):
+        return self.bloom is None or self.bloom.mightContain(withoutChr(variant[0]), variant[1])
+
+    def dbSnpVariant(self, variant):
+        chr, pos, ref, alt = variant
+        return (withoutChr(chr), pos, ref, ann.getComplementary(ref))
+
+    def compact(self, rows):
+        return [(str(row[3]), str(row[7])) for row in rows]
+
+    def lookupSql(self, variant):
+        chr, pos, ref, compRef = self.dbSnpVariant(variant)
+        return 'select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( REF="'+ str(ref) + '" OR REF ="'+ str(compRef)+'" )  AND INFO = "'+self.varclass+'" ;'
+
+    def lookup(self, cursor, variant):
+        if not self.mightContain(variant):
+            return []
+        cursor.execute (self.lookupSql(variant))
+        return self.compact(cursor.fetchall ())
+
+    async def lookupAsync(self, db, variant):
+        if not self.mightContain(variant):
+            return []
+        return self.compact(await db.fetchall(self.lookupSql(variant)))
+
+    async def lookupBatchAsync(self, db, variants):
+        if self.batched == False:
+            return await self.gatherLookups(db, variants)
+        return await Stage.lookupBatchAsync(self, db, variants)
+
+    def lookupBatch(self, cursor, variants):
+        if self.batched == False:
+            return Stage.lookupBatch(self, cursor, variants)
+        found = ann.lookupSnpsFromDbSnp(cursor, [self.dbSnpVariant(v) for v in variants], varclass=self.varclass,
+                                        bloom=self.bloom)
+        return [self.compact(rows) for rows in found]
+
+    def apply(self, fields, result):
+        self.counts['lines'] += 1
+        fields[2]='.'
+        if len(result) == 0:
+            return
+
+        rsids=[]
+        mafs=[]
+        for rsid, maf in result:
+            rsids.append(rsid)
+            if maf !='.':
+                mafs.append('GMAF='+maf)
+
+        maf_str=''
+        if len(mafs)>0:
+            maf_str=';'+';'.join(mafs)
+
+        self.counts['found'] += 1
+        if str(fields[7])=='.':
+            fields[7]='DB'+maf_str
+        else:
+            fields[7]=fields[7]+';DB;VC='+self.varclass + maf_str
+
+        fields[2]=str(';'.join(rsids))
+
+    def report(self, fh_log):
+        linenum = self.counts['lines'] + 1
+        var_count = self.counts['found']
+        ratioInDbSnp = (var_count/float(linenum))*100
+        fh_log.write("## Please notice that all Isoforms were counted "+'\n')
+        fh_log.write("## Numbers may exceed number of variants in the annotated file"+'\n')
+        fh_log.write("Total: " +str(linenum) +'\n')
+        fh_log.write("In dbSNP: " +str(var_count) + " (" + str(ratioInDbSnp) + "%)" +'\n')
+
+    def close(self):
+        if self.bloom is not None:
+            # lookups of this process only
+            if self.bloom.checked > 0:
+                print (self.bloom.summary())
+            self.bloom.close()
+
+
+class DbSnpIndelStage(DbSnpStage):
+    """ getIndelsFromDbSnp: rsIDs and variant classes of everything but SNVs """
+
+    function = 'getIndelsFromDbSnp'
+
+    def lookupSql(self, variant):
+        chr, pos, ref, alt = variant
+        return 'select * from dbSNP where CHR="'+ str(withoutChr(chr)) + '" AND POS=' + str(pos)  + ' AND INFO != "'+self.varclass+'" ;'
+
+    def compact(self, rows):
+        return [(str(row[3]), str(row[6])) for row in rows]
+
+    def lookupBatch(self, cursor, variants):
+        return Stage.lookupBatch(self, cursor, variants)
+
+    async def lookupBatchAsync(self, db, variants):
+        return await self.gatherLookups(db, variants)
+
+    def apply(self, fields, result):
+        self.counts['lines'] += 1
+        fields[2]='.'
+        if len(result) == 0:
+            return
+
+        rsids=[rsid for rsid, vc in result]
+        vcs=[vc for rsid, vc in result]
+
+        self.counts['found'] += 1
+        if str(fields[7])=='.':
+            fields[7]='DB;VC='+str(';'.join(u.dedup(vcs)))
+        else:
+            fields[7]=fields[7]+';DB;VC='+str(';'.join(u.dedup(vcs)))
+
+        fields[2]=str(';'.join(rsids))
+
+
+class BigRefGeneStage(Stage):
+    """ getBigRefGene: first of chrom_pos_equal_base, chrom_pos_equal_nobase
+        and chrom_pos_unequal that knows the position """
+
+    function = 'getBigRefGene'
+    log_mode = None
+
+    # the three tables, in the order they are tried
+    tiers = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase', 'chrom_pos_unequal']
+
+    def __init__(self, table='bigRefGene', batched=False):
+        Stage.__init__(self, table)
+        self.batched = batched
+
+    def tierQueries(self, variant):
+        chr, pos, ref, alt = variant
+        chr = withoutChr(chr)
+        compRef=ann.getComplementary(ref)
+        compAlt=ann.getComplementary(alt)
+
+        sql1='select * from chrom_pos_equal_base where CHR="'+ str(chr) + '" AND start = ' + str(pos) + ' AND ((haplotypeReference="'+ str(ref) + '" AND haplotypeAlternate ="'+ str(alt)+'") OR (haplotypeReference="'+ str(compRef) + '" AND haplotypeAlternate ="'+ str(compAlt)+'"));'
+        sql2='select * from chrom_pos_equal_nobase where CHR="'+ str(chr) + '" AND start = ' + str(pos) + ';'
+        sql3='select * from chrom_pos_unequal where CHR="'+ str(chr) + '" AND start <= ' + str(pos) + ' AND ' + str(pos) + ' <= end ;'
+        return [sql1, sql2, sql3]
+
+    def collapse(self, rows):
+        """ All isoforms are collapsed in one record """
+        m=set([])
+        for row in rows:
+            m.add(ann.collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+        return ';'.join(m)
+
+    def lookup(self, cursor, variant):
+        for sql in self.tierQueries(variant):
+            cursor.execute (sql)
+            rows = cursor.fetchall ()
+            if len(rows) > 0:
+                return self.collapse(rows)
+        return None
+
+    async def lookupAsync(self, db, variant):
+        for sql in self.tierQueries(variant):
+            rows = await db.fetchall(sql)
+            if len(rows) > 0:
+                return self.collapse(rows)
+        return None
+
+    async def lookupBatchAsync(self, db, variants):
+        if self.batched == False:
+            return await self.gatherLookups(db, variants)
+        return await Stage.lookupBatchAsync(self, db, variants)
+
+    def batchQuery(self, variants):
+        """ One query returning the rows of all three tables for the variants,
+            each one preceded by the number of its table. The tables share
+            the layout collapseRefSeq reads """
+        positions = {}
+        for chr, pos, ref, alt in variants:
+            positions.setdefault(withoutChr(chr).upper(), set()).add(int(pos))
+
+        equal = []
+        unequal = []
+        for chr in sorted(positions.keys()):
+            inlist = ','.join([str(x) for x in sorted(positions[chr])])
+            equal.append('(CHR="' + str(chr) + '" AND start IN (' + inlist + '))')
+            ranges = ['(start <= ' + str(x) + ' AND ' + str(x) + ' <= end)' for x in sorted(positions[chr])]
+            unequal.append('(CHR="' + str(chr) + '" AND ' + orTree(ranges) + ')')
+
+        selects = []
+        for t in range(0, len(self.tiers)):
+            where = equal
+            if t == 2:
+                where = unequal
+            selects.append('select ' + str(t) + ' as tier, ' + self.tiers[t] + '.* from ' + self.tiers[t]
+                           + ' where ' + ' OR '.join(where))
+        return ' UNION ALL '.join(selects) + ';'
+
+    def multiLookups(self, cursor, variants):
+        """ lookup() of every variant, the queries of a table sent
+            multi_statements at a time, then those of the next table for the
+            variants still unknown """
+        queries = [self.tierQueries(variant) for variant in variants]
+        results = [None] * len(variants)
+        todo = range(0, len(variants))
+        for t in range(0, len(self.tiers)):
+            unknown = []
+            for v, rows in zip(todo, sql_config.fetchSets(cursor, [queries[v][t] for v in todo], self.multi_statements)):
+                if len(rows) > 0:
+                    results[v] = self.collapse(rows)
+                else:
+                    unknown.append(v)
+            todo = unknown
+        return results
+
+    def lookupBatch(self, cursor, variants):
+        """ lookup() of every variant from one round trip: the rows of the
+            first table knowing the variant win, as with the queries in turn """
+        if self.batched == False and self.multi_statements > 0 and self.packable(variants):
+            return self.multiLookups(cursor, variants)
+        if self.batched == False or len(variants) == 0:
+            return Stage.lookupBatch(self, cursor, variants)
+
+        cursor.execute (self.batchQuery(variants))
+        columns = [str(d[0]).lower() for d in cursor.description]
+        chr_col = columns.index('chr')
+        start_col = columns.index('start')
+        end_col = columns.index('end')
+        ref_col = columns.index('haplotypereference')
+        alt_col = columns.index('haplotypealternate')
+
+        atPosition = [{}, {}]
+        ranges = {}
+        for row in cursor.fetchall ():
+            tier = int(row[0])
+            chr = str(row[chr_col]).upper()
+            if tier < 2:
+                atPosition[tier].setdefault((chr, int(row[start_col])), []).append(row)
+            else:
+                ranges.setdefault(chr, []).append((int(row[start_col]), int(row[end_col]), row))
+        ranges = dict([(chr, IntervalIndex(rows)) for chr, rows in ranges.items()])
+
+        results = []
+        for chr, pos, ref, alt in variants:
+            chr = withoutChr(chr).upper()
+            pos = int(pos)
+            alleles = [(str(ref).upper(), str(alt).upper()),
+                       (ann.getComplementary(ref).upper(), ann.getComplementary(alt).upper())]
+            rows = [row for row in atPosition[0].get((chr, pos), [])
+                    if (str(row[ref_col]).upper(), str(row[alt_col]).upper()) in alleles]
+            if len(rows) == 0:
+                rows = atPosition[1].get((chr, pos), [])
+            if len(rows) == 0 and chr in ranges:
+                rows = ranges[chr].query(pos)
+            if len(rows) == 0:
+                results.append(None)
+            else:
+                # without the tier number, the rows are those of the table
+                results.append(self.collapse([row[1:] for row in rows]))
+        return results
+
+    def apply(self, fields, result):
+        if result is None:
+            return
+        fields[7]=fields[7]+';'+result
+        if str(fields[7]).startswith(".;"):
+            fields[7] = str(fields[7]).replace('.;', '', 1)
+
+
+class GenesStage(Stage):
+    """ getGenes: exons, non coding exons and putative promoters of refGene transcripts """
+
+    function = 'getGenes'
+
+    # GeneModels of the table after useModels()
+    models = None
+    # TableIndex of cpgIslandExt after useCpgIndex()
+    cpg_index = None
+
+    def __init__(self, table='refGene', promoter_offset=500):
+        Stage.__init__(self, table)
+        self.promoter_offset = promoter_offset
+
+    def useModels(self):
+        self.models = GeneModels(self.table, promoter_offset=self.promoter_offset)
+
+    def transcriptSql(self, cursor, chr, pos):
+        sql='select * from ' + self.table + ' where chrom="'+ str(chr) + '"   AND (txStart - ' + str(self.promoter_offset) +') <= ' + str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + str(self.promoter_offset) +');'
+        return ub.addBins(cursor, self.table, sql, pos, self.promoter_offset)
+
+    def transcripts(self, cursor, chr, pos, prefetched=None):
+        """ prefetched: (transcripts, CpG island rows) by position, fetched
+            by multiLookups() """
+        if self.models is not None:
+            return self.models.query(cursor, chr, pos)
+        if prefetched is not None and (chr, pos) in prefetched[0]:
+            return prefetched[0][(chr, pos)]
+        cursor.execute (self.transcriptSql(cursor, chr, pos))
+        return cursor.fetchall ()
+
+    def useCpgIndex(self):
+        self.cpg_index = sharedIndex('select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="%s";')
+
+    def cpgIsland(self, cursor, chr, pos, prefetched=None):
+        """ name of the first CpG island at the position, or None """
+        if self.cpg_index is not None:
+            row = self.cpg_index.first(cursor, chr, pos)
+        elif prefetched is not None and (chr, pos) in prefetched[1]:
+            rows = prefetched[1][(chr, pos)]
+            row = rows[0] if len(rows) > 0 else None
+        else:
+            cursor.execute (self.cpgSql(cursor, chr, pos))
+            row = cursor.fetchone ()
+        island = None
+        if row is not None:
+            island = "".join(str(row[3]).split())
+        return island
+
+    def cpgSql(self, cursor, chr, pos):
+        sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+        return ub.addBins(cursor, 'cpgIslandExt', sql, pos)
+
+    def exonHits(self, pos, row):
+        """ 0-based numbers of the exons of the transcript that hold the position """
+        if isinstance(row, Transcript):
+            return row.exonHits(pos)
+        exonCount = int(row[8])
+        exonsSt=str(row[9].decode("utf-8")).split(',')
+        exonsEn=str(row[10].decode("utf-8")).split(',')
+        hits=[]
+        for e in range(0, exonCount):
+            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]) ):
+                hits.append(e)
+        return hits
+
+    def exonName(self, e, row):
+        exonCount = int(row[8])
+        exnum=e+1
+        if str(row[3]) == '-':
+            exnum =  exonCount - e
+        return "ex"+str(exnum) +'/'+str(exonCount)
+
+    def nearPromoter(self, pos, row):
+        """ Whether pos is within promoter_offset in front of the transcript """
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        strand = str(row[3])
+        if u.isBetween(pos, txtStart - int(self.promoter_offset), txtStart) and strand=="+":
+            return True
+        return u.isBetween(pos, txtEnd, txtEnd + int(self.promoter_offset)) and strand=="-"
+
+    def promoter(self, cursor, chr, pos, row, islands, prefetched=None):
+        """ CpG island in front of the transcript, or None. The transcripts
+            of a variant all ask for the same position: islands, a dict of
+            the lookup of the variant, keeps the answer """
+        if self.nearPromoter(pos, row):
+            if (chr, pos) not in islands:
+                islands[(chr, pos)] = self.cpgIsland(cursor, chr, pos, prefetched)
+            return islands[(chr, pos)]
+        return None
+
+    def lookupBatch(self, cursor, variants):
+        if self.multi_statements > 0 and self.models is None and self.packable(variants):
+            return self.multiLookups(cursor, variants)
+        return Stage.lookupBatch(self, cursor, variants)
+
+    def multiLookups(self, cursor, variants):
+        """ lookup() of every variant with the queries sent multi_statements
+            at a time: the transcripts of all positions, then the CpG islands
+            of the positions in front of one of their transcripts """
+        # distinct positions, in order
+        keys = list(collections.OrderedDict([((withChr(v[0]), v[1]), True) for v in variants]).keys())
+        queries = [self.transcriptSql(cursor, chr, pos) for chr, pos in keys]
+        transcripts = dict(zip(keys, sql_config.fetchSets(cursor, queries, self.multi_statements)))
+
+        islands = {}
+        if self.cpg_index is None:
+            near = collections.OrderedDict()
+            for chr, pos in keys:
+                if any([self.nearPromoter(int(pos), row) for row in transcripts[(chr, pos)]]):
+                    near[(chr, int(pos))] = True
+            near = list(near.keys())
+            queries = [self.cpgSql(cursor, chr, pos) for chr, pos in near]
+            islands = dict(zip(near, sql_config.fetchSets(cursor, queries, self.multi_statements)))
+
+        prefetched = (transcripts, islands)
+        return [self.lookup(cursor, variant, prefetched) for variant in variants]
+
+    def lookup(self, cursor, variant, prefetched=None):
+        """ Returns (number of transcripts, INFO entries, exonic hits, promoter hits) """
+        chr = withChr(variant[0])
+        rows = self.transcripts(cursor, chr, variant[1], prefetched)
+        pos = int(variant[1])
+        islands = {}
+        info=[]
+        exonic=0
+        promoters=0
+        cnt=1
+        for row in rows:
+            cdsStart = int(row[6])
+            cdsEnd = int(row[7])
+            region=''
+
+            if cdsStart == cdsEnd:
+                exons=["non_coding_exon="+self.exonName(e, row) for e in self.exonHits(pos, row)]
+                region=";".join(exons)
+
+            elif u.isBetween(pos, cdsStart, cdsEnd):
+                exons=["exon="+self.exonName(e, row) for e in self.exonHits(pos, row)]
+                exonic=exonic+len(exons)
+                region=";".join(exons)
+
+            else:
+                island = self.promoter(cursor, chr, pos, row, islands, prefetched)
+                if island is not None:
+                    region='putativePromoterRegion='+ island
+                    promoters=promoters+1
+
+            if region != '':
+                info.append(ann.collapseGeneNames(row=row, indices=ann.indicesKnownGenes, region=region, cnt=cnt) )
+            cnt=cnt+1
+
+        return (len(rows), info, exonic, promoters)
+
+    def apply(self, fields, result):
+        transcripts, info, exonic, promoters = result
+        if transcripts == 0:
+            fields[7]=fields[7]+";positionType=interGenic"
+            self.counts['interGenic'] += 1
+            return
+
+        # location comes from getBigRefGene, counted once per transcript
+        info_field = ann.clean_shit(fields[7]).strip()
+        positionType=str(u.parse_field(info_field, 'positionType',';','='))
+        if positionType in ('intron', 'non_coding_intron', 'CDS', 'non_coding_exon', 'utr5', 'utr3'):
+            self.counts[positionType] += transcripts
+        self.counts['exonic'] += exonic
+        self.counts['promoter'] += promoters
+
+        fields[7]=fields[7]+';' +";".join(info)
+
+    # getExonsEtAl prints this one without "In"
+    utr3_print = "In \'3 UTR "
+
+    def report(self, fh_log):
+        c = self.counts
+        print ("Variants located: ")
+        fh_log.write("Variants located: "+'\n')
+        lines = [("In interGenic ", c['interGenic']),
+                 ("In CDS ", c['CDS']),
+                 ("In \'3 UTR ", c['utr3']),
+                 ("In \'5 UTR ", c['utr5']),
+                 ("In Intronic ", c['intron']),
+                 ("In Non_coding_intronic ", c['non_coding_intron']),
+                 ("In Exonic ", c['exonic']),
+                 ("In Non_coding_exonic ", c['non_coding_exon']),
+                 ("In Putative Promoter Region ", c['promoter'])]
+        for text, count in lines:
+            if text == "In \'3 UTR ":
+                print (self.utr3_print + str(count))
+            else:
+                print (text + str(count))
+            fh_log.write(text + str(count) +'\n')
+
+
+class ExonsEtAlStage(GenesStage):
+    """ getExonsEtAl: full location in the gene structure, for INDELS """
+
+    function = 'getExonsEtAl'
+    utr3_print = "\'3 UTR "
+
+    def lookup(self, cursor, variant, prefetched=None):
+        """ Returns (number of transcripts, INFO entries, Counter of locations) """
+        chr = withChr(variant[0])
+        rows = self.transcripts(cursor, chr, variant[1], prefetched)
+        pos = int(variant[1])
+        islands = {}
+        info=[]
+        counts=Counter()
+        cnt=1
+        for row in rows:
+            txtStart = int(row[4])
+            txtEnd = int(row[5])
+            cdsStart = int(row[6])
+            cdsEnd = int(row[7])
+            strand = str(row[3])
+            region=''
+
+            if cdsStart == cdsEnd:
+                exons=["non_coding_exon="+self.exonName(e, row) for e in self.exonHits(pos, row)]
+                counts['non_coding_exon'] += len(exons)
+                if len(exons)>0:
+                    region='positionType=non_coding_exon;'+";".join(exons)
+                else:
+                    counts['non_coding_intron'] += 1
+                    region='positionType=non_coding_intron'
+
+            elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                counts['CDS'] += 1
+                exons=["exon="+self.exonName(e, row) for e in self.exonHits(pos, row)]
+                counts['exonic'] += len(exons)
+                if len(exons)>0:
+                    region= 'positionType=CDS;'+";".join(exons)
+                else:
+                    counts['intron'] += 1
+                    region='positionType=CDS;'+'intron'
+
+            elif u.isBetween(pos, txtStart, cdsStart) and (cdsStart < cdsEnd) and strand=="+":
+                counts['utr5'] += 1
+                region='positionType=utr5'
+
+            elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd) and strand=="+":
+                counts['utr3'] += 1
+                region='positionType=utr3'
+
+            elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd) and strand=="-":
+                counts['utr5'] += 1
+                region='positionType=utr5'
+
+            elif u.isBetween(pos, txtStart, cdsStart) and (cdsStart < cdsEnd) and strand=="-":
+                counts['utr3'] += 1
+                region='positionType=utr3'
+
+            else:
+                island = self.promoter(cursor, chr, pos, row, islands, prefetched)
+                if island is not None:
+                    region='putativePromoterRegion='+ island
+                    counts['promoter'] += 1
+
+            if region != '':
+                info.append(ann.collapseGeneNames(row=row, indices=ann.indicesKnownGenes, region=region, cnt=cnt) )
+            cnt=cnt+1
+
+        return (len(rows), info, counts)
+
+    def apply(self, fields, result):
+        transcripts, info, counts = result
+        if transcripts == 0:
+            fields[7]=fields[7]+";positionType=interGenic"
+            self.counts['interGenic'] += 1
+            return
+
+        self.counts.update(counts)
+        fields[7]=fields[7]+';' +";".join(info)
+
+
+class OverlapStage(Stage):
+    """ Base class of the addOverlapWith* annotators.
+        rows() returns what the SQL query returns; with fetch_one only the first row.
+        After useIndex() the rows come from an in-memory IntervalIndex of the
+        table instead of one query per variant. After useSweep() they come from
+        a merge join with the table as long as the input is sorted. After
+        useColumnar() lookupBatch() joins the positions of a whole block with
+        the table at once (NumPy). After useSnapshot() they are read from a
+        memory-mapped snapshot of the table (see snapshot.py) """
+
+    fetch_one = False
+    label = None
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+    index = None
+    sweep = None
+    columnar = None
+    snapshot = None
+    # planner.Planner choosing the lookups of each chromosome, and the
+    # TableIndex of its bulk strategy
+    planner = None
+    bulk = None
+
+    def chrom(self, chr):
+        return withChr(chr)
+
+    def queryable(self, chr):
+        """ Whether the table can hold rows of chr """
+        return True
+
+    def sql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+
+    def queryTable(self, chr):
+        """ Table sql() reads """
+        return self.table
+
+    def indexSql(self):
+        """ Rows of one chromosome, %s is the chromosome """
+        return 'select * from ' + self.table + ' where ' + self.chromName + '="%s";'
+
+    def useIndex(self):
+        self.index = TableIndex(self.indexSql(), start=self.startName, end=self.endName)
+
+    def useSweep(self):
+        self.sweep = SweepJoin(self.table, sharedIndex(self.indexSql(), start=self.startName, end=self.endName),
+                               chrom=self.chromName, start=self.startName, end=self.endName)
+
+    def useColumnar(self):
+        self.columnar = ColumnarTable(self.indexSql(), start=self.startName, end=self.endName)
+
+    def useSnapshot(self, path):
+        snapshot = Snapshot(path)
+        if (snapshot.start, snapshot.end) != (self.startName, self.endName):
+            snapshot.close()
+            raise ValueError(path + ' holds ' + snapshot.start + '-' + snapshot.end + ' intervals, not '
+                             + self.startName + '-' + self.endName)
+        self.snapshot = snapshot
+
+    def snapshotChroms(self, cursor):
+        """ Chromosomes exportSnapshot() reads with indexSql() """
+        cursor.execute ('select distinct ' + self.chromName + ' from ' + self.table + ';')
+        return [str(row[0]) for row in cursor.fetchall ()]
+
+    def exportSnapshot(self, cursor, path):
+        export(cursor, path, self.table, self.indexSql(), self.snapshotChroms(cursor), start=self.startName,
+               end=self.endName)
+
+    def rows(self, cursor, chr, pos):
+        if self.sweep is not None:
+            rows = self.sweep.query(chr, pos)
+            if rows is not None:
+                if self.fetch_one:
+                    return rows[:1]
+                return rows
+
+        if self.snapshot is not None:
+            if self.fetch_one:
+                row = self.snapshot.first(chr, pos)
+                if row is None:
+                    return []
+                return [row]
+            return self.snapshot.query(chr, pos)
+
+        if self.index is not None:
+            return self.indexRows(self.index, cursor, chr, pos)
+
+        cursor.execute (ub.addBins(cursor, self.queryTable(chr), self.sql(chr, pos), pos))
+        if self.fetch_one:
+            row = cursor.fetchone ()
+            if row is None:
+                return []
+            return [row]
+        return cursor.fetchall ()
+
+    def indexRows(self, index, cursor, chr, pos):
+        if self.fetch_one:
+            row = index.first(cursor, chr, pos)
+            if row is None:
+                return []
+            return [row]
+        return index.query(cursor, chr, pos)
+
+    def close(self):
+        if self.sweep is not None:
+            self.sweep.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+        if self.planner is not None and len(self.planner.summary(self.table)) > 0:
+            print (self.planner.summary(self.table))
+
+    def summarize(self, rows):
+        """ INFO text written for the rows, computed once at lookup time """
+        raise NotImplementedError
+
+    def lookup(self, cursor, variant):
+        rows = self.rows(cursor, self.chrom(variant[0]), variant[1])
+        if len(rows) == 0:
+            return None
+        return (len(rows), self.summarize(rows))
+
+    async def lookupAsync(self, db, variant):
+        chr = self.chrom(variant[0])
+        pos = variant[1]
+        if not self.queryable(chr):
+            return None
+        rows = await db.fetchall(ub.addBins(db.cursor, self.queryTable(chr), self.sql(chr, pos), pos))
+        if self.fetch_one:
+            rows = rows[:1]
+        if len(rows) == 0:
+            return None
+        return (len(rows), self.summarize(rows))
+
+    async def lookupBatchAsync(self, db, variants):
+        # the rows come from memory, or the lookups the planner chose
+        if (self.sweep is not None or self.snapshot is not None or self.index is not None or self.columnar is not None
+                or self.planner is not None):
+            return await Stage.lookupBatchAsync(self, db, variants)
+        return await self.gatherLookups(db, variants)
+
+    def lookupBatch(self, cursor, variants):
+        if self.columnar is not None:
+            return self.columnarLookups(cursor, variants)
+        if self.sweep is None and self.snapshot is None and self.index is None:
+            if self.planner is not None:
+                return self.plannedLookups(cursor, variants)
+            if self.multi_statements > 0 and self.packable(variants):
+                return self.multiLookups(cursor, variants)
+        return Stage.lookupBatch(self, cursor, variants)
+
+    def plannedLookups(self, cursor, variants):
+        """ lookup() of every variant, the way the planner chose for its chromosome """
+        byChrom = collections.OrderedDict()
+        for v in range(0, len(variants)):
+            byChrom.setdefault(self.chrom(variants[v][0]), []).append(v)
+
+        results = [None] * len(variants)
+        for chr, inds in byChrom.items():
+            strategy = self.planner.strategy(cursor, self, chr)
+            subset = [variants[v] for v in inds]
+            started = time.time()
+            if strategy == BULK:
+                found = [self.bulkLookup(cursor, variant) for variant in subset]
+            elif strategy == BATCHED and self.packable(subset):
+                found = self.multiLookups(cursor, subset)
+            else:
+                found = Stage.lookupBatch(self, cursor, subset)
+            self.planner.record(self, chr, len(subset), time.time() - started)
+            for v, result in zip(inds, found):
+                results[v] = result
+        return results
+
+    def bulkLookup(self, cursor, variant):
+        if self.bulk is None:
+            self.bulk = TableIndex(self.indexSql(), start=self.startName, end=self.endName)
+        rows = self.indexRows(self.bulk, cursor, self.chrom(variant[0]), variant[1])
+        if len(rows) == 0:
+            return None
+        return (len(rows), self.summarize(rows))
+
+    def multiLookups(self, cursor, variants):
+        """ lookup() of every variant, the queries sent multi_statements at a time """
+        queries = []
+        asked = []
+        for v in range(0, len(variants)):
+            chr = self.chrom(variants[v][0])
+            pos = variants[v][1]
+            if self.queryable(chr):
+                queries.append(ub.addBins(cursor, self.queryTable(chr), self.sql(chr, pos), pos))
+                asked.append(v)
+        results = [None] * len(variants)
+        for v, rows in zip(asked, sql_config.fetchSets(cursor, queries, self.multi_statements)):
+            if self.fetch_one:
+                rows = rows[:1]
+            if len(rows) > 0:
+                results[v] = (len(rows), self.summarize(rows))
+        return results
+
+    def columnarLookups(self, cursor, variants):
+        results = [None] * len(variants)
+        if len(variants) == 0:
+            return results
+        batch = VariantBatch.fromVariants(variants)
+        for chrom, inds in batch.chromosomes():
+            chr = self.chrom(chrom)
+            if not self.queryable(chr):
+                continue
+            hits = self.columnar.join(cursor, chr, batch.positions[inds], first=self.fetch_one)
+            for i, rows in zip(inds.tolist(), hits):
+                if len(rows) > 0:
+                    results[i] = (len(rows), self.summarize(rows))
+        return results
+
+    def apply(self, fields, result):
+        if result is None:
+            return
+        count, text = result
+        self.counts['lines'] += 1
+        self.counts['rows'] += count
+        appendInfo(fields, text)
+
+    def report(self, fh_log):
+        label = self.label
+        if label is None:
+            label = str(self.table)
+        fh_log.write("In "+ label + ": " +str(self.counts['rows']) +' in ' + str(self.counts['lines']) + ' variants\n')
+
+
+class TfbsConsSitesStage(OverlapStage):
+    """ addOverlapWithTfbsConsSites: one table per chromosome """
+
+    function = 'addOverlapWithTfbsConsSites'
+
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','17','18','19','20','21','22','X','Y']
+
+    def __init__(self, table='tfbsConsSites'):
+        OverlapStage.__init__(self, table)
+
+    def chrom(self, chr):
+        # That is a special case - for some reason this table has no "chr" preceeding number
+        return withChr(chr).replace('chr', '')
+
+    def sql(self, chrIndex, pos):
+        ## chrom is not needed, as one table contains one chromosome
+        return 'select chrom, chromStart, chromEnd, name from tfbsConsSites' +chrIndex+ ' where  chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd;'
+
+    def queryTable(self, chrIndex):
+        return 'tfbsConsSites' + chrIndex
+
+    def indexSql(self):
+        return 'select chrom, chromStart, chromEnd, name from tfbsConsSites%s;'
+
+    def useSweep(self):
+        self.sweep = SweepJoin('tfbsConsSites%s', sharedIndex(self.indexSql()), columns='chrom, chromStart, chromEnd, name',
+                               chrom=None)
+
+    def queryable(self, chrIndex):
+        return chrIndex in self.allowed_chrom
+
+    def snapshotChroms(self, cursor):
+        chroms = []
+        for chrIndex in self.allowed_chrom:
+            try:
+                cursor.execute ('select * from tfbsConsSites' + chrIndex + ' limit 0;')
+            except Exception:
+                # not every chromosome has its table
+                continue
+            chroms.append(chrIndex)
+        return chroms
+
+    def rows(self, cursor, chrIndex, pos):
+        if not self.queryable(chrIndex):
+            return []
+        return OverlapStage.rows(self, cursor, chrIndex, pos)
+
+    def summarize(self, rows):
+        records=[]
+        for row in rows:
+            t=str(row[3])+'.'+str(row[0])+'.'+str(row[1])+'.'+str(row[2])
+            records.append('tfbsRegion'+'='+t.strip())
+        return ';'.join(records)
+
+
+class GadAllStage(OverlapStage):
+    """ addOverlapWithGadAll: genetic association database, chromosomes without "chr" """
+
+    function = 'addOverlapWithGadAll'
+    chromName = 'chromosome'
+
+    def __init__(self, table='gadAll'):
+        OverlapStage.__init__(self, table)
+
+    def chrom(self, chr):
+        if(chr.startswith("chr")==True):
+            chr = str(chr).replace("chr", "")
+        return chr
+
+    def sql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chromosome="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
+
+    def summarize(self, rows):
+        records=u.dedup([str(row[3]) for row in rows])
+        return ';'.join([str(self.table)+'='+r for r in records])
+
+
+class GwasCatalogStage(OverlapStage):
+    """ addOverlapWithGwasCatalog: GWAS hits ending at the position """
+
+    function = 'addOverlapWithGwasCatalog'
+    # hits end at the position
+    startName = 'chromEnd'
+
+    def __init__(self, table='gwasCatalog'):
+        OverlapStage.__init__(self, table)
+
+    def sql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="'+ str(chr) +  '" AND chromEnd = ' + str(pos) + ';'
+
+    def summarize(self, rows):
+        records=[str(self.table)+'='+str('pubMedID')+'='+str(row[5]) + ',trait='+str(row[10]) for row in rows]
+        return ';'.join(records)
+
+
+class HugoStage(OverlapStage):
+    """ addOverlapWitHUGOGeneNomenclature: HUGO Gene Nomenclature Committee (HGNC) """
+
+    function = 'addOverlapWitHUGOGeneNomenclature'
+
+    def __init__(self, table='hugo'):
+        OverlapStage.__init__(self, table)
+
+    def summarize(self, rows):
+        records=u.dedup([str(str(row[5]) +','+ str(row[6])).strip() for row in rows])
+        records=['HGNC_GeneAnnotation'+'='+t for t in records]
+        return ','.join(records).replace(';',',')
+
+
+class GenomicSuperDupsStage(OverlapStage):
+    """ addOverlapWithGenomicSuperDups: first segmental duplication at the position """
+
+    function = 'addOverlapWithGenomicSuperDups'
+    fetch_one = True
+
+    def __init__(self, table='genomicSuperDups'):
+        OverlapStage.__init__(self, table)
+
+    def summarize(self, rows):
+        row = rows[0]
+        return str(self.table)+'='+str(True)+';'+'otherChrom='+str(row[7])+';otherStart='+str(row[8])+';otherEnd='+str(row[9])
+
+    def apply(self, fields, result):
+        if result is None:
+            return
+        count, text = result
+        self.counts['lines'] += 1
+        self.counts['rows'] += count
+        fields[7]=fields[7]+';'+text
+
+
+class RefGeneStage(OverlapStage):
+    """ addOverlapWithRefGene: names of the transcripts at the position """
+
+    function = 'addOverlapWithRefGene'
+    startName = 'txStart'
+    endName = 'txEnd'
+
+    def __init__(self, table='refGene'):
+        OverlapStage.__init__(self, table)
+
+    def sql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="'+ str(chr) +  '" AND (txStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= txEnd);'
+
+    def summarize(self, rows):
+        return ';'.join(['name2='+str(row[12])+';name='+str(row[1]) for row in rows])
+
+
+class CytobandStage(OverlapStage):
+    """ addOverlapWithCytoband: cytogenetic bands (or gene names of a refGene table) """
+
+    function = 'addOverlapWithCytoband'
+
+    def __init__(self, table='cytoBand'):
+        OverlapStage.__init__(self, table)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+        if table == 'cytoBand':
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def sql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="'+ str(chr) +  '" AND (' + self.startName + ' <= ' + str(pos) + ' AND ' + str(pos) + ' <= ' + self.endName +');'
+
+    def summarize(self, rows):
+        overlapsWith=u.dedup([str(row[self.colindex]) for row in rows])
+        return str(self.table)+'='+';'.join(overlapsWith)
+
+
+class CnvStage(OverlapStage):
+    """ addOverlapWithCnvDatabase: flags variants in a CNV table """
+
+    function = 'addOverlapWithCnvDatabase'
+    fetch_one = True
+
+    def __init__(self, table='dgv_Cnv'):
+        OverlapStage.__init__(self, table)
+
+    def summarize(self, rows):
+        return str(self.table)+'='+str(True)
+
+
+class MiRNAStage(OverlapStage):
+    """ addOverlapWithMiRNA: first targetScanS miRNA site at the position """
+
+    function = 'addOverlapWithMiRNA'
+    fetch_one = True
+    label = 'miRNAsites'
+
+    def __init__(self, table='targetScanS'):
+        OverlapStage.__init__(self, table)
+
+    def summarize(self, rows):
+        row = rows[0]
+        t=str(row[4])+','+  str(row[1]) + '_'+  str(row[2])+ '_'+  str(row[3])
+        return 'miRNAsites='+t.strip()
+
+
+class PutativePromoterStage(OverlapStage):
+    """ addOverlapWithPutativePromoter: first putative promoter at the position """
+
+    function = 'addOverlapWithPutativePromoter'
+    fetch_one = True
+
+    def __init__(self, table='putativePromoter'):
+        OverlapStage.__init__(self, table)
+
+    def summarize(self, rows):
+        row = rows[0]
+        t=str(row[2]) +','+ str(row[1])+','+  str(row[4]) + ','+  str(row[7])
+        return 'putativePromoterRegion='+t.strip()
+
+
+""" Stages of driver.run, in the order they annotate.
+    Overlap stages of indexed_tables use an in-memory IntervalIndex,
+    with merge_join all overlap stages merge join sorted input with their table,
+    those of columnar_tables join whole blocks with their table (NumPy)
+    and dbsnp_bloom is the path of a dbsnp_bloom.py filter. Overlap stages
+    with a snapshot in snapshot_dir read their table from it (see snapshot.py).
+    The stages looking up one query per variant send multi_statements of
+    them per round trip. plan, the arguments of a planner.Planner, has the
+    other overlap stages choose their lookups per chromosome """
+def driverStages(dbsnp_batched=False, promoter_offset=500, indexed_tables=(), merge_join=False, gene_models=False,
+                 bigrefgene_batched=False, columnar_tables=(), dbsnp_bloom='', snapshot_dir='', multi_statements=0,
+                 plan=None):
+    bloom = None
+    if dbsnp_bloom:
+        bloom = BloomFilter(dbsnp_bloom)
+    planner = None
+    if plan is not None:
+        planner = Planner(**plan)
+    stages = [DbSnpStage(varclass='SNV', batched=dbsnp_batched, bloom=bloom),
+            BigRefGeneStage(batched=bigrefgene_batched),
+            GenesStage(table='refGene', promoter_offset=promoter_offset),
+            CytobandStage(table='cytoBand'),
+            GadAllStage(table='gadAll'),
+            GwasCatalogStage(table='gwasCatalog'),
+            MiRNAStage(table='targetScanS'),
+            HugoStage(table='hugo'),
+            CnvStage(table='dgv_Cnv'),
+            CnvStage(table='abParts_IG_T_CelReceptors'),
+            CnvStage(table='mcCarroll_Cnv'),
+            CnvStage(table='conrad_Cnv'),
+            GenomicSuperDupsStage(table='genomicSuperDups'),
+            TfbsConsSitesStage(table='tfbsConsSites')]
+
+    for stage in stages:
+        if isinstance(stage, OverlapStage) and stage.table in indexed_tables:
+            stage.useIndex()
+        if isinstance(stage, OverlapStage) and merge_join:
+            stage.useSweep()
+        if isinstance(stage, GenesStage) and gene_models:
+            stage.useModels()
+        if isinstance(stage, GenesStage) and 'cpgIslandExt' in indexed_tables:
+            stage.useCpgIndex()
+        if isinstance(stage, OverlapStage) and stage.table in columnar_tables:
+            if columnar.np is None:
+                print ("NumPy is not installed, " + stage.table + " is annotated one variant at a time")
+            else:
+                stage.useColumnar()
+        stage.multi_statements = multi_statements
+        if isinstance(stage, OverlapStage) and snapshot_dir:
+            if os.path.exists(snapshotPath(snapshot_dir, stage.table)):
+                stage.useSnapshot(snapshotPath(snapshot_dir, stage.table))
+        if isinstance(stage, OverlapStage) and planner is not None:
+            stage.planner = planner
+    return stages
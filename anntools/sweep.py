@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+""" Sweep-line merge join of a coordinate-sorted VCF with a reference table.
+
+    For each chromosome the table is streamed on its own connection ordered
+    by start, while the variants come in by position. Intervals enter the
+    active set when the sweep passes their start and leave it when it passes
+    their end, so a whole table is joined in one pass over the variants and
+    the rows instead of one indexed lookup per variant.
+
+    Hits are returned in the order of the per-variant SQL query, so the first
+    hit (fetch_one) and the order of the names joined for several hits are
+    the same as without the sweep. That order is read from the indexes of the
+    table (see sql_config.rowOrder): the stream is ordered by start, then by
+    those columns, which come first in each row, and the active set is kept
+    ordered by them. A table without a primary key has no order a query can
+    ask for: its chromosomes are answered from the interval_index.TableIndex
+    given instead.
+
+    The join needs positions to be non-decreasing within a chromosome and
+    every chromosome to come in one run. query() returns None as soon as the
+    input breaks that, and for every variant after it; callers then fall back
+    to their regular lookup.
+"""
+
+import bisect
+
+import sql_config
+
+
+class SweepJoin(object):
+
+    def __init__(self, table, index, columns='*', chrom='chrom', start='chromStart', end='chromEnd',
+                 fetch_size=5000):
+        """ Joins columns of table, whose chromosome column is chrom; with
+            chrom None there is one table per chromosome and %s in table is
+            the chromosome. index is the TableIndex of the same rows """
+        self.table = table
+        self.index = index
+        self.columns = columns
+        self.chromName = chrom
+        self.start = start
+        self.end = end
+        self.fetch_size = fetch_size
+        self.conn = None
+        self.cursor = None
+        self.chrom = None
+        self.done = set()
+        self.last = None
+        self.unsorted = False
+
+    def sql(self, chrom, order):
+        """ Rows of chrom, each one preceded by its order columns, ordered by
+            start then by them """
+        table = self.table
+        where = ''
+        if self.chromName is None:
+            table = self.table % chrom
+        else:
+            where = ' where ' + self.chromName + '="' + str(chrom) + '"'
+        columns = self.columns
+        if columns == '*':
+            columns = table + '.*'
+        return ('select ' + ', '.join(order) + ', ' + columns + ' from ' + table + where + ' order by '
+                + ', '.join([self.start] + order) + ';')
+
+    def open(self, chrom):
+        if self.conn is None:
+            self.conn = sql_config.conn2annotator()
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        self.chrom = chrom
+        self.last = None
+        self.buffer = []
+        self.next = 0
+        self.active = []
+        self.exhausted = False
+
+        cursor = self.conn.cursor()
+        table = self.table
+        if self.chromName is None:
+            table = self.table % chrom
+        order = sql_config.rowOrder(cursor, table, self.chromName)
+        cursor.close()
+        self.keyed = order is not None
+        if not self.keyed:
+            self.cursor = self.conn.cursor()
+            return
+
+        self.cursor = sql_config.streamCursor(self.conn)
+        self.cursor.execute (self.sql(chrom, order))
+        self.k = len(order)
+        columns = [str(d[0]) for d in self.cursor.description][self.k:]
+        self.s = self.k + columns.index(self.start)
+        self.e = self.k + columns.index(self.end)
+        # smallest end in the active set
+        self.soonest = None
+
+    def pending(self):
+        """ next row of the stream, or None at the end of the chromosome """
+        if self.next == len(self.buffer) and self.exhausted == False:
+            self.buffer = self.cursor.fetchmany (self.fetch_size)
+            self.next = 0
+            if len(self.buffer) == 0:
+                self.exhausted = True
+        if self.next < len(self.buffer):
+            return self.buffer[self.next]
+        return None
+
+    def query(self, chrom, pos):
+        """ rows holding pos in the order of the table, or None if the input
+            turned out not to be sorted """
+        if self.unsorted:
+            return None
+        pos = int(pos)
+
+        if chrom != self.chrom:
+            if chrom in self.done:
+                return self.fallback()
+            if self.chrom is not None:
+                self.done.add(self.chrom)
+            self.open(chrom)
+        elif pos < self.last:
+            return self.fallback()
+        self.last = pos
+
+        if not self.keyed:
+            return self.index.query(self.cursor, chrom, pos)
+
+        if self.soonest is not None and self.soonest < pos:
+            self.active = [r for r in self.active if int(r[self.e]) >= pos]
+            self.soonest = None
+            if len(self.active) > 0:
+                self.soonest = min([int(r[self.e]) for r in self.active])
+        row = self.pending()
+        while row is not None and int(row[self.s]) <= pos:
+            if int(row[self.e]) >= pos:
+                bisect.insort(self.active, row)
+                if self.soonest is None or int(row[self.e]) < self.soonest:
+                    self.soonest = int(row[self.e])
+            self.next = self.next + 1
+            row = self.pending()
+
+        return [tuple(r[self.k:]) for r in self.active]
+
+    def fallback(self):
+        print ("Input is not sorted, falling back from merge join: " + self.table)
+        self.unsorted = True
+        self.close()
+        return None
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+        if self.conn is not None:
+            self.conn.close()
+        self.cursor = None
+        self.conn = None
@@ -0,0 +1,207 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+# the modules of anntools import each other by name, and sql_config reads
+# config.txt from the working directory
+ANNTOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ANNTOOLS)
+os.chdir(ANNTOOLS)
+
+import sql_config
+
+
+CHROMS = ['1', '2', 'X']
+LENGTH = 200000
+BASES = 'ACGT'
+
+
+def createTable(conn, name, columns, rows):
+    types = {'s': 'TEXT COLLATE NOCASE', 'i': 'INTEGER', 'b': 'BLOB'}
+    conn.execute('create table ' + name + ' (' + ', '.join([c + ' ' + types[t] for c, t in columns]) + ')')
+    conn.executemany('insert into ' + name + ' values (' + ','.join(['?'] * len(columns)) + ')', rows)
+
+
+def intervals(rng, n, shortest, longest, extra, chrom='chr%s'):
+    """ n random intervals per chromosome, in no particular order, as the
+        rows of the UCSC dumps are not either once their tables are merged """
+    rows = []
+    for ch in CHROMS:
+        for i in range(0, n):
+            start = rng.randint(1, LENGTH)
+            rows.append((chrom % ch, start, start + rng.randint(shortest, longest)) + extra(i))
+    return rows
+
+
+def bigRefGeneRow(rng, ch, start, end, ref, alt):
+    row = [0, ch, start, end, ref, alt]
+    for name in BIGREFGENE[5:]:
+        if name == 'frame':
+            row.append(rng.choice([0, 1, 2]))
+        elif name == 'positionType':
+            row.append(rng.choice(['intron', 'CDS', 'utr5', 'utr3', 'non_coding_exon', 'non_coding_intron']))
+        else:
+            row.append(rng.choice(['', '0', name + str(rng.randint(0, 3))]))
+    return row
+
+
+BIGREFGENE = ['chr', 'start', 'end', 'haplotypeReference', 'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+              'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon', 'referenceAA',
+              'variantCodon', 'variantAA', 'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+              'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+
+def buildDatabase(path, vcf, seed=1, per_chrom=300):
+    """ Small annotation database with the tables of the driver, and a
+        coordinate-sorted VCF of per_chrom variants per chromosome hitting them """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+
+    variants = []
+    for ch in CHROMS:
+        for i in range(0, per_chrom):
+            ref = rng.choice(BASES)
+            if rng.random() > 0.85:
+                ref = ''.join([rng.choice(BASES) for b in range(0, rng.randint(2, 4))])
+            variants.append((ch, rng.randint(1, LENGTH), ref, rng.choice([b for b in BASES if b != ref[0]])))
+    variants.sort(key=lambda v: (CHROMS.index(v[0]), v[1]))
+
+    rows = []
+    for i, (ch, pos, ref, alt) in enumerate(variants):
+        if rng.random() < 0.4:
+            for k in range(0, rng.choice([1, 1, 2])):
+                if rng.random() > 0.8:
+                    ref = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}.get(ref, 'N')
+                rows.append((ch, pos, '+', 'rs' + str(i * 3 + k), ref, alt,
+                             'SNV' if len(ref) == 1 or rng.random() < 0.3 else 'DIV', rng.choice(['.', '0.01', '0.3'])))
+    createTable(conn, 'dbSNP', [('CHR', 's'), ('POS', 'i'), ('strand', 's'), ('RSID', 's'), ('REF', 's'),
+                                ('ALT', 's'), ('INFO', 's'), ('GMAF', 's')], rows)
+
+    columns = [('bin', 'i')] + [(c, 'i' if c in ('start', 'end', 'frame') else 's') for c in BIGREFGENE]
+    equal_base, equal_nobase, unequal = [], [], []
+    for ch, pos, ref, alt in variants:
+        x = rng.random()
+        if x < 0.25:
+            equal_base.append(bigRefGeneRow(rng, ch, pos, pos, ref, alt))
+            if rng.random() < 0.3:
+                equal_base.append(bigRefGeneRow(rng, ch, pos, pos, ref, alt))
+        elif x < 0.4:
+            equal_nobase.append(bigRefGeneRow(rng, ch, pos, pos, '', ''))
+    for ch in CHROMS:
+        for i in range(0, 80):
+            start = rng.randint(1, LENGTH)
+            unequal.append(bigRefGeneRow(rng, ch, start, start + rng.randint(1, 800), '', ''))
+    createTable(conn, 'chrom_pos_equal_base', columns, equal_base)
+    createTable(conn, 'chrom_pos_equal_nobase', columns, equal_nobase)
+    createTable(conn, 'chrom_pos_unequal', columns, unequal)
+
+    genes = []
+    for ch in CHROMS:
+        for i in range(0, 40):
+            tx_start = rng.randint(1, LENGTH)
+            tx_end = tx_start + rng.randint(500, 20000)
+            n = rng.randint(1, 12)
+            bounds = sorted(rng.sample(range(tx_start, tx_end), 2 * n))
+            starts, ends = bounds[0::2], bounds[1::2]
+            starts[0] = tx_start
+            ends[-1] = tx_end
+            cds_start = cds_end = tx_end
+            if rng.random() > 0.25:
+                cds_start = rng.randint(tx_start, (tx_start + tx_end) // 2)
+                cds_end = rng.randint(cds_start, tx_end)
+            genes.append((0, 'NM_' + str(len(genes)), 'chr' + ch, rng.choice('+-'), tx_start, tx_end, cds_start,
+                          cds_end, n, (','.join(map(str, starts)) + ',').encode(),
+                          (','.join(map(str, ends)) + ',').encode(), 0, 'G' + str(rng.randint(0, 60)), 'cmpl', 'cmpl',
+                          b'0,'))
+    createTable(conn, 'refGene', [('bin', 'i'), ('name', 's'), ('chrom', 's'), ('strand', 's'), ('txStart', 'i'),
+                                  ('txEnd', 'i'), ('cdsStart', 'i'), ('cdsEnd', 'i'), ('exonCount', 'i'),
+                                  ('exonStarts', 'b'), ('exonEnds', 'b'), ('score', 'i'), ('name2', 's'),
+                                  ('cdsStartStat', 's'), ('cdsEndStat', 's'), ('exonFrames', 'b')], genes)
+
+    createTable(conn, 'cpgIslandExt', [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'),
+                                       ('name', 's')],
+                [(0,) + r for r in intervals(rng, 120, 100, 1500, lambda i: ('CpG: ' + str(i),))])
+    bands = []
+    for ch in CHROMS:
+        start = 0
+        k = 0
+        while start < LENGTH + 10:
+            end = start + rng.randint(2000, 15000)
+            bands.append(('chr' + ch, start, end, 'p' + str(k // 3) + '.' + str(k), 'gneg'))
+            start = end
+            k = k + 1
+    rng.shuffle(bands)
+    createTable(conn, 'cytoBand', [('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 's'),
+                                   ('gieStain', 's')], bands)
+    createTable(conn, 'gadAll', [('id', 'i'), ('association', 's'), ('broadPhen', 's'), ('geneSymbol', 's'),
+                                 ('chromosome', 's'), ('chromStart', 'i'), ('chromEnd', 'i')],
+                [(i, 'Y', 'ph', 'GS' + str(i % 37)) + r
+                 for i, r in enumerate(intervals(rng, 60, 100, 5000, lambda i: (), chrom='%s'))])
+    gwas = []
+    for i, (ch, pos, ref, alt) in enumerate(variants):
+        if rng.random() < 0.05:
+            gwas.append((0, 'chr' + ch, pos - 1, pos, 'rs', str(1000 + i), 'au', 'd', 'j', 't', 'trait ' + str(i)))
+    createTable(conn, 'gwasCatalog', [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'),
+                                      ('name', 's'), ('pubMedID', 's'), ('author', 's'), ('pubDate', 's'),
+                                      ('journal', 's'), ('title', 's'), ('trait', 's')], gwas)
+    createTable(conn, 'targetScanS', [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'),
+                                      ('name', 's'), ('score', 'i'), ('strand', 's')],
+                [(0,) + r for r in intervals(rng, 100, 5, 5000, lambda i: ('miR-' + str(i), 1, '+'))])
+    createTable(conn, 'hugo', [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'), ('x', 's'),
+                               ('symbol', 's'), ('desc', 's')],
+                [(0,) + r for r in intervals(rng, 30, 1000, 9000,
+                                             lambda i: ('x', 'HG' + str(i % 20), 'desc;' + str(i % 3)))])
+    for table in ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv']:
+        cnvs = intervals(rng, 50, 100, 4000, lambda i: ('cnv' + str(i),))
+        # a CNV over most of the first chromosome
+        cnvs.insert(len(cnvs) // 2, ('chr1', 10, LENGTH - 10, 'cnvLong'))
+        createTable(conn, table, [('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 's')], cnvs)
+    createTable(conn, 'genomicSuperDups', [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'), ('chromEnd', 'i'),
+                                           ('name', 's'), ('score', 'i'), ('strand', 's'), ('otherChrom', 's'),
+                                           ('otherStart', 'i'), ('otherEnd', 'i')],
+                [(0,) + r for r in intervals(rng, 30, 1000, 20000,
+                                             lambda i: ('sd', 0, '+', 'chr' + str(i % 5 + 1), i * 10, i * 10 + 500))])
+    for ch in CHROMS:
+        createTable(conn, 'tfbsConsSites' + ch, [('bin', 'i'), ('chrom', 's'), ('chromStart', 'i'),
+                                                 ('chromEnd', 'i'), ('name', 's')],
+                    [(0, 'chr' + ch, s, s + rng.randint(5, 40), 'V$TF' + str(rng.randint(0, 50)))
+                     for s in [rng.randint(1, LENGTH) for i in range(0, 800)]])
+    conn.commit()
+    conn.close()
+
+    fh = open(vcf, 'w')
+    fh.write('##fileformat=VCFv4.0\n##source=test\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n')
+    for i, (ch, pos, ref, alt) in enumerate(variants):
+        # both namings of the chromosomes
+        if ch == '2':
+            ch = 'chr2'
+        info = '.'
+        if rng.random() > 0.6:
+            info = 'DP=' + str(i)
+        fh.write('\t'.join([ch, str(pos), 'rsold' if i % 7 == 0 else '.', ref, alt, '50', 'PASS', info, 'GT', '0/1'])
+                 + '\n')
+    fh.close()
+
+
+@pytest.fixture(scope='session')
+def annotationDb(tmp_path_factory):
+    """ (database, VCF) of buildDatabase, the database used by sql_config
+        for the session """
+    directory = tmp_path_factory.mktemp('annotation')
+    path = str(directory / 'annotation.db')
+    vcf = str(directory / 'input.vcf')
+    buildDatabase(path, vcf)
+
+    previous = sql_config.sqlite_db
+    sql_config.useSqlite(path)
+    yield (path, vcf)
+    sql_config.pool.clear()
+    sql_config.multi_pool.clear()
+    sql_config.sqlite_db = previous
+    if previous is None:
+        os.environ.pop('ANNTOOLS_SQLITE_DB', None)
+    else:
+        os.environ['ANNTOOLS_SQLITE_DB'] = previous
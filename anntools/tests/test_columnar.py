@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from columnar import IntervalColumns
+
+
+def bruteForce(starts, ends, positions):
+    pairs = [(v, i) for v in range(0, len(positions)) for i in range(0, len(starts))
+             if starts[i] <= positions[v] <= ends[i]]
+    return ([v for v, i in pairs], [i for v, i in pairs])
+
+
+def testJoinMatchesBruteForce():
+    rng = random.Random(7)
+    starts = []
+    ends = []
+    for i in range(0, 500):
+        start = rng.randint(0, 100000)
+        starts.append(start)
+        ends.append(start + rng.choice([0, 1, 10, 100, 1000, 30000]))
+    # a chromosome-spanning CNV in the middle of the table
+    starts.insert(250, 0)
+    ends.insert(250, 100000)
+    positions = sorted([rng.randint(0, 101000) for i in range(0, 300)])
+
+    variant, ids = IntervalColumns(starts, ends).join(positions)
+    assert (variant.tolist(), ids.tolist()) == bruteForce(starts, ends, positions)
+
+
+def testChromosomeSpanningInterval():
+    # the old join scanned every interval after the spanning one for every
+    # position: 20000 * 20000 candidates, some 3 GB of indices
+    n = 20000
+    starts = [0] + [i * 10000 for i in range(0, n)]
+    ends = [250000000] + [i * 10000 + 100 for i in range(0, n)]
+    positions = [i * 10000 + 50 for i in range(0, n)]
+
+    variant, ids = IntervalColumns(starts, ends).join(positions)
+    assert len(variant) == 2 * n
+    assert variant.tolist() == [v for v in range(0, n) for twice in (0, 1)]
+    assert ids.tolist() == [i for v in range(0, n) for i in (0, v + 1)]
+
+
+def testEmpty():
+    variant, ids = IntervalColumns([], []).join([1, 2, 3])
+    assert len(variant) == 0 and len(ids) == 0
+    variant, ids = IntervalColumns([5], [10]).join([])
+    assert len(variant) == 0
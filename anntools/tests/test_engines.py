@@ -0,0 +1,154 @@
+""" Every engine and option of driver.run against the staged engine of
+    annotate.py: same annotated VCF and count.log, byte for byte """
+
+import os
+import shutil
+
+import pytest
+
+import dbsnp_bloom
+import driver
+import snapshot
+import sql_config
+import stages as st
+
+
+OVERLAP_TABLES = ['cytoBand', 'gadAll', 'gwasCatalog', 'targetScanS', 'hugo', 'dgv_Cnv', 'abParts_IG_T_CelReceptors',
+                  'mcCarroll_Cnv', 'conrad_Cnv', 'genomicSuperDups', 'tfbsConsSites']
+
+# count.log lines an option adds after the sections of the stages
+ADDED_LINES = ('Async queries:', 'Cache:')
+
+
+def annotate(directory, vcf, **options):
+    """ (annotated VCF, count.log) of driver.run on a copy of vcf in directory """
+    os.makedirs(directory)
+    infile = os.path.join(directory, 'input.vcf')
+    shutil.copyfile(vcf, infile)
+    driver.run(infile, 'vcf', driver.Options(**options))
+    fh = open(driver.annotatedName(infile))
+    annotated = fh.read()
+    fh.close()
+    fh = open(infile + '.count.log')
+    log = fh.read()
+    fh.close()
+    return (annotated, log)
+
+
+def stageLines(log):
+    return ''.join([line for line in log.splitlines(True) if not line.startswith(ADDED_LINES)])
+
+
+@pytest.fixture(scope='module')
+def baseline(annotationDb, tmp_path_factory):
+    db, vcf = annotationDb
+    return annotate(str(tmp_path_factory.mktemp('baseline') / 'staged'), vcf)
+
+
+@pytest.fixture(scope='module')
+def snapshots(annotationDb, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('snapshots'))
+    conn = sql_config.connect()
+    cursor = conn.cursor ()
+    for stage in st.driverStages():
+        if isinstance(stage, st.OverlapStage):
+            stage.exportSnapshot(cursor, snapshot.snapshotPath(directory, stage.table))
+    conn.close()
+    return directory
+
+
+@pytest.fixture(scope='module')
+def bloom(annotationDb, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('bloom') / 'dbsnp.bloom')
+    conn = sql_config.connect()
+    dbsnp_bloom.build(conn, path)
+    conn.close()
+    return path
+
+
+def testBaselineAnnotates(baseline):
+    annotated, log = baseline
+    assert len([line for line in annotated.splitlines() if not line.startswith('#')]) == 900
+    for annotation in [';DB', 'positionType=', 'putativePromoterRegion=', 'cytoBand=', 'gadAll=', 'gwasCatalog=',
+                       'miRNAsites=', 'HGNC_GeneAnnotation=', 'dgv_Cnv=', 'genomicSuperDups=', 'tfbsRegion=']:
+        assert annotation in annotated
+    assert 'In dbSNP: ' in log
+
+
+ENGINES = {
+    'dbsnp batched': dict(dbsnp_batch_size=100),
+    'lookup threads': dict(lookup_threads=4),
+    'fused': dict(engine='fused'),
+    'fused dbsnp batched': dict(engine='fused', dbsnp_batch_size=100),
+    'interval index': dict(engine='fused', indexed_tables=OVERLAP_TABLES + ['cpgIslandExt']),
+    'merge join': dict(engine='fused', merge_join=True),
+    'columnar': dict(engine='fused', columnar_tables=OVERLAP_TABLES),
+    'gene models': dict(engine='fused', gene_models=True),
+    'bigrefgene batched': dict(engine='fused', bigrefgene_batched=True),
+    'multi statements': dict(engine='fused', multi_statements=16),
+    'adaptive plan': dict(engine='fused', adaptive_plan=True, plan_query_ms=0.001),
+    'workers': dict(engine='fused', workers=2),
+    'shards': dict(engine='fused', shards=4),
+    'shards by chromosome': dict(engine='fused', shards=4, shard_by_chrom=True),
+    'async': dict(engine='fused', async_window=8),
+    'everything': dict(engine='fused', dbsnp_batch_size=100, indexed_tables=['cpgIslandExt'], merge_join=True,
+                       gene_models=True, bigrefgene_batched=True, multi_statements=16),
+}
+
+
+@pytest.mark.parametrize('name', sorted(ENGINES.keys()))
+def testSameOutput(name, baseline, annotationDb, tmp_path):
+    db, vcf = annotationDb
+    annotated, log = annotate(str(tmp_path / 'run'), vcf, **ENGINES[name])
+    assert annotated == baseline[0]
+    assert stageLines(log) == baseline[1]
+
+
+def testSnapshots(baseline, annotationDb, snapshots, tmp_path):
+    db, vcf = annotationDb
+    assert annotate(str(tmp_path / 'run'), vcf, engine='fused', snapshot_dir=snapshots) == baseline
+
+
+@pytest.mark.parametrize('engine', ['staged', 'fused'])
+def testBloomFilter(engine, baseline, annotationDb, bloom, tmp_path):
+    db, vcf = annotationDb
+    assert annotate(str(tmp_path / 'run'), vcf, engine=engine, dbsnp_bloom=bloom) == baseline
+
+
+def testAsyncGaugesInCountLog(annotationDb, tmp_path):
+    db, vcf = annotationDb
+    annotated, log = annotate(str(tmp_path / 'run'), vcf, engine='fused', async_window=8)
+    assert log.splitlines()[-1].startswith('Async queries:')
+
+
+def testCache(baseline, annotationDb, tmp_path):
+    db, vcf = annotationDb
+    path = str(tmp_path / 'cache.db')
+    for run in ['cold', 'warm']:
+        annotated, log = annotate(str(tmp_path / run), vcf, engine='fused', cache_path=path, cache_version='1')
+        assert annotated == baseline[0]
+        assert stageLines(log) == baseline[1]
+    # the second run read every variant from the cache
+    assert log.splitlines()[-1].endswith(' 0 misses')
+
+
+@pytest.mark.parametrize('engine, options', [
+    ('staged', dict(merge_join=True)),
+    ('staged', dict(cache_path='cache.db')),
+    ('staged', dict(shards=4, shard_by_chrom=True)),
+    ('fused', dict(lookup_threads=4)),
+])
+def testUnsupportedOption(engine, options):
+    with pytest.raises(ValueError, match=' is not supported by the ' + engine + ' engine'):
+        driver.Options(engine=engine, **options)
+
+
+def testOptionsNotInUse():
+    # settings only refining an option left off, as utils.cfg has them
+    options = driver.Options(engine='staged', plan_query_ms=2.5, cache_version='3', cache_size=10,
+                             shard_by_chrom=True, indexed_tables=[])
+    assert options.inUse() == []
+    with pytest.raises(ValueError):
+        driver.Options(engine='serial')
+    with pytest.raises(TypeError):
+        driver.Options(engine='fused', merge_joins=True)
@@ -0,0 +1,184 @@
+import os
+
+import pytest
+
+import s3_stream
+
+
+def putObject(root, bucket, key, data):
+    os.makedirs(os.path.join(root, bucket))
+    fh = open(os.path.join(root, bucket, key), 'wb')
+    fh.write(data)
+    fh.close()
+
+
+def vcfLines(n):
+    return ['chr1\t' + str(pos) + '\t.\tA\tG\t.\tPASS\tDP=' + str(pos % 97) + '\n' for pos in range(1, n + 1)]
+
+
+class FlakyStore(s3_stream.LocalObjectStore):
+    """ Fails the first GET of every range, then truncates the second one """
+
+    def __init__(self, root):
+        s3_stream.LocalObjectStore.__init__(self, root)
+        self.calls = {}
+
+    def getRange(self, bucket, key, start, end):
+        calls = self.calls.get(start, 0)
+        self.calls[start] = calls + 1
+        if calls == 0:
+            raise IOError('connection reset')
+        data = s3_stream.LocalObjectStore.getRange(self, bucket, key, start, end)
+        if calls == 1:
+            return data[:-1]
+        return data
+
+
+def testLinesAcrossPartBoundaries(tmp_path):
+    root = str(tmp_path)
+    lines = vcfLines(500)
+    putObject(root, 'in', 'job.vcf', ''.join(lines).encode())
+    store = s3_stream.LocalObjectStore(root)
+
+    # parts far smaller than a line, then cutting most lines
+    for part_size in [7, 100, 4096, 1 << 20]:
+        fh = s3_stream.openObject(store, 'in', 'job.vcf', part_size=part_size, concurrency=3)
+        assert list(fh) == lines
+        fh.close()
+
+
+def testRetriesFailedAndShortGets(tmp_path):
+    root = str(tmp_path)
+    lines = vcfLines(50)
+    putObject(root, 'in', 'job.vcf', ''.join(lines).encode())
+    store = FlakyStore(root)
+
+    fh = s3_stream.openObject(store, 'in', 'job.vcf', part_size=256, concurrency=4, retries=2)
+    assert list(fh) == lines
+    fh.close()
+    assert len(store.calls) == (len(''.join(lines)) + 255) // 256
+    assert set(store.calls.values()) == set([3])
+
+
+def testGivesUpAfterRetries(tmp_path):
+    root = str(tmp_path)
+    putObject(root, 'in', 'job.vcf', ''.join(vcfLines(50)).encode())
+    store = FlakyStore(root)
+
+    fh = s3_stream.openObject(store, 'in', 'job.vcf', part_size=256, concurrency=2, retries=1)
+    with pytest.raises(IOError):
+        fh.read()
+    fh.close()
+
+
+def testEmptyObject(tmp_path):
+    root = str(tmp_path)
+    putObject(root, 'in', 'empty.vcf', b'')
+    fh = s3_stream.openObject(s3_stream.LocalObjectStore(root), 'in', 'empty.vcf')
+    assert fh.read() == ''
+    fh.close()
+
+
+def testCloseBeforeTheEnd(tmp_path):
+    # what runJob does when the engine fails halfway
+    root = str(tmp_path)
+    lines = vcfLines(500)
+    putObject(root, 'in', 'job.vcf', ''.join(lines).encode())
+
+    fh = s3_stream.openObject(s3_stream.LocalObjectStore(root), 'in', 'job.vcf', part_size=64, concurrency=2)
+    assert fh.readline() == lines[0]
+    raw = fh.buffer.raw
+    fh.close()
+    assert raw.closed
+    assert all([part.done() for part in raw.pending])
+
+
+class FlakyUploads(s3_stream.LocalObjectStore):
+    """ Fails the first upload of every part, and every upload of the parts
+        in broken """
+
+    def __init__(self, root, broken=()):
+        s3_stream.LocalObjectStore.__init__(self, root)
+        self.broken = set(broken)
+        self.calls = {}
+        self.aborted = []
+
+    def uploadPart(self, bucket, key, upload_id, number, data):
+        calls = self.calls.get(number, 0)
+        self.calls[number] = calls + 1
+        if calls == 0 or number in self.broken:
+            raise IOError('connection reset')
+        return s3_stream.LocalObjectStore.uploadPart(self, bucket, key, upload_id, number, data)
+
+    def abortMultipart(self, bucket, key, upload_id):
+        self.aborted.append(upload_id)
+        s3_stream.LocalObjectStore.abortMultipart(self, bucket, key, upload_id)
+
+
+def readObject(root, bucket, key):
+    fh = open(os.path.join(root, bucket, key), 'rb')
+    data = fh.read()
+    fh.close()
+    return data
+
+
+def uploads(root):
+    return os.listdir(os.path.join(root, '.uploads'))
+
+
+def testUploadInParts(tmp_path):
+    root = str(tmp_path)
+    lines = vcfLines(300)
+    upload = s3_stream.MultipartUpload(s3_stream.LocalObjectStore(root), 'out', 'job.annot.vcf', part_size=1000,
+                                       concurrency=3)
+    fh = upload.open()
+    for line in lines:
+        fh.write(line)
+    fh.close()
+    upload.wait()
+
+    data = ''.join(lines).encode()
+    assert readObject(root, 'out', 'job.annot.vcf') == data
+    assert len(upload.parts) == (len(data) + 999) // 1000
+    assert [part.result()['PartNumber'] for part in upload.parts] == list(range(1, len(upload.parts) + 1))
+    assert upload.size == len(data)
+    assert uploads(root) == []
+
+
+def testEmptyUpload(tmp_path):
+    root = str(tmp_path)
+    upload = s3_stream.MultipartUpload(s3_stream.LocalObjectStore(root), 'out', 'empty.vcf')
+    upload.open().close()
+    upload.wait()
+    assert readObject(root, 'out', 'empty.vcf') == b''
+
+
+def testRetriesEveryPart(tmp_path):
+    root = str(tmp_path)
+    store = FlakyUploads(root)
+    data = ''.join(vcfLines(100))
+    upload = s3_stream.MultipartUpload(store, 'out', 'job.annot.vcf', part_size=500, concurrency=2, retries=2)
+    fh = upload.open()
+    fh.write(data)
+    fh.close()
+    upload.wait()
+
+    assert readObject(root, 'out', 'job.annot.vcf') == data.encode()
+    assert sorted(store.calls.keys()) == list(range(1, len(upload.parts) + 1))
+    assert set(store.calls.values()) == set([2])
+    assert store.aborted == []
+
+
+def testAbortsWhenAPartFails(tmp_path):
+    root = str(tmp_path)
+    store = FlakyUploads(root, broken=[2])
+    upload = s3_stream.MultipartUpload(store, 'out', 'job.annot.vcf', part_size=500, concurrency=2, retries=1)
+    fh = upload.open()
+    fh.write(''.join(vcfLines(100)))
+    fh.close()
+    with pytest.raises(IOError):
+        upload.wait()
+
+    assert store.aborted == [upload.upload_id]
+    assert uploads(root) == []
+    assert not os.path.exists(os.path.join(root, 'out', 'job.annot.vcf'))
@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+import snapshot
+
+
+COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name', 'score']
+ROWS = {
+    'CHR1': [('chr1', 100, 200, 'b', 1.5), ('chr1', 50, 150, b'a', None), ('chr1', 120, 130, 'c', 7)],
+    'CHR2': [('chr2', 10, 20, 'd', 0)],
+}
+
+
+def testQueryThenClose(tmp_path):
+    path = str(tmp_path / 'table.snap')
+    snapshot.write(path, 'table', COLUMNS, ROWS)
+    snap = snapshot.Snapshot(path)
+
+    # table order, not start order
+    rows = snap.query('chr1', 125)
+    assert rows == [('chr1', 100, 200, 'b', 1.5), ('chr1', 50, 150, b'a', None), ('chr1', 120, 130, 'c', 7)]
+    first = snap.first('chr1', 140)
+    assert first == ('chr1', 100, 200, 'b', 1.5)
+    assert snap.query('chr2', 15) == [('chr2', 10, 20, 'd', 0)]
+    assert snap.query('chr3', 15) == []
+
+    # the rows handed out keep no view of the map
+    snap.close()
+    assert snap.map.closed
+    assert rows[1][3] == b'a'
+    assert first[3] == 'b'
+
+
+def testCloseUnread(tmp_path):
+    path = str(tmp_path / 'empty.snap')
+    snapshot.write(path, 'empty', COLUMNS, {})
+    snap = snapshot.Snapshot(path)
+    assert snap.query('chr1', 1) == []
+    snap.close()
+    assert snap.map.closed
+
+
+def testMatchesBruteForce(tmp_path):
+    rng = random.Random(11)
+    rows = []
+    for i in range(0, 400):
+        start = rng.randint(0, 100000)
+        rows.append(('chr1', start, start + rng.choice([0, 1, 10, 100, 1000, 30000]), 'r' + str(i), i))
+    # a chromosome-long CNV in the middle of the table
+    rows.insert(200, ('chr1', 0, 250000000, 'cnv', -1))
+    path = str(tmp_path / 'table.snap')
+    snapshot.write(path, 'table', COLUMNS, {'CHR1': rows})
+    snap = snapshot.Snapshot(path)
+    for pos in [rng.randint(0, 101000) for i in range(0, 300)]:
+        assert snap.query('chr1', pos) == [row for row in rows if row[1] <= pos <= row[2]]
+    snap.close()
+
+
+def testChromosomeLongRow(tmp_path):
+    # the rows after a chromosome-long one are not scanned by every lookup
+    rows = [('chr1', 0, 250000000, 'cnv', 0)] + [('chr1', i * 1000, i * 1000 + 10, 'r', i) for i in range(0, 20000)]
+    path = str(tmp_path / 'table.snap')
+    snapshot.write(path, 'table', COLUMNS, {'CHR1': rows})
+    snap = snapshot.Snapshot(path)
+    ends = CountingEnds(snap.ends)
+    snap.ends = ends
+    assert snap.query('chr1', 19999005) == [rows[0], rows[20000]]
+    assert ends.read < 10
+    snap.ends = ends.values
+    snap.close()
+
+
+class CountingEnds(object):
+    def __init__(self, values):
+        self.values = values
+        self.read = 0
+
+    def __getitem__(self, r):
+        self.read = self.read + 1
+        return self.values[r]
+
+
+def testOldVersion(tmp_path):
+    path = str(tmp_path / 'old.snap')
+    snapshot.write(path, 'table', COLUMNS, ROWS)
+    fh = open(path, 'r+b')
+    fh.write(snapshot.HEADER.pack(snapshot.MAGIC, 1, 0)[:12])
+    fh.close()
+    with pytest.raises(ValueError, match='version 1'):
+        snapshot.Snapshot(path)
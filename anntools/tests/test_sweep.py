@@ -0,0 +1,83 @@
+import random
+import sqlite3
+
+import pytest
+
+import sql_config
+from interval_index import TableIndex
+from sweep import SweepJoin
+
+
+SQL = 'select * from iv where chrom="%s";'
+
+
+@pytest.fixture(params=[[], ['chrom', 'chromStart', 'chromEnd']], ids=['rowid', 'index'])
+def table(request, tmp_path, monkeypatch):
+    """ SQLite database of one interval table, its rows out of start order
+        with ties, and with or without the index of sqlite_backend """
+    rng = random.Random(3)
+    path = str(tmp_path / 'sweep.db')
+    conn = sqlite3.connect(path)
+    conn.execute('create table iv (chrom TEXT, chromStart INTEGER, chromEnd INTEGER, name TEXT)')
+    rows = []
+    for chrom in ['chr1', 'chr2']:
+        for i in range(0, 300):
+            start = rng.choice([rng.randint(0, 5000), 1000])
+            rows.append((chrom, start, start + rng.choice([0, 5, 50, 500]), 'r' + str(i)))
+        rows.insert(len(rows) - 150, (chrom, 0, 6000, 'long'))
+    conn.executemany('insert into iv values (?,?,?,?)', rows)
+    if len(request.param) > 0:
+        conn.execute('create index iv_0 on iv (' + ', '.join(request.param) + ')')
+    conn.commit()
+    conn.close()
+
+    sql_config.pool.clear()
+    monkeypatch.setattr(sql_config, 'sqlite_db', path)
+    yield path
+    sql_config.pool.clear()
+
+
+def perVariant(chrom, pos):
+    conn = sql_config.connect()
+    cursor = conn.cursor()
+    cursor.execute ('select * from iv where chrom="' + chrom + '" AND (chromStart <= ' + str(pos) + ' AND '
+                    + str(pos) + ' <= chromEnd);')
+    rows = cursor.fetchall ()
+    conn.close()
+    return rows
+
+
+def positions():
+    rng = random.Random(5)
+    return [(chrom, pos) for chrom in ['chr1', 'chr2'] for pos in sorted([rng.randint(0, 6100) for i in range(0, 200)])
+            + [1000, 1000, 1005]]
+
+
+def testHitsInTableOrder(table):
+    sweep = SweepJoin('iv', TableIndex(SQL))
+    for chrom, pos in sorted(positions()):
+        assert sweep.query(chrom, pos) == perVariant(chrom, pos)
+    sweep.close()
+
+
+def testTableWithoutKey(table, monkeypatch):
+    # as a MySQL table without a primary key
+    monkeypatch.setattr(sql_config, 'rowOrder', lambda cursor, table, chrom=None: None)
+    sweep = SweepJoin('iv', TableIndex(SQL))
+    for chrom, pos in sorted(positions()):
+        assert sweep.query(chrom, pos) == perVariant(chrom, pos)
+    assert sweep.cursor is not None
+    sweep.close()
+
+
+def testUnsortedInput(table):
+    sweep = SweepJoin('iv', TableIndex(SQL))
+    assert sweep.query('chr1', 2000) == perVariant('chr1', 2000)
+    assert sweep.query('chr1', 1999) is None
+    assert sweep.query('chr1', 2500) is None
+
+    sweep = SweepJoin('iv', TableIndex(SQL))
+    sweep.query('chr1', 10)
+    sweep.query('chr2', 10)
+    # chr1 came in two runs
+    assert sweep.query('chr1', 5000) is None
@@ -0,0 +1,53 @@
+import sqlite3
+import time
+
+from variant_cache import VariantCache
+
+
+class Stage(object):
+    function = 'addOverlapWithCytoband'
+    table = 'cytoBand'
+
+
+def variants(first, n):
+    return [('chr1', str(pos), 'A', 'G') for pos in range(first, first + n)]
+
+
+def entries(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT count(*) FROM variants').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def testNeverHoldsMoreThanMaxEntries(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = VariantCache(path, version='1', max_entries=10)
+    stages = [Stage()]
+    for block in range(0, 5):
+        batch = variants(block * 4, 4)
+        cache.putMany(stages, batch, [['band' + v[1] for v in batch]])
+        assert entries(path) <= 10
+        time.sleep(0.01)
+    assert entries(path) == 10
+    assert cache.counts['evicted'] == 10
+    cache.close()
+
+
+def testEvictsLeastRecentlyUsed(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = VariantCache(path, version='1', max_entries=4)
+    stages = [Stage()]
+    old = variants(0, 4)
+    for variant in old:
+        cache.putMany(stages, [variant], [['old']])
+        time.sleep(0.01)
+    # read again, so more recent than the others
+    assert cache.getMany(stages, old[:1]) == [('old',)]
+    time.sleep(0.01)
+    cache.putMany(stages, variants(100, 2), [['new'] * 2])
+
+    found = cache.getMany(stages, old + variants(100, 2))
+    assert found == [('old',), None, None, ('old',), ('new',), ('new',)]
+    cache.close()
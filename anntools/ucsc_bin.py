@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+""" UCSC binning scheme for the range queries of the annotators.
+
+    Most UCSC tables carry a `bin` column, indexed together with the
+    chromosome: every row is put in the smallest bin of a fixed hierarchy
+    (128kb, 1Mb, 8Mb, 64Mb and 512Mb) that holds it entirely. The rows that
+    can overlap a position are in the few bins of that hierarchy overlapping
+    the position, so adding `bin IN (...)` to a range predicate turns the
+    scan of a whole chromosome into a handful of index lookups. See Kent et
+    al., The Human Genome Browser at UCSC (2002).
+
+    Coordinates are the UCSC ones: 0-based, half-open [start, end).
+
+    The tables without a bin column get one with:
+
+        python ucsc_bin.py cytoBand gadAll ...
+
+    Binning is off unless USE_BIN is set. The annotators write the rows of
+    a position in the order the server returns them, and that order follows
+    the index the server picks: the (chrom, bin) index and the bin predicate
+    can change it, and with it the names written for the variants
+    overlapping several rows of a table (and the row kept by the annotators
+    reading only the first one). No column restores the order of the
+    unbinned query, so enable binning only once the output of the migrated
+    tables has been compared with and without it.
+"""
+
+import argparse
+
+import sql_config
+
+
+# Standard scheme: bins of 2^17 bases at the lowest level, 8 times larger at
+# each level up, up to one bin of 2^29 bases
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX_END = 1 << 29
+
+# Set to True to query with bins
+enabled = False
+
+
+def binFromRange(start, end):
+    """ Bin of the row [start, end) """
+    if end > BIN_MAX_END:
+        raise ValueError('Position ' + str(end) + ' is beyond the standard binning scheme')
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = max(end - 1, start) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    raise ValueError('Range ' + str(start) + '-' + str(end) + ' is out of range')
+
+
+def overlappingBins(start, end):
+    """ Bins that can hold rows overlapping [start, end) """
+    end = min(max(end, start + 1), BIN_MAX_END)
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return bins
+
+
+def pointBins(pos, offset=0):
+    """ Bins of the rows matching start - offset <= pos <= end + offset.
+        The predicates of the annotators are closed on both ends, so rows
+        ending right at pos - offset are included too """
+    pos = int(pos)
+    return overlappingBins(max(pos - offset - 1, 0), pos + offset + 1)
+
+
+# table -> whether it has a bin column
+binned = {}
+
+
+def hasBin(cursor, table):
+    if table not in binned:
+        cursor.execute ('select * from ' + table + ' limit 0;')
+        binned[table] = 'bin' in [str(d[0]).lower() for d in cursor.description]
+    return binned[table]
+
+
+def addBins(cursor, table, sql, pos, offset=0):
+    """ sql, a range query on table ending with ';', restricted to the bins of
+        pos +- offset when the table has a bin column """
+    # the SQLite backend has its own indexes on the coordinates
+    if enabled == False or sql_config.sqlite_db or not hasBin(cursor, table):
+        return sql
+    bins = ','.join([str(b) for b in pointBins(pos, offset)])
+    return sql.rstrip().rstrip(';') + ' AND bin IN (' + bins + ');'
+
+
+def binExpression(start, end):
+    """ SQL expression computing binFromRange(start, end) from two columns """
+    cases = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        cases.append('WHEN (' + start + ' >> ' + str(shift) + ') = ((' + end + ' - 1) >> ' + str(shift) + ') THEN '
+                     + str(offset) + ' + (' + start + ' >> ' + str(shift) + ')')
+        shift = shift + BIN_NEXT_SHIFT
+    return 'CASE WHEN ' + end + ' <= ' + start + ' THEN ' + str(BIN_OFFSETS[0]) + ' + (' + start + ' >> ' \
+        + str(BIN_FIRST_SHIFT) + ') ' + ' '.join(cases) + ' ELSE 0 END'
+
+
+def addBinColumn(conn, table, start='chromStart', end='chromEnd', chrom='chrom'):
+    """ Adds an indexed bin column to table, after the existing columns so the
+        positions the annotators read the rows by do not move """
+    cursor = conn.cursor ()
+    if hasBin(cursor, table):
+        print (table + " already has a bin column")
+        return
+    columns = [str(d[0]) for d in cursor.description]
+    cursor.execute ('ALTER TABLE ' + table + ' ADD COLUMN bin INTEGER NOT NULL DEFAULT 0;')
+    cursor.execute ('UPDATE ' + table + ' SET bin = ' + binExpression(start, end) + ';')
+    key = 'bin'
+    if chrom in columns:
+        key = chrom + ', bin'
+    cursor.execute ('CREATE INDEX ' + table + '_bin ON ' + table + ' (' + key + ');')
+    conn.commit()
+    binned[table] = True
+    print ("Added bin to " + table)
+
+
+# Coordinate columns of the tables not named chrom/chromStart/chromEnd
+COLUMNS = {
+    'refGene': ('txStart', 'txEnd', 'chrom'),
+    'gadAll': ('chromStart', 'chromEnd', 'chromosome'),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adds the UCSC bin column to annotation tables')
+    parser.add_argument('tables', nargs='+')
+    args = parser.parse_args()
+
+    conn = sql_config.connect()
+    for table in args.tables:
+        start, end, chrom = COLUMNS.get(table, ('chromStart', 'chromEnd', 'chrom'))
+        addBinColumn(conn, table, start=start, end=end, chrom=chrom)
+    conn.close()
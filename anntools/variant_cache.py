@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+""" Persistent cache of the stage lookups of a variant, shared across jobs.
+
+    Lookups only depend on (chrom, pos, ref, alt) (see stages.py), so the
+    results of all stages for a variant are stored under that key, the
+    version of the annotation database and the list of stages. A job reading
+    them back writes exactly what the database would have given.
+
+    The cache is a SQLite file in WAL mode, which several worker processes can
+    read and write at once. It holds at most max_entries variants; the least
+    recently used ones are evicted. Hits and misses are counted in counts and
+    written to count.log.
+"""
+
+import os
+import pickle
+import sqlite3
+import time
+from collections import Counter
+
+
+class VariantCache(object):
+
+    def __init__(self, path, version='', max_entries=1000000, timeout=60):
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.counts = Counter()
+        self.conn = None
+        self.pid = None
+
+    def __getstate__(self):
+        # connections stay in the process that opened them
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['counts'] = Counter()
+        return state
+
+    def connect(self):
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self.pid = os.getpid()
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS variants (key TEXT PRIMARY KEY, results BLOB, used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS variants_used ON variants (used)')
+        return self.conn
+
+    def signature(self, stages):
+        """ Part of the key naming the stages, as their results depend on them """
+        return ','.join([str(stage.function) + ':' + str(stage.table) for stage in stages])
+
+    def key(self, signature, variant):
+        return '\t'.join([self.version, signature] + [str(v) for v in variant])
+
+    def getMany(self, stages, variants):
+        """ Cached results of the stages for each variant, or None """
+        conn = self.connect()
+        signature = self.signature(stages)
+        keys = [self.key(signature, v) for v in variants]
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute('SELECT key, results FROM variants WHERE key IN (' + ','.join(['?'] * len(chunk)) + ')',
+                                chunk).fetchall()
+            for key, results in rows:
+                found[key] = pickle.loads(results)
+        if len(found) > 0:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE variants SET used = ? WHERE key = ?', [(now, key) for key in found])
+            conn.execute('COMMIT')
+        self.counts['hits'] += len(found)
+        self.counts['misses'] += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def putMany(self, stages, variants, results):
+        """ results[s][v] is the result of stage s for variants[v] """
+        if len(variants) == 0:
+            return
+        conn = self.connect()
+        signature = self.signature(stages)
+        now = time.time()
+        rows = [(self.key(signature, variants[v]), pickle.dumps(tuple([r[v] for r in results]), pickle.HIGHEST_PROTOCOL), now)
+                for v in range(0, len(variants))]
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT OR REPLACE INTO variants VALUES (?, ?, ?)', rows)
+        # in the same transaction, so no reader sees more than max_entries
+        self.evict(conn)
+        conn.execute('COMMIT')
+
+    def evict(self, conn):
+        """ Deletes the least recently used variants beyond max_entries; the
+            count reads the small index on used, a few ms per million rows """
+        excess = conn.execute('SELECT count(*) FROM variants').fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute('DELETE FROM variants WHERE key IN (SELECT key FROM variants ORDER BY used LIMIT ?)', (excess,))
+            self.counts['evicted'] += excess
+
+    def report(self, fh_log):
+        fh_log.write("Cache: " + str(self.counts['hits']) + " hits, " + str(self.counts['misses']) + " misses\n")
+
+    def close(self):
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+def missingVariants(variants, found):
+    return [variants[v] for v in range(0, len(variants)) if found[v] is None]
+
+
+""" results[s][v] of the stages for all variants, from found[v] (the cached
+    results of variant v, or None) and fresh[s][m] (those of the m-th missing
+    variant) """
+def mergeResults(stages, found, fresh):
+    results = [[] for stage in stages]
+    m = 0
+    for row in found:
+        for s in range(0, len(stages)):
+            if row is None:
+                results[s].append(fresh[s][m])
+            else:
+                results[s].append(row[s])
+        if row is None:
+            m = m + 1
+    return results
+
+
+""" results[s][v] of the stages for the variants, taken from the cache where
+    possible; lookup(missing) returns the results[s][m] of the others """
+def cachedLookups(cache, stages, variants, lookup):
+    if cache is None:
+        return lookup(variants)
+    found = cache.getMany(stages, variants)
+    missing = missingVariants(variants, found)
+    fresh = [[] for stage in stages]
+    if len(missing) > 0:
+        fresh = lookup(missing)
+        cache.putMany(stages, missing, fresh)
+    return mergeResults(stages, found, fresh)